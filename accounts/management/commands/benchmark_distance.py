@@ -0,0 +1,101 @@
+import random
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from accounts.utils import DistanceCalculator
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the per-rider haversine loop with the vectorized "
+        "DistanceCalculator batch path. 'batch' includes parsing the "
+        "'long,lat' strings, 'arrays' is the pure coordinate-array path."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            nargs="+",
+            type=int,
+            default=[1_000, 10_000, 100_000],
+            help="Numbers of riders to benchmark.",
+        )
+        parser.add_argument("--radius", type=float, default=5, help="Radius in km.")
+        parser.add_argument(
+            "--repeat", type=int, default=5, help="Runs per size, best is kept."
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        radius = options["radius"]
+        origin = "3.3792,6.5244"
+        calculator = DistanceCalculator(origin)
+
+        self.stdout.write(
+            f"{'riders':>10} {'loop (ms)':>12} {'batch (ms)':>12} "
+            f"{'arrays (ms)':>12} {'speedup':>9}"
+        )
+        for size in options["sizes"]:
+            riders_locations = [
+                {
+                    "email": f"rider{i}@example.com",
+                    "location": "{},{}".format(
+                        3.3792 + rng.uniform(-0.5, 0.5),
+                        6.5244 + rng.uniform(-0.5, 0.5),
+                    ),
+                }
+                for i in range(size)
+            ]
+
+            loop_time = self.best_of(
+                options["repeat"],
+                lambda: self.loop_within_radius(calculator, riders_locations, radius),
+            )
+            lats = [float(r["location"].split(",")[1]) for r in riders_locations]
+            longs = [float(r["location"].split(",")[0]) for r in riders_locations]
+            lats, longs = np.array(lats), np.array(longs)
+
+            batch_time = self.best_of(
+                options["repeat"],
+                lambda: calculator.destinations_within_radius(
+                    riders_locations, radius
+                ),
+            )
+            arrays_time = self.best_of(
+                options["repeat"],
+                lambda: calculator.within_radius_batch(lats, longs, radius),
+            )
+            self.stdout.write(
+                f"{size:>10} {loop_time * 1000:>12.2f} {batch_time * 1000:>12.2f} "
+                f"{arrays_time * 1000:>12.2f} {loop_time / batch_time:>8.1f}x"
+            )
+
+    @staticmethod
+    def best_of(repeat, func):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    @staticmethod
+    def loop_within_radius(calculator, riders_locations, radius):
+        """The scalar per-rider loop the batch path replaced."""
+        within_radius = []
+        for location in riders_locations:
+            lon, lat = map(float, location["location"].split(","))
+            distance = calculator.haversine_distance(
+                calculator.origin_lat, calculator.origin_long, lat, lon
+            )
+            if distance <= radius:
+                within_radius.append(
+                    {
+                        "email": location["email"],
+                        "location": "{},{}".format(lon, lat),
+                    }
+                )
+        return within_radius
@@ -1,11 +1,12 @@
-import requests
 from django.conf import settings
+from http_pool.sessions import get_session
 
 
 class PaystackServices:
     def __init__(self, email="", first_name="", last_name="", phone_number=""):
         self.api_key = settings.PAYSTACK_SECRET_KEY
-        self.base_url = "https://api.paystack.co/customer"
+        self.base_url = f"{settings.PAYSTACK_API_URL}/customer"
+        self.session = get_session("paystack")
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
@@ -22,7 +23,7 @@ class PaystackServices:
             "last_name": self.last_name,
             "phone": self.phone_number,
         }
-        response = requests.post(self.base_url, headers=self.headers, json=data)
+        response = self.session.post(self.base_url, headers=self.headers, json=data)
         response.raise_for_status()
         data = response.json()
         return data
@@ -41,7 +42,7 @@ class PaystackServices:
             "last_name": self.last_name,
         }
 
-        response = requests.post(url, headers=self.headers, json=params)
+        response = self.session.post(url, headers=self.headers, json=params)
         response.raise_for_status()
         data = response.json()
         return data
@@ -50,7 +51,7 @@ class PaystackServices:
         url = f"{self.base_url}/{email_or_code}"
         headers = {"Authorization": f"Bearer {self.api_key}"}
 
-        response = requests.get(url, headers=headers)
+        response = self.session.get(url, headers=headers)
         response.raise_for_status()
         data = response.json()
         return data["data"]
@@ -7,6 +7,8 @@ import pyotp
 from django.conf import settings
 from .models import CustomUser, UserVerification
 from math import radians, sin, cos, sqrt, atan2
+import numpy as np
+import heapq
 import logging
 from functools import wraps
 import time
@@ -42,6 +44,63 @@ class DistanceCalculator:
         distance = 6371 * c  # Earth radius in kilometers
         return distance
 
+    def bounding_box(self, radius):
+        """
+        Get the latitude/longitude box enclosing a circle around the origin.
+
+        Parameters:
+        radius: Radius in kilometers.
+
+        Returns:
+        Tuple of (min_lat, min_long, max_lat, max_long) in degrees.
+        """
+        lat_span = radius / 111.32
+        long_span = radius / (111.32 * max(cos(radians(self.origin_lat)), 0.01))
+        return (
+            self.origin_lat - lat_span,
+            self.origin_long - long_span,
+            self.origin_lat + lat_span,
+            self.origin_long + long_span,
+        )
+
+    def distances_to(self, lats, longs):
+        """
+        Calculate the distance between the origin and many points in a single
+        vectorized pass of the Haversine formula.
+
+        Parameters:
+        lats, longs: Sequences or arrays of latitudes and longitudes (in degrees).
+
+        Returns:
+        numpy array of distances in kilometers, in the same order as the input.
+        """
+        lat1, lon1 = np.radians(self.origin_lat), np.radians(self.origin_long)
+        lat2 = np.radians(np.asarray(lats, dtype=float))
+        lon2 = np.radians(np.asarray(longs, dtype=float))
+
+        dlat = lat2 - lat1
+        dlon = lon2 - lon1
+        a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+        c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+        return 6371 * c  # Earth radius in kilometers
+
+    def within_radius_batch(self, lats, longs, radius):
+        """
+        Find the points within a specified radius of the origin.
+
+        Parameters:
+        lats, longs: Sequences or arrays of latitudes and longitudes (in degrees).
+        radius: Radius in kilometers.
+
+        Returns:
+        Tuple of (indices, distances): the positions in the input of the points
+        within the radius and their distances in kilometers, so callers can
+        sort or rank by distance.
+        """
+        distances = self.distances_to(lats, longs)
+        indices = np.flatnonzero(distances <= radius)
+        return indices, distances[indices]
+
     def destinations_within_radius(self, riders_locations, radius):
         """
         Find riders_locations within a specified radius of the origin.
@@ -54,20 +113,66 @@ class DistanceCalculator:
         Returns:
         List of dictionaries for riders_locations within the specified radius of the origin.
         """
-        within_radius = []
-        for location in riders_locations:
-            lon, lat = map(float, location["location"].split(","))
-            distance = self.haversine_distance(
-                self.origin_lat, self.origin_long, lat, lon
-            )
-            if distance <= radius:
-                within_radius.append(
-                    {
-                        "email": location["email"],
-                        "location": "{},{}".format(lon, lat),
-                    }
-                )
-        return within_radius
+        if not riders_locations:
+            return []
+
+        coordinates = self.parse_locations(riders_locations)
+        indices, _ = self.within_radius_batch(
+            coordinates[:, 1], coordinates[:, 0], radius
+        )
+        return [
+            {
+                "email": riders_locations[i]["email"],
+                "location": "{},{}".format(*coordinates[i].tolist()),
+            }
+            for i in indices
+        ]
+
+    def nearest_destinations(self, riders_locations, k, radius):
+        """
+        Find the k riders_locations closest to the origin within a radius.
+
+        Parameters:
+        riders_locations: List of dictionaries, each containing 'email' and 'location' keys.
+                    'location' is a str containing 'longitude,latitude'.
+        k: Maximum number of riders_locations to return.
+        radius: Radius in kilometers.
+
+        Returns:
+        List of dictionaries for the closest riders_locations, sorted by distance.
+        """
+        if not riders_locations or k <= 0:
+            return []
+
+        coordinates = self.parse_locations(riders_locations)
+        indices, distances = self.within_radius_batch(
+            coordinates[:, 1], coordinates[:, 0], radius
+        )
+        # Bounded heap selection, only the k best candidates are kept in order
+        nearest = heapq.nsmallest(k, zip(distances.tolist(), indices.tolist()))
+        return [
+            {
+                "email": riders_locations[i]["email"],
+                "location": "{},{}".format(*coordinates[i].tolist()),
+            }
+            for _, i in nearest
+        ]
+
+    @staticmethod
+    def parse_locations(riders_locations):
+        """
+        Parse the 'longitude,latitude' strings of riders_locations into an
+        array of shape (n, 2) holding (longitude, latitude) rows.
+
+        Raises:
+        ValueError: If a location is not made of exactly two numbers.
+        """
+        coordinates = [location["location"].split(",") for location in riders_locations]
+        for location, parts in zip(riders_locations, coordinates):
+            if len(parts) != 2:
+                raise ValueError(f"Invalid location: {location['location']!r}")
+        # Converted to floats by numpy in one pass
+        return np.array(coordinates, dtype=float).reshape(-1, 2)
 
 
 def retry(ExceptionToCheck=Exception, tries=3, delay=1, backoff=2, logger=None):
@@ -160,7 +265,7 @@ def send_riders_notification(
     order_id=None,
     order_info=None,
 ):
-    supabase.send_riders_notification(
+    return supabase.send_riders_notification(
         riders,
         price,
         message,
@@ -213,3 +318,15 @@ def send_verification_email(user_id, purpose=None):
 
 def str_to_bool(s):
     return s.lower() in ["true", "1", "yes", "on"]
+
+
+def format_duration(duration):
+    """Format a duration in seconds the way the map clients display it."""
+    duration_minutes, duration_seconds = divmod(duration, 60)
+
+    if duration <= 60:
+        return f"{duration} secs"
+    elif duration_seconds == 0:
+        return f"{duration_minutes} minutes"
+    else:
+        return f"{duration_minutes} mins {duration_seconds} secs"
@@ -102,12 +102,17 @@ class BaseRegistrationView(generics.CreateAPIView):
                         ).data
 
                         if user_obj_serializer:
-                            # Send a welcome email or perform any additional actions
-                            send_verification_email.delay(user.id, "registration")
+                            # Send a welcome email or perform any additional
+                            # actions, once the user is committed
+                            transaction.on_commit(
+                                lambda: send_verification_email.delay(
+                                    user.id, "registration"
+                                )
+                            )
 
                             # Return a response with the serialized user object and a success message
                             table, data = self.get_user_supabase_creation_info(self.user_model,user)
-                            create_on_table.delay(table, data)
+                            transaction.on_commit(lambda: create_on_table.delay(table, data))
                             return Response(
                                 {
                                     "data": user_obj_serializer,
@@ -0,0 +1,378 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from math import atan2, cos, radians, sin, sqrt
+from urllib.parse import parse_qs, unquote, urlsplit
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+SERVICES = ("mapbox", "tomtom", "supabase", "paystack")
+
+# Road distance is longer than the straight line between two points, and
+# riders average about 25 km/h in city traffic
+CIRCUITY = 1.3
+SPEED_METERS_PER_SECOND = 25 / 3.6
+
+
+def estimate_route(origin, destination):
+    """
+    Estimate the road distance (meters) and duration (seconds) between two
+    (latitude, longitude) points.
+    """
+    lat1, long1 = map(radians, origin)
+    lat2, long2 = map(radians, destination)
+    a = (
+        sin((lat2 - lat1) / 2) ** 2
+        + cos(lat1) * cos(lat2) * sin((long2 - long1) / 2) ** 2
+    )
+    distance = 6371000 * 2 * atan2(sqrt(a), sqrt(1 - a)) * CIRCUITY
+    return round(distance, 1), round(distance / SPEED_METERS_PER_SECOND, 1)
+
+
+def parse_coordinates(coordinates):
+    """Parse 'long,lat;long,lat' into a list of (lat, long) tuples."""
+    points = []
+    for point in unquote(coordinates).split(";"):
+        long, lat = map(float, point.split(","))
+        points.append((lat, long))
+    return points
+
+
+class ServiceBehaviour:
+    """
+    How a fake service responds: ``latency`` seconds (+/- ``jitter``) before
+    answering, and ``error_rate`` of requests failing with a 503.
+    """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    def delay(self):
+        return max(0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def should_fail(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+class FakeProviderServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the Mapbox, TomTom, Supabase and Paystack endpoints
+    used by the app, so dispatch can be exercised and benchmarked without
+    calling the paid APIs.
+
+    Each service is served under its own prefix, e.g. point MAPBOX_API_URL at
+    ``<url>/mapbox`` and SUPABASE_URL at ``<url>/supabase``. Supabase tables
+    are kept in memory.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 8900), behaviours=None, async_job_seconds=0.5):
+        super().__init__(address, FakeProviderHandler)
+        self.behaviours = {service: ServiceBehaviour() for service in SERVICES}
+        self.behaviours.update(behaviours or {})
+        self.async_job_seconds = async_job_seconds
+        self.tables = {}
+        self.jobs = {}
+        self.paystack_customers = {}
+        self.request_counts = {service: 0 for service in SERVICES}
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def service_url(self, service):
+        return f"{self.url}/{service}"
+
+    def start(self):
+        """Serve from a daemon thread, returning the server."""
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="fake-providers", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def next_id(self):
+        return next(self._ids)
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    server_version = "FakeProviders/1.0"
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PATCH(self):
+        self.dispatch("PATCH")
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        # PostgREST repeats a column for each of its conditions, e.g.
+        # current_lat=gte.6.4&current_lat=lte.6.6
+        self.query_values = parse_qs(url.query)
+        self.query = {key: values[-1] for key, values in self.query_values.items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        self.body = json.loads(self.rfile.read(length)) if length else None
+
+        service = parts[0] if parts else None
+        if service not in SERVICES:
+            return self.respond(404, {"message": "Unknown service"})
+        with self.server.lock:
+            self.server.request_counts[service] += 1
+
+        behaviour = self.server.behaviours[service]
+        time.sleep(behaviour.delay())
+        if behaviour.should_fail():
+            return self.respond(503, {"message": "Injected error"})
+
+        try:
+            getattr(self, f"handle_{service}")(method, parts[1:])
+        except (KeyError, ValueError, IndexError) as e:
+            self.respond(400, {"message": f"Bad request: {e}"})
+
+    def respond(self, status, data, headers=None):
+        content = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    # Mapbox
+
+    def handle_mapbox(self, method, parts):
+        if parts[:3] == ["directions-matrix", "v1", "mapbox"]:
+            return self.mapbox_matrix(parse_coordinates(parts[4]))
+        if parts[:3] == ["directions", "v5", "mapbox"]:
+            origin, destination = parse_coordinates(parts[4])[:2]
+            distance, duration = estimate_route(origin, destination)
+            return self.respond(
+                200,
+                {"code": "Ok", "routes": [{"distance": distance, "duration": duration}]},
+            )
+        self.respond(404, {"message": "Not Found"})
+
+    def mapbox_matrix(self, points):
+        def indices(name):
+            value = self.query.get(name, "all")
+            if value == "all":
+                return list(range(len(points)))
+            return [int(index) for index in value.split(";")]
+
+        cells = [
+            [estimate_route(points[i], points[j]) for j in indices("destinations")]
+            for i in indices("sources")
+        ]
+        annotations = self.query.get("annotations", "duration").split(",")
+        data = {"code": "Ok"}
+        if "distance" in annotations:
+            data["distances"] = [[cell[0] for cell in row] for row in cells]
+        if "duration" in annotations:
+            data["durations"] = [[cell[1] for cell in row] for row in cells]
+        self.respond(200, data)
+
+    # TomTom
+
+    def handle_tomtom(self, method, parts):
+        if parts[:3] != ["routing", "matrix", "2"]:
+            return self.respond(404, {"detailedError": {"message": "Not Found"}})
+        parts = parts[3:]
+        if method == "POST" and not parts:
+            return self.respond(200, self.tomtom_matrix(self.body))
+        if method == "POST" and parts == ["async"]:
+            job_id = f"job-{self.server.next_id()}"
+            self.server.jobs[job_id] = (
+                time.monotonic() + self.server.async_job_seconds,
+                self.tomtom_matrix(self.body),
+            )
+            return self.respond(202, {"jobId": job_id, "state": "Submitted"})
+        if method == "GET" and parts[0] == "async" and len(parts) >= 2:
+            job = self.server.jobs.get(parts[1])
+            if job is None:
+                return self.respond(404, {"detailedError": {"message": "Job not found"}})
+            ready_at, result = job
+            completed = time.monotonic() >= ready_at
+            if parts[2:] == ["result"]:
+                if not completed:
+                    return self.respond(400, {"detailedError": {"message": "Job not completed"}})
+                return self.respond(200, result)
+            return self.respond(
+                200, {"jobId": parts[1], "state": "Completed" if completed else "InProgress"}
+            )
+        self.respond(404, {"detailedError": {"message": "Not Found"}})
+
+    def tomtom_matrix(self, payload):
+        def point(item):
+            return item["point"]["latitude"], item["point"]["longitude"]
+
+        data = []
+        for i, origin in enumerate(payload["origins"]):
+            for j, destination in enumerate(payload["destinations"]):
+                distance, duration = estimate_route(point(origin), point(destination))
+                data.append(
+                    {
+                        "originIndex": i,
+                        "destinationIndex": j,
+                        "routeSummary": {
+                            "lengthInMeters": round(distance),
+                            "travelTimeInSeconds": round(duration),
+                        },
+                    }
+                )
+        return {"data": data, "statistics": {"totalCount": len(data)}}
+
+    # Supabase (PostgREST)
+
+    def handle_supabase(self, method, parts):
+        if method == "POST" and parts[:3] == ["rest", "v1", "rpc"] and len(parts) == 4:
+            return self.supabase_rpc(parts[3])
+        if parts[:2] != ["rest", "v1"] or len(parts) != 3:
+            return self.respond(404, {"message": "Not Found"})
+        prefer = self.headers.get("Prefer", "")
+        with self.server.lock:
+            rows = self.server.tables.setdefault(parts[2], [])
+            if method == "GET":
+                result = [row for row in rows if self.matches(row)]
+                return self.respond(200, [self.project(row) for row in result])
+            if method == "PATCH":
+                result = [row for row in rows if self.matches(row)]
+                for row in result:
+                    row.update(self.body)
+                return self.respond(200, result if "return=representation" in prefer else [])
+            if method == "POST":
+                new_rows = self.body if isinstance(self.body, list) else [self.body]
+                conflict_column = self.query.get("on_conflict")
+                if conflict_column is None and "resolution=merge-duplicates" in prefer:
+                    conflict_column = "id"
+                result = []
+                for new_row in new_rows:
+                    existing = None
+                    if "resolution=merge-duplicates" in prefer:
+                        existing = next(
+                            (
+                                row
+                                for row in rows
+                                if row.get(conflict_column) == new_row.get(conflict_column)
+                            ),
+                            None,
+                        )
+                    if existing is not None:
+                        existing.update(new_row)
+                        result.append(existing)
+                    else:
+                        row = {"id": self.server.next_id(), **new_row}
+                        rows.append(row)
+                        result.append(row)
+                return self.respond(201, result if "return=representation" in prefer else [])
+        self.respond(405, {"message": "Method not allowed"})
+
+    def supabase_rpc(self, function):
+        # map_clients/sql/bulk_update_rows.sql
+        if function != "bulk_update_rows":
+            return self.respond(404, {"message": f"Unknown function {function}"})
+        key_column = self.body["key_column"]
+        updated = []
+        with self.server.lock:
+            rows = self.server.tables.setdefault(self.body["target_table"], [])
+            for new_row in self.body["rows"]:
+                for row in rows:
+                    if str(row.get(key_column)) == str(new_row[key_column]):
+                        row.update(new_row)
+                        updated.append(str(new_row[key_column]))
+        self.respond(200, updated)
+
+    def matches(self, row):
+        for column, conditions in self.query_values.items():
+            if column in ("select", "on_conflict", "order", "limit", "offset"):
+                continue
+            for condition in conditions:
+                operator, _, value = condition.partition(".")
+                if not self.compare(row.get(column), operator, value):
+                    return False
+        return True
+
+    @staticmethod
+    def compare(actual, operator, expected):
+        if operator == "in":
+            values = [value.strip('"') for value in expected.strip("()").split(",")]
+            return str(actual) in values
+        if actual is None:
+            return False
+        try:
+            actual, expected = float(actual), float(expected)
+        except (TypeError, ValueError):
+            actual = str(actual)
+        comparisons = {
+            "eq": lambda: actual == expected,
+            "neq": lambda: actual != expected,
+            "gt": lambda: actual > expected,
+            "gte": lambda: actual >= expected,
+            "lt": lambda: actual < expected,
+            "lte": lambda: actual <= expected,
+        }
+        if operator not in comparisons:
+            raise ValueError(f"Unsupported operator: {operator}")
+        return comparisons[operator]()
+
+    def project(self, row):
+        columns = self.query.get("select", "*").split(",")
+        if "*" in columns:
+            return dict(row)
+        return {column: row.get(column) for column in columns}
+
+    # Paystack
+
+    def handle_paystack(self, method, parts):
+        if parts[:1] != ["customer"]:
+            return self.respond(404, {"status": False, "message": "Not Found"})
+        customers = self.server.paystack_customers
+        if method == "POST" and len(parts) == 1:
+            customer = {
+                **self.body,
+                "id": self.server.next_id(),
+                "customer_code": f"CUS_fake{len(customers) + 1}",
+                "identified": False,
+            }
+            customers[customer["email"]] = customer
+            return self.respond(200, {"status": True, "message": "Customer created", "data": customer})
+        if method == "POST" and parts[2:] == ["identification"]:
+            return self.respond(
+                202, {"status": True, "message": "Customer Identification in progress"}
+            )
+        if method == "GET" and len(parts) == 2:
+            customer = customers.get(parts[1]) or next(
+                (
+                    customer
+                    for customer in customers.values()
+                    if customer["customer_code"] == parts[1]
+                ),
+                None,
+            )
+            if customer is None:
+                return self.respond(404, {"status": False, "message": "Customer not found"})
+            return self.respond(200, {"status": True, "message": "Customer retrieved", "data": customer})
+        self.respond(404, {"status": False, "message": "Not Found"})
@@ -0,0 +1,74 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    Tokens are added continuously at ``rate`` per second up to ``capacity``.
+    Callers only wait when the bucket is empty, i.e. when the provider quota
+    is actually exhausted, instead of sleeping a fixed interval.
+    """
+
+    def __init__(self, rate, capacity):
+        if rate <= 0 or capacity <= 0:
+            raise ValueError("rate and capacity must be greater than 0")
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def try_acquire(self, tokens=1):
+        """Take ``tokens`` if available without waiting. Returns True on success."""
+        with self._lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1, timeout=None):
+        """
+        Take ``tokens``, waiting for the bucket to refill if needed.
+
+        Returns:
+        bool: False if the tokens could not be taken within ``timeout`` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return True
+                wait = (tokens - self.tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+
+_buckets = {}
+_lock = threading.Lock()
+
+
+def get_rate_limiter(name, rate, capacity):
+    """
+    Get the token bucket shared by every caller of ``name`` in this process,
+    creating it on first use.
+    """
+    with _lock:
+        if name not in _buckets:
+            _buckets[name] = TokenBucket(rate, capacity)
+        return _buckets[name]
@@ -0,0 +1,134 @@
+from django.conf import settings
+import asyncio
+import logging
+import os
+import threading
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger(__name__)
+
+
+class TimeoutSession(requests.Session):
+    """
+    A requests session that applies a default (connect, read) timeout to
+    every request which does not set its own.
+    """
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+_sessions = {}
+_sessions_pid = None
+_lock = threading.Lock()
+
+
+def create_session(
+    pool_size=None,
+    connect_timeout=None,
+    read_timeout=None,
+):
+    """
+    Create a keep-alive session with a connection pool of ``pool_size``
+    connections per host and explicit connect/read timeouts in seconds.
+    """
+    pool_size = pool_size or settings.HTTP_POOL_SIZE
+    timeout = (
+        connect_timeout or settings.HTTP_CONNECT_TIMEOUT,
+        read_timeout or settings.HTTP_READ_TIMEOUT,
+    )
+    session = TimeoutSession(timeout)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(name="default"):
+    """
+    Get the pooled session shared by every caller of the ``name``
+    integration in this process, creating it on first use.
+
+    Sessions are never shared with forked children (e.g. gunicorn or celery
+    workers), each process opens its own connections.
+    """
+    global _sessions_pid
+
+    pid = os.getpid()
+    session = _sessions.get(name)
+    if session is not None and _sessions_pid == pid:
+        return session
+
+    with _lock:
+        if _sessions_pid != pid:
+            _sessions.clear()
+            _sessions_pid = pid
+        if name not in _sessions:
+            _sessions[name] = create_session()
+        return _sessions[name]
+
+
+_async_clients = {}
+_client_loop = None
+_client_loop_pid = None
+
+
+def get_client_loop():
+    """
+    Get the event loop running the async HTTP requests of this process, on
+    its own thread, starting it on first use.
+
+    async_to_sync runs each call on a new event loop, so clients kept per
+    calling loop would open a connection pool per request and never close
+    it. Running the requests on one long-lived loop lets every caller share
+    one client.
+    """
+    global _client_loop, _client_loop_pid
+
+    pid = os.getpid()
+    with _lock:
+        if _client_loop_pid != pid:
+            _async_clients.clear()
+            _client_loop = asyncio.new_event_loop()
+            _client_loop_pid = pid
+            threading.Thread(
+                target=_client_loop.run_forever, name="http-pool-async", daemon=True
+            ).start()
+        return _client_loop
+
+
+async def run_on_client_loop(coroutine):
+    """Await a coroutine using an async client on the client loop."""
+    return await asyncio.wrap_future(
+        asyncio.run_coroutine_threadsafe(coroutine, get_client_loop())
+    )
+
+
+def get_async_client(name="default"):
+    """
+    Get the pooled httpx client shared by every caller of the ``name``
+    integration in this process, creating it on first use. Its requests must
+    be run with run_on_client_loop.
+    """
+    get_client_loop()
+    with _lock:
+        if name not in _async_clients:
+            _async_clients[name] = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=settings.HTTP_POOL_SIZE,
+                    max_keepalive_connections=settings.HTTP_POOL_SIZE,
+                ),
+                timeout=httpx.Timeout(
+                    settings.HTTP_READ_TIMEOUT, connect=settings.HTTP_CONNECT_TIMEOUT
+                ),
+            )
+        return _async_clients[name]
@@ -1,5 +1,6 @@
 from django.contrib import admin
-from map_clients.models import MapClientManager
+from map_clients.models import MapClientManager, OutboxMessage
 
 # Register your models here.
 admin.site.register(MapClientManager)
+admin.site.register(OutboxMessage)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MapClientsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'map_clients'
+
+    def ready(self):
+        # Register the system checks
+        from map_clients import shared_cache  # noqa: F401
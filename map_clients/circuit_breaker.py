@@ -0,0 +1,144 @@
+from django.conf import settings
+import logging
+import time
+
+from map_clients.shared_cache import get_shared_cache
+
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker guarding calls to one provider.
+
+    Outcomes are counted in ``bucket_seconds`` buckets over a sliding window of
+    ``window_seconds``. Once at least ``minimum_calls`` were made in the window
+    and the failure rate reaches ``failure_rate_threshold`` the circuit opens
+    and calls are skipped for ``open_seconds``. After that a single trial call
+    is let through (half-open): success closes the circuit, failure opens it
+    again.
+
+    State lives in a Django cache so, with a shared cache such as Redis, every
+    gunicorn and celery worker sees the same circuit.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name,
+        cache,
+        failure_rate_threshold=0.5,
+        minimum_calls=5,
+        window_seconds=60,
+        open_seconds=30,
+        bucket_seconds=10,
+    ):
+        self.name = name
+        self.cache = cache
+        self.failure_rate_threshold = failure_rate_threshold
+        self.minimum_calls = minimum_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.bucket_seconds = bucket_seconds
+        self.opened_key = f"circuit:{name}:opened_at"
+        self.trial_key = f"circuit:{name}:trial"
+
+    @property
+    def state(self):
+        opened_at = self.cache.get(self.opened_key)
+        if opened_at is None:
+            return self.CLOSED
+        if time.time() - opened_at < self.open_seconds:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow_request(self):
+        """Return True if a call to the provider may be made now."""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.OPEN:
+            return False
+        # Half-open, only the worker that claims the trial slot gets through
+        return self.cache.add(self.trial_key, 1, timeout=self.open_seconds)
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            self.close()
+        self._count("success")
+
+    def record_failure(self):
+        if self.state == self.HALF_OPEN:
+            self.open()
+            return
+        self._count("failure")
+        successes, failures = self.window_counts()
+        calls = successes + failures
+        if (
+            calls >= self.minimum_calls
+            and failures / calls >= self.failure_rate_threshold
+        ):
+            self.open()
+
+    def open(self):
+        logger.warning(f"Circuit for {self.name} opened")
+        self.cache.set(self.opened_key, time.time(), timeout=None)
+        self.cache.delete(self.trial_key)
+
+    def close(self):
+        logger.info(f"Circuit for {self.name} closed")
+        self.cache.delete_many(
+            [self.opened_key, self.trial_key]
+            + [
+                self._bucket_key(outcome, bucket)
+                for bucket in self._window_buckets()
+                for outcome in ("success", "failure")
+            ]
+        )
+
+    def window_counts(self):
+        """Return the (successes, failures) counted in the sliding window."""
+        keys = {
+            outcome: [self._bucket_key(outcome, bucket) for bucket in self._window_buckets()]
+            for outcome in ("success", "failure")
+        }
+        counts = self.cache.get_many(keys["success"] + keys["failure"])
+        return (
+            sum(counts.get(key, 0) for key in keys["success"]),
+            sum(counts.get(key, 0) for key in keys["failure"]),
+        )
+
+    def stats(self):
+        successes, failures = self.window_counts()
+        return {"state": self.state, "successes": successes, "failures": failures}
+
+    def _window_buckets(self):
+        current = int(time.time() // self.bucket_seconds)
+        return range(current - self.window_seconds // self.bucket_seconds, current + 1)
+
+    def _bucket_key(self, outcome, bucket):
+        return f"circuit:{self.name}:{outcome}:{bucket}"
+
+    def _count(self, outcome):
+        key = self._bucket_key(outcome, int(time.time() // self.bucket_seconds))
+        self.cache.add(key, 0, timeout=self.window_seconds + self.bucket_seconds)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            # The bucket expired between add and incr
+            self.cache.set(key, 1, timeout=self.window_seconds + self.bucket_seconds)
+
+
+def get_circuit_breaker(name):
+    return CircuitBreaker(
+        name,
+        get_shared_cache(),
+        failure_rate_threshold=settings.MAP_CLIENTS_BREAKER_FAILURE_RATE,
+        minimum_calls=settings.MAP_CLIENTS_BREAKER_MINIMUM_CALLS,
+        window_seconds=settings.MAP_CLIENTS_BREAKER_WINDOW_SECONDS,
+        open_seconds=settings.MAP_CLIENTS_BREAKER_OPEN_SECONDS,
+    )
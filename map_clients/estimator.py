@@ -0,0 +1,261 @@
+from django.conf import settings
+from django.utils import timezone
+from math import floor
+from statistics import median
+import logging
+import threading
+import time
+
+from accounts.utils import DistanceCalculator
+from map_clients.shared_cache import get_shared_cache
+from orders.models import Order
+
+
+logger = logging.getLogger(__name__)
+
+KM_PER_DEGREE = 111.32
+PROFILE_CACHE_KEY = "map_clients:travel_profile"
+
+# Trips outside these bounds are GPS or data entry noise
+MIN_CIRCUITY, MAX_CIRCUITY = 1.0, 3.0
+MIN_SPEED, MAX_SPEED = 1.0, 40.0  # meters per second
+
+
+class TravelProfile:
+    """
+    Circuity (road distance over straight-line distance) and average speed
+    learned from completed trips, per square zone of ``zone_size_km`` and
+    hour of the day.
+
+    Lookups fall back from (zone, hour) to the zone, then the hour, then the
+    whole service area and finally to the defaults, each level only being
+    used once it has at least ``min_samples`` trips.
+    """
+
+    def __init__(
+        self,
+        zone_size_km,
+        default_circuity=1.3,
+        default_speed=6.0,
+        min_samples=5,
+        profiles=None,
+    ):
+        self.zone_size_deg = zone_size_km / KM_PER_DEGREE
+        self.default_circuity = default_circuity
+        self.default_speed = default_speed
+        self.min_samples = min_samples
+        self.profiles = profiles or {}
+
+    def zone_for(self, lat, long):
+        return floor(lat / self.zone_size_deg), floor(long / self.zone_size_deg)
+
+    def lookup(self, lat, long, hour):
+        """Return the (circuity, speed in m/s) to use around a point at an hour."""
+        zone = self.zone_for(lat, long)
+        for key in (
+            self.key(zone, hour),
+            self.key(zone, None),
+            self.key(None, hour),
+            self.key(None, None),
+        ):
+            profile = self.profiles.get(key)
+            if profile is not None:
+                return profile
+        return self.default_circuity, self.default_speed
+
+    @staticmethod
+    def key(zone, hour):
+        zone = "*" if zone is None else f"{zone[0]}:{zone[1]}"
+        hour = "*" if hour is None else str(hour)
+        return f"{zone}/{hour}"
+
+    def learn(self, trips):
+        """
+        Build the profiles from completed trips.
+
+        Parameters:
+        trips: Iterable of (pickup_lat, pickup_long, recipient_lat,
+                    recipient_long, distance in meters, duration in seconds,
+                    hour) tuples.
+
+        Returns:
+        The number of trips used.
+        """
+        samples = {}
+        used = 0
+        for trip in trips:
+            pickup_lat, pickup_long, recipient_lat, recipient_long = trip[:4]
+            distance, duration, hour = trip[4:]
+            if None in trip[:4] or not duration:
+                continue
+            straight_line = (
+                DistanceCalculator(f"{pickup_long},{pickup_lat}").haversine_distance(
+                    pickup_lat, pickup_long, recipient_lat, recipient_long
+                )
+                * 1000
+            )
+            if straight_line < 100:
+                continue
+            circuity = distance / straight_line
+            speed = distance / duration
+            if not (
+                MIN_CIRCUITY <= circuity <= MAX_CIRCUITY and MIN_SPEED <= speed <= MAX_SPEED
+            ):
+                continue
+            used += 1
+            zone = self.zone_for(
+                (pickup_lat + recipient_lat) / 2, (pickup_long + recipient_long) / 2
+            )
+            for key in (
+                self.key(zone, hour),
+                self.key(zone, None),
+                self.key(None, hour),
+                self.key(None, None),
+            ):
+                samples.setdefault(key, []).append((circuity, speed))
+
+        # Medians keep a few unusual trips from skewing a zone
+        self.profiles = {
+            key: (
+                round(median(circuity for circuity, _ in values), 4),
+                round(median(speed for _, speed in values), 4),
+            )
+            for key, values in samples.items()
+            if len(values) >= self.min_samples
+        }
+        return used
+
+
+class RoadEstimator:
+    """
+    Estimate road distance and ETA from the straight-line distance and the
+    learned travel profile, without any network call.
+
+    The profile is learned by the refresh_travel_profile task and shared
+    through the cache, each process reloads it every ``reload_seconds``.
+    """
+
+    def __init__(self, cache, zone_size_km, reload_seconds):
+        self.cache = cache
+        self.zone_size_km = zone_size_km
+        self.reload_seconds = reload_seconds
+        self.profile = TravelProfile(zone_size_km)
+        self.loaded_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def profile_is_stale(self):
+        return (
+            self.loaded_at is None
+            or time.monotonic() - self.loaded_at > self.reload_seconds
+        )
+
+    def get_profile(self):
+        if self.profile_is_stale:
+            with self._lock:
+                if self.profile_is_stale:
+                    try:
+                        profiles = self.cache.get(PROFILE_CACHE_KEY)
+                    except Exception as e:
+                        logger.error(f"Error loading travel profile: {str(e)}")
+                        profiles = None
+                    if profiles is not None:
+                        self.profile = TravelProfile(self.zone_size_km, profiles=profiles)
+                    self.loaded_at = time.monotonic()
+        return self.profile
+
+    def estimate(self, origin, destinations, hour=None):
+        """
+        Estimate the road distance and duration from origin to each destination.
+
+        Parameters:
+        origin: str containing 'longitude,latitude'.
+        destinations: List of dictionaries, each containing 'email' and 'location' keys.
+        hour: Hour of the day of the trip, defaults to the current hour.
+
+        Returns:
+        List of dictionaries, each containing 'email', 'distance_meters' and
+        'duration_seconds', in the order of destinations.
+        """
+        if hour is None:
+            hour = timezone.localtime().hour
+        profile = self.get_profile()
+        calculator = DistanceCalculator(origin)
+        results = []
+        for destination in destinations:
+            long, lat = map(float, destination["location"].split(","))
+            circuity, speed = profile.lookup(
+                (calculator.origin_lat + lat) / 2,
+                (calculator.origin_long + long) / 2,
+                hour,
+            )
+            distance = (
+                calculator.haversine_distance(
+                    calculator.origin_lat, calculator.origin_long, lat, long
+                )
+                * 1000
+                * circuity
+            )
+            results.append(
+                {
+                    "email": destination["email"],
+                    "distance_meters": round(distance),
+                    "duration_seconds": round(distance / speed),
+                }
+            )
+        return results
+
+    def rank(self, origin, destinations, k):
+        """
+        Keep the k destinations with the shortest estimated ETA, a free
+        pre-ranking before the paid matrix call.
+        """
+        durations = {
+            result["email"]: result["duration_seconds"]
+            for result in self.estimate(origin, destinations)
+        }
+        return sorted(
+            destinations, key=lambda destination: durations[destination["email"]]
+        )[:k]
+
+    def learn(self, max_trips=50000):
+        """
+        Learn the travel profile from the most recent completed trips and
+        share it through the cache.
+
+        Returns:
+        The number of trips used.
+        """
+        trips = (
+            Order.objects.filter(
+                trip_distance_meters__isnull=False,
+                trip_duration_seconds__gt=0,
+                trip_route_estimated=False,
+            )
+            .order_by("-created_at")
+            .values_list(
+                "pickup_lat",
+                "pickup_long",
+                "recipient_lat",
+                "recipient_long",
+                "trip_distance_meters",
+                "trip_duration_seconds",
+                "created_at",
+            )[:max_trips]
+        )
+        profile = TravelProfile(self.zone_size_km)
+        used = profile.learn(
+            (*trip[:6], timezone.localtime(trip[6]).hour) for trip in trips.iterator()
+        )
+        self.cache.set(PROFILE_CACHE_KEY, profile.profiles, timeout=None)
+        with self._lock:
+            self.profile = profile
+            self.loaded_at = time.monotonic()
+        return used
+
+
+road_estimator = RoadEstimator(
+    get_shared_cache(),
+    zone_size_km=settings.TRAVEL_PROFILE_ZONE_KM,
+    reload_seconds=settings.TRAVEL_PROFILE_RELOAD_SECONDS,
+)
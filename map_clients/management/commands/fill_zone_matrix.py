@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from map_clients.map_clients import map_clients_manager
+from map_clients.zone_matrix import zone_matrix
+
+
+class Command(BaseCommand):
+    help = (
+        "Refresh the zone to zone travel time table from the map providers, "
+        "for the stalest zones of the current (or given) time of day bucket."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--origins",
+            type=int,
+            default=settings.ZONE_MATRIX_ORIGINS_PER_RUN,
+            help="Origin zones to refresh.",
+        )
+        parser.add_argument("--hour", type=int, help="Hour of the day to fill.")
+
+    def handle(self, *args, **options):
+        zones = zone_matrix.fill(
+            map_clients_manager, options["origins"], hour=options["hour"]
+        )
+        self.stdout.write(
+            f"Refreshed {zones} of {zone_matrix.grid.size} zones in "
+            f"{zone_matrix.path}"
+        )
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from map_clients.estimator import road_estimator
+from map_clients.shared_cache import require_shared_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Learn the circuity and speed per zone and hour used by the offline "
+        "road estimator from past trips, and share it with every worker."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max-trips", type=int, default=50000, help="Most recent trips to use."
+        )
+
+    def handle(self, *args, **options):
+        require_shared_cache()
+        trips = road_estimator.learn(max_trips=options["max_trips"])
+        profiles = road_estimator.profile.profiles
+        self.stdout.write(
+            f"Learned {len(profiles)} profiles from {trips} trips, "
+            f"service area: {profiles.get('*/*', 'not enough trips')}"
+        )
@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand
+
+from fake_providers.server import SERVICES, FakeProviderServer, ServiceBehaviour
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve local stand-ins for the Mapbox, TomTom, Supabase and Paystack "
+        "APIs, with configurable latency and error injection. Point "
+        "MAPBOX_API_URL, TOMTOM_API_URL, SUPABASE_URL and PAYSTACK_API_URL at "
+        "the printed URLs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8900)
+        parser.add_argument(
+            "--latency", type=float, default=0.05, help="Seconds before answering."
+        )
+        parser.add_argument(
+            "--jitter", type=float, default=0.02, help="Latency +/- seconds."
+        )
+        parser.add_argument(
+            "--error-rate", type=float, default=0, help="Share of requests failing."
+        )
+        for service in SERVICES:
+            parser.add_argument(
+                f"--{service}-latency", type=float, help=f"Override --latency for {service}."
+            )
+            parser.add_argument(
+                f"--{service}-error-rate",
+                type=float,
+                help=f"Override --error-rate for {service}.",
+            )
+        parser.add_argument(
+            "--async-job-seconds",
+            type=float,
+            default=0.5,
+            help="Seconds a TomTom async matrix job takes to complete.",
+        )
+
+    def handle(self, *args, **options):
+        behaviours = {}
+        for service in SERVICES:
+            latency = options[f"{service}_latency"]
+            error_rate = options[f"{service}_error_rate"]
+            behaviours[service] = ServiceBehaviour(
+                latency=options["latency"] if latency is None else latency,
+                jitter=options["jitter"],
+                error_rate=options["error_rate"] if error_rate is None else error_rate,
+            )
+
+        server = FakeProviderServer(
+            (options["host"], options["port"]),
+            behaviours=behaviours,
+            async_job_seconds=options["async_job_seconds"],
+        )
+        self.stdout.write("Serving fake providers:")
+        for service, setting in zip(
+            SERVICES, ("MAPBOX_API_URL", "TOMTOM_API_URL", "SUPABASE_URL", "PAYSTACK_API_URL")
+        ):
+            self.stdout.write(f"  {setting}={server.service_url(service)}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f"Requests served: {server.request_counts}")
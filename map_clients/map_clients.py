@@ -1,8 +1,20 @@
+from asgiref.sync import sync_to_async
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from django.conf import settings
+from django.core.cache import cache
 import logging
-import requests
-from accounts.utils import retry
+import threading
+import time
+from accounts.utils import format_duration
+from http_pool.rate_limit import TokenBucket, get_rate_limiter
+from http_pool.sessions import get_async_client, get_session, run_on_client_loop
+from map_clients.circuit_breaker import get_circuit_breaker
+from map_clients.estimator import road_estimator
+from map_clients.matrix_cache import matrix_cache
 from map_clients.models import MapClientManager
+from map_clients.provider_stats import ProviderStats
+from map_clients.routing import ProviderRouter
 
 from mapbox_distance_matrix.distance_matrix import MapboxDistanceDuration
 from tom_tom_map_api.distance_matrix import TomTomDistanceMatrix
@@ -10,21 +22,66 @@ from tom_tom_map_api.distance_matrix import TomTomDistanceMatrix
 logger = logging.getLogger(__name__)
 
 
+class MapClientsUnavailable(Exception):
+    """Raised when every map client failed or has its circuit open."""
+
+
 class MapClients:
-    def __init__(self, api_key=None):
+    # Most destinations a single provider request can hold
+    max_destinations_per_request = 1
+
+    def __init__(self, api_key=None, cache=matrix_cache):
         self.api_key = api_key
-        self.is_available = True
+        self.cache = cache
 
-    def get_distances_duration(self):
-        raise NotImplementedError("Subclasses must implement this method")
+    def get_distances_duration(self, origin, destinations):
+        """
+        Get distances and durations from origin to each destination, only
+        calling the provider for the pairs missing from the matrix cache.
 
-    def handle_exceptions(self, exception):
-        if isinstance(exception, requests.exceptions.RequestException) or isinstance(
-            exception, FileNotFoundError
-        ):
-            pass
-        else:
-            self.is_available = False
+        :param origin: The origin in the format 'longitude,latitude'.
+        :type origin: str
+        :param destinations: List of dictionaries, each containing 'email' and 'location' keys.
+        :type destinations: list
+        :return: List of dictionaries, each containing 'email', 'distance', 'duration',
+                 'distance_meters' and 'duration_seconds', in the order of destinations.
+        """
+        cached = {}
+        if self.cache is not None:
+            cached = self.cache.get_many(
+                origin, [destination["location"] for destination in destinations]
+            )
+        misses = [
+            destination
+            for destination in destinations
+            if destination["location"] not in cached
+        ]
+
+        if misses:
+            fetched = self.fetch_distances_duration(origin, misses)
+            if fetched is None:
+                return None
+            locations = {
+                destination["email"]: destination["location"] for destination in misses
+            }
+            fetched_results = {
+                locations[result["email"]]: {
+                    key: value for key, value in result.items() if key != "email"
+                }
+                for result in fetched
+            }
+            if self.cache is not None:
+                self.cache.set_many(origin, fetched_results)
+            cached.update(fetched_results)
+
+        return [
+            {"email": destination["email"], **cached[destination["location"]]}
+            for destination in destinations
+            if destination["location"] in cached
+        ]
+
+    def fetch_distances_duration(self, origin, destinations):
+        raise NotImplementedError("Subclasses must implement this method")
 
 
 class Mapbox(MapClients):
@@ -32,21 +89,25 @@ class Mapbox(MapClients):
         if api_key is None:
             api_key = settings.MAPBOX_API_KEY
         super().__init__(api_key)
+        requests_per_minute = settings.MAPBOX_MATRIX_REQUESTS_PER_MINUTE
+        self.mapbox = MapboxDistanceDuration(
+            self.api_key,
+            rate_limiter=get_rate_limiter(
+                "mapbox-matrix", requests_per_minute / 60, requests_per_minute
+            ),
+            max_concurrency=settings.MAPBOX_MATRIX_MAX_CONCURRENCY,
+            profile=settings.MAPBOX_MATRIX_PROFILE,
+            api_url=settings.MAPBOX_API_URL,
+        )
+        self.max_destinations_per_request = self.mapbox.batch_size
 
-    @retry(
-        (requests.exceptions.RequestException, FileNotFoundError),
-        tries=3,
-        delay=1,
-        backoff=2,
-        logger=logger,
-    )
-    def get_distances_duration(
+    def fetch_distances_duration(
         self,
         origin,
         destination,
     ):
         """
-        A method that uses retry decorator to make multiple attempts to get distances and durations between two locations using MapBox API.
+        Get distances and durations between two locations using MapBox API.
 
         :param origin: The origin of the distance calculation.
         :type origin: str
@@ -54,11 +115,18 @@ class Mapbox(MapClients):
         :type destination: str
         :return: The get_distance_duration method of the mapbox client
         """
-        try:
-            mapbox = MapboxDistanceDuration(self.api_key)
-            return mapbox.get_distance_duration(origin, destination)
-        except Exception as e:
-            self.handle_exceptions(e)
+        return self.mapbox.get_distance_duration(origin, destination)
+
+    def fetch_matrix(self, origins, destinations):
+        """
+        Get distances and durations from several origins to the same
+        destinations, packing as many of them as possible in each request.
+
+        :param origins: List of origins in the format 'longitude,latitude'.
+        :param destinations: List of dictionaries, each containing 'email' and 'location' keys.
+        :return: List with, for each origin, the results in the order of destinations.
+        """
+        return self.mapbox.get_matrix(origins, destinations)
 
 
 class TomTom(MapClients):
@@ -66,48 +134,127 @@ class TomTom(MapClients):
         if api_key is None:
             api_key = settings.TOMTOM_API_KEY
         super().__init__(api_key)
+        self.tomtom = TomTomDistanceMatrix(
+            self.api_key,
+            sync_max_cells=settings.TOMTOM_SYNC_MATRIX_MAX_CELLS,
+            poll_initial_delay=settings.TOMTOM_ASYNC_POLL_INITIAL_SECONDS,
+            poll_max_delay=settings.TOMTOM_ASYNC_POLL_MAX_SECONDS,
+            job_deadline=settings.TOMTOM_ASYNC_DEADLINE_SECONDS,
+            api_url=settings.TOMTOM_API_URL,
+        )
+        self.max_destinations_per_request = self.tomtom.sync_max_cells
 
-    @retry(
-        (requests.exceptions.RequestException, FileNotFoundError),
-        tries=3,
-        delay=1,
-        backoff=2,
-        logger=logger,
-    )
-    def get_distances_duration(
+    def fetch_distances_duration(
         self,
         origin,
         destination,
     ):
         """
-        A method that uses retry decorator to make multiple attempts to get distances and durations between two locations using TomTom API.
+        Get distances and durations between two locations using TomTom API.
 
         Parameters:
             origin (str): The starting location.
             destination (str): The destination location.
 
         Returns:
-            func: the get_async_response method of the tomtom client
+            func: the get_distance_duration method of the tomtom client
         """
-        try:
-            tomtom = TomTomDistanceMatrix(self.api_key)
-            return tomtom.get_async_response(origin, destination)
-        except Exception as e:
-            self.handle_exceptions(e)
+        return self.tomtom.get_distance_duration(origin, destination)
+
+
+class Estimator(MapClients):
+    """
+    Offline client answering from the road estimator. Its results are
+    approximate so they are flagged 'estimated' and never cached.
+    """
+
+    max_destinations_per_request = float("inf")
+
+    def __init__(self, estimator=road_estimator):
+        super().__init__(cache=None)
+        self.estimator = estimator
+
+    def fetch_distances_duration(self, origin, destinations):
+        return [
+            {
+                **result,
+                "distance": round(result["distance_meters"] / 1000, 2),
+                "duration": format_duration(result["duration_seconds"]),
+                "estimated": True,
+            }
+            for result in self.estimator.estimate(origin, destinations)
+        ]
 
 
 class MapClientsManager:
     def __init__(self):
         self.map_client_names = ["tomtom", "mapbox"]
-        self.map_client = MapClientManager()
-        self.client_name = self.map_client.current_map_client
+        self.clients = {}
+        self.breakers = {
+            client_name: get_circuit_breaker(client_name)
+            for client_name in self.map_client_names
+        }
+        self.provider_stats = {
+            client_name: ProviderStats() for client_name in self.map_client_names
+        }
+        self.router = ProviderRouter(
+            settings.MAP_CLIENTS_COST_PER_REQUEST,
+            latency_slo=settings.MAP_CLIENTS_LATENCY_SLO_SECONDS,
+            max_error_rate=settings.MAP_CLIENTS_MAX_ERROR_RATE,
+            provider_stats=self.provider_stats,
+        )
+        self.hedging_enabled = settings.MAP_CLIENTS_HEDGING_ENABLED
+        # At most MAP_CLIENTS_HEDGE_BUDGET_PER_MINUTE duplicate requests
+        self.hedge_budget = TokenBucket(
+            settings.MAP_CLIENTS_HEDGE_BUDGET_PER_MINUTE / 60,
+            settings.MAP_CLIENTS_HEDGE_BUDGET_PER_MINUTE,
+        )
+        self.hedge_counts = Counter()
+        self._lock = threading.Lock()
+        self._executor = None
+        self.estimator_fallback = settings.MAP_CLIENTS_ESTIMATOR_FALLBACK
+        self.estimator = Estimator()
+        self.estimator_fallbacks = 0
+
+    def get_preferred_client_name(self):
+        """
+        Get the client selected in the MapClientManager admin, cached for a
+        minute so it is not read from the database on every request.
+        """
+        client_name = cache.get("map_clients:preferred_client")
+        if client_name is None:
+            map_client = MapClientManager.objects.first()
+            client_name = (
+                map_client.current_map_client
+                if map_client is not None
+                else self.map_client_names[0]
+            )
+            cache.set("map_clients:preferred_client", client_name, timeout=60)
+        return client_name
+
+    def get_client_names(self, destinations_count=1):
+        """
+        Get the client names in the order they should be tried for a request
+        to destinations_count destinations, as ranked by the router. The
+        client selected in the admin wins ties.
+        """
+        preferred = self.get_preferred_client_name()
+        client_names = sorted(
+            self.map_client_names, key=lambda client_name: client_name != preferred
+        )
+        max_destinations = {
+            client_name: self.get_client(client_name).max_destinations_per_request
+            for client_name in client_names
+        }
+        return self.router.rank(client_names, destinations_count, max_destinations)
 
     def get_client(self, client_name=None):
         """
         Get the client based on the client name.
 
         Args:
-            client_name (str, optional): The name of the client. Defaults to None.
+            client_name (str, optional): The name of the client. Defaults to the
+                                         preferred client.
 
         Returns:
             Mapbox or TomTom: The client object based on the client_name.
@@ -116,40 +263,276 @@ class MapClientsManager:
             ValueError: If the client_name is not "mapbox" or "tomtom".
         """
         if client_name is None:
-            client_name = self.client_name
+            client_name = self.get_preferred_client_name()
 
-        if client_name == "mapbox":
-            return Mapbox()
-        elif client_name == "tomtom":
-            return TomTom()
-        else:
-            raise ValueError(f"Unknown client: {client_name}")
+        # Clients are built once per manager so their pooled sessions are reused
+        if client_name not in self.clients:
+            if client_name == "mapbox":
+                self.clients[client_name] = Mapbox()
+            elif client_name == "tomtom":
+                self.clients[client_name] = TomTom()
+            else:
+                raise ValueError(f"Unknown client: {client_name}")
+        return self.clients[client_name]
+
+    def get_distances_duration(self, origin, destinations, client_names=None):
+        """
+        Get distances and durations from the first client that is up.
+
+        Clients whose circuit is open are skipped straight away, a failure
+        falls through to the next client instead of being retried. In hedged
+        mode the next client is also asked when the first one is slower than
+        its usual p95 latency, and the first answer wins.
+
+        When no client could answer, the offline estimator answers instead
+        (degraded mode) unless MAP_CLIENTS_ESTIMATOR_FALLBACK is off.
+
+        Raises:
+            MapClientsUnavailable: If no client could answer and the estimator
+                                   fallback is off.
+        """
+        if client_names is None:
+            client_names = self.get_client_names(len(destinations))
+        client_names = iter(client_names)
+        while True:
+            client_name = self.next_available_client(client_names)
+            if client_name is None:
+                if self.estimator_fallback:
+                    logger.warning("No map client is available, estimating offline")
+                    self.count_estimator_fallback()
+                    return self.estimator.get_distances_duration(origin, destinations)
+                raise MapClientsUnavailable("No map client is available")
+
+            if self.hedging_enabled:
+                success, results = self.call_hedged(
+                    client_name, client_names, origin, destinations
+                )
+            else:
+                success, results = self.call_client(
+                    client_name, origin, destinations
+                )
+            if success:
+                return results
+
+    async def aget_distances_duration(self, origin, destinations):
+        """
+        Async version of get_distances_duration for async views. The
+        provider calls run on a worker thread so the event loop keeps serving
+        other requests while waiting on them.
+        """
+        client_names = await sync_to_async(self.get_client_names)(len(destinations))
+        return await sync_to_async(self.get_distances_duration, thread_sensitive=False)(
+            origin, destinations, client_names
+        )
+
+    def next_available_client(self, client_names):
+        for client_name in client_names:
+            if self.breakers[client_name].allow_request():
+                return client_name
+            logger.warning(f"Skipping {client_name}, its circuit is open")
+        return None
+
+    def call_client(self, client_name, origin, destinations):
+        """
+        Call a client, recording the outcome in its circuit breaker and
+        latency statistics.
+
+        Returns:
+            Tuple of (success, results).
+        """
+        breaker = self.breakers[client_name]
+        start = time.monotonic()
+        try:
+            results = self.get_client(client_name).get_distances_duration(
+                origin, destinations
+            )
+        except Exception as e:
+            logger.error(f"Error from {client_name}: {str(e)}")
+            self.provider_stats[client_name].record(time.monotonic() - start, False)
+            breaker.record_failure()
+            return False, None
+        self.provider_stats[client_name].record(time.monotonic() - start, True)
+        breaker.record_success()
+        return True, results
+
+    def get_hedge_delay(self, client_name):
+        """
+        Seconds to wait for a client before hedging, its p95 latency once
+        enough calls were seen.
+        """
+        stats = self.provider_stats[client_name]
+        if len(stats) < settings.MAP_CLIENTS_HEDGE_MIN_SAMPLES:
+            return settings.MAP_CLIENTS_HEDGE_DEFAULT_DELAY_SECONDS
+        return max(
+            stats.percentile(95) or 0, settings.MAP_CLIENTS_HEDGE_MIN_DELAY_SECONDS
+        )
 
-    def switch_client(self):
+    def call_hedged(self, client_name, client_names, origin, destinations):
         """
-        Switches to the next available client and saves the change.
+        Call a client and, if it has not answered within its hedge delay and
+        the hedge budget allows, the next available client as well. The first
+        successful answer is returned, the slower call finishes in the
+        background and still fills the matrix cache.
         """
-        current_client = self.get_client()
-        if not current_client.is_available:
-            current_index = self.map_client_names.index(self.client_name)
-            next_index = (current_index + 1) % len(self.map_client_names)
-            next_client_name = self.map_client_names[next_index]
-            self.map_client.current_map_client = next_client_name
-            self.map_client.save()
-            logger.info(f"Switched to {next_client_name}, {self.client_name} is down")
+        started = threading.Event()
+
+        def call_primary():
+            started.set()
+            return self.call_client(client_name, origin, destinations)
+
+        primary = self.get_executor().submit(call_primary)
+        # The delay runs from when the call starts, a call queued behind busy
+        # workers is not slow. Waiting for a worker is still bounded by the
+        # provider timeout, after which the call counts as failed and the
+        # next client is tried.
+        timeout = settings.HTTP_CONNECT_TIMEOUT + settings.HTTP_READ_TIMEOUT
+        if not started.wait(timeout):
+            primary.cancel()
+            logger.error(f"No worker free to call {client_name}")
+            self.count_hedge("queue_timeout")
+            return False, None
+        done, _ = wait([primary], timeout=self.get_hedge_delay(client_name))
+        if done:
+            self.count_hedge("not_hedged")
+            return primary.result()
+
+        if not self.hedge_budget.try_acquire():
+            self.count_hedge("budget_exhausted")
+            return primary.result()
+        hedge_client_name = self.next_available_client(client_names)
+        if hedge_client_name is None:
+            self.count_hedge("no_hedge_client")
+            return primary.result()
+
+        self.count_hedge("hedged")
+        hedge = self.get_executor().submit(
+            self.call_client, hedge_client_name, origin, destinations
+        )
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                success, results = future.result()
+                if success:
+                    self.count_hedge("hedge_won" if future is hedge else "primary_won")
+                    return success, results
+        return False, None
+
+    def get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=settings.MAP_CLIENTS_HEDGE_MAX_WORKERS,
+                    thread_name_prefix="map-clients-hedge",
+                )
+            return self._executor
 
+    def count_hedge(self, outcome):
+        with self._lock:
+            self.hedge_counts[outcome] += 1
 
-def get_distance(origin, destination):
+    def count_estimator_fallback(self):
+        with self._lock:
+            self.estimator_fallbacks += 1
+
+    async def aget_route(self, origin, destination):
+        """
+        Get the driving route between two points from the Mapbox Directions
+        API, behind the Mapbox circuit breaker.
+
+        When Mapbox is down or its circuit is open, the road estimator
+        answers instead (degraded mode) unless MAP_CLIENTS_ESTIMATOR_FALLBACK
+        is off.
+
+        Returns:
+            Tuple of (distance in meters, duration in seconds, estimated).
+
+        Raises:
+            MapClientsUnavailable: If Mapbox could not answer and the estimator
+                                   fallback is off.
+        """
+        breaker = self.breakers["mapbox"]
+        if await sync_to_async(breaker.allow_request, thread_sensitive=False)():
+            try:
+                distance, duration = await aget_route(origin, destination)
+            except Exception as e:
+                logger.error(f"Error from mapbox directions: {str(e)}")
+                await sync_to_async(breaker.record_failure, thread_sensitive=False)()
+            else:
+                await sync_to_async(breaker.record_success, thread_sensitive=False)()
+                return distance, duration, False
+        else:
+            logger.warning("Skipping mapbox directions, its circuit is open")
+
+        return await sync_to_async(self.estimate_route, thread_sensitive=False)(
+            origin, destination
+        )
+
+    def estimate_route(self, origin, destination):
+        if not self.estimator_fallback:
+            raise MapClientsUnavailable("No route is available")
+        logger.warning("Mapbox directions are not available, estimating offline")
+        self.count_estimator_fallback()
+        result = self.estimator.estimator.estimate(
+            origin, [{"email": destination, "location": destination}]
+        )[0]
+        return result["distance_meters"], result["duration_seconds"], True
+
+    def stats(self):
+        return {
+            "clients": {
+                client_name: {
+                    "circuit": self.breakers[client_name].stats(),
+                    **self.provider_stats[client_name].stats(),
+                }
+                for client_name in self.map_client_names
+            },
+            "hedging": {"enabled": self.hedging_enabled, **self.hedge_counts},
+            "routing": self.router.stats(),
+            "matrix_cache": matrix_cache.stats(),
+            "estimator": {
+                "fallback_enabled": self.estimator_fallback,
+                "fallbacks": self.estimator_fallbacks,
+            },
+        }
+
+
+map_clients_manager = MapClientsManager()
+
+
+def get_route_url(origin, destination):
     api = settings.MAPBOX_API_KEY
-    url = f"https://api.mapbox.com/directions/v5/mapbox/driving-traffic/{origin};{destination}?access_token={api}"
+    return f"{settings.MAPBOX_API_URL}/directions/v5/mapbox/driving-traffic/{origin};{destination}?access_token={api}"
 
-    response = requests.get(url)
 
+def parse_route(response):
     if response.status_code == 200:
         data = response.json()
-        distance = data["routes"][0]["distance"]
-        return round((distance / 1000), 2)
+        route = data["routes"][0]
+        return round(route["distance"]), round(route["duration"])
     else:
         raise Exception(
             f"Failed to get response. Status code: {response.status_code}. Error: {response.text}"
         )
+
+
+def get_route(origin, destination):
+    """
+    Get the driving route between two points using the Mapbox Directions API.
+
+    :param origin: The origin in the format 'longitude,latitude'.
+    :param destination: The destination in the format 'longitude,latitude'.
+    :return: Tuple of (distance in meters, duration in seconds).
+    """
+    response = get_session("mapbox").get(get_route_url(origin, destination))
+    return parse_route(response)
+
+
+async def aget_route(origin, destination):
+    """
+    Async version of get_route.
+    """
+    response = await run_on_client_loop(
+        get_async_client("mapbox").get(get_route_url(origin, destination))
+    )
+    return parse_route(response)
@@ -0,0 +1,149 @@
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class MatrixCache:
+    """
+    Two-tier cache of distance matrix results.
+
+    Entries are keyed on (origin, destination) with both coordinates rounded
+    to ``precision`` decimal places, so a rider standing still and matched
+    against the same pickup within ``ttl`` seconds reuses the earlier result
+    instead of hitting the paid API again.
+
+    The first tier is an in-process LRU of at most ``max_entries`` entries.
+    The optional second tier is a Django cache (e.g. Redis) shared by every
+    worker process.
+    """
+
+    def __init__(self, precision, ttl, max_entries, shared_cache=None):
+        self.precision = precision
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.shared_cache = shared_cache
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, origin, destination):
+        """
+        Build the cache key of an (origin, destination) pair given as
+        'longitude,latitude' strings.
+        """
+        points = []
+        for point in (origin, destination):
+            long, lat = map(float, point.split(","))
+            points.append(
+                "{:.{p}f},{:.{p}f}".format(long, lat, p=self.precision)
+            )
+        return "matrix:" + ";".join(points)
+
+    def get_many(self, origin, destinations):
+        """
+        Look up the cached results from origin to each destination.
+
+        Parameters:
+        origin: str containing 'longitude,latitude'.
+        destinations: List of 'longitude,latitude' strings.
+
+        Returns:
+        Dictionary mapping each destination found in the cache to its result.
+        """
+        keys = {destination: self.key(origin, destination) for destination in destinations}
+        found = {}
+        now = time.monotonic()
+
+        with self._lock:
+            for destination, key in keys.items():
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                value, expires_at = entry
+                if expires_at < now:
+                    del self._entries[key]
+                    continue
+                self._entries.move_to_end(key)
+                found[destination] = value
+            self.local_hits += len(found)
+
+        missing = {
+            destination: key for destination, key in keys.items() if destination not in found
+        }
+        if missing and self.shared_cache is not None:
+            try:
+                shared = self.shared_cache.get_many(list(missing.values()))
+            except Exception as e:
+                logger.error(f"Shared matrix cache error: {str(e)}")
+                shared = {}
+            for destination, key in missing.items():
+                if key in shared:
+                    found[destination] = shared[key]
+                    self._store_local(key, shared[key])
+            with self._lock:
+                self.shared_hits += len(shared)
+
+        with self._lock:
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, origin, results):
+        """
+        Cache results from origin.
+
+        Parameters:
+        origin: str containing 'longitude,latitude'.
+        results: Dictionary mapping 'longitude,latitude' destinations to results.
+        """
+        entries = {
+            self.key(origin, destination): value
+            for destination, value in results.items()
+        }
+        for key, value in entries.items():
+            self._store_local(key, value)
+        if entries and self.shared_cache is not None:
+            try:
+                self.shared_cache.set_many(entries, timeout=self.ttl)
+            except Exception as e:
+                logger.error(f"Shared matrix cache error: {str(e)}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.local_hits + self.shared_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "local_hits": self.local_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": (
+                round((self.local_hits + self.shared_hits) / lookups, 3)
+                if lookups
+                else None
+            ),
+        }
+
+    def _store_local(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+matrix_cache = MatrixCache(
+    precision=settings.MATRIX_CACHE_PRECISION,
+    ttl=settings.MATRIX_CACHE_TTL_SECONDS,
+    max_entries=settings.MATRIX_CACHE_MAX_ENTRIES,
+    shared_cache=caches["shared"] if "shared" in settings.CACHES else None,
+)
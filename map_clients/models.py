@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 
 class MapClientManager(models.Model):
@@ -6,3 +7,28 @@ class MapClientManager(models.Model):
 
     def __str__(self):
         return self.current_map_client
+
+
+class OutboxMessage(models.Model):
+    """
+    Supabase row update queued in the same transaction as the change that
+    triggers it, and written by the outbox relay once committed.
+
+    A relay claims messages until ``claimed_until`` while it writes them.
+    Failed messages are retried from ``available_at`` with a growing delay,
+    and set aside as dead (``dead_at``) after too many attempts.
+    """
+
+    table = models.CharField(max_length=50)
+    key_column = models.CharField(max_length=50)
+    key = models.CharField(max_length=255)
+    data = models.JSONField()
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField(default=timezone.now, db_index=True)
+    claimed_until = models.DateTimeField(blank=True, null=True)
+    dead_at = models.DateTimeField(blank=True, null=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.table} {self.key_column}={self.key}"
@@ -0,0 +1,213 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min, Q
+from django.utils import timezone
+import logging
+
+from accounts.utils import supabase
+from map_clients.models import OutboxMessage
+
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(table, key_column, rows):
+    """
+    Queue an update of the row matching each row's key_column value.
+
+    The messages are saved in the current transaction, so they are only
+    relayed if it commits, and the relay is kicked off once it has.
+    """
+    OutboxMessage.objects.bulk_create(
+        [
+            OutboxMessage(
+                table=table,
+                key_column=key_column,
+                key=row[key_column],
+                data={key: value for key, value in row.items() if key != key_column},
+            )
+            for row in rows
+        ]
+    )
+    if rows:
+        from map_clients.tasks import relay_supabase_outbox
+
+        transaction.on_commit(relay_supabase_outbox.delay)
+
+
+def enqueue_customer_notification(
+    customer,
+    message,
+    rider_info=None,
+    ride_status=None,
+    by_pass_rider_info=False,
+):
+    enqueue(
+        supabase.customers_table,
+        "email",
+        [
+            {
+                "email": customer,
+                **supabase.customer_notification_data(
+                    message, rider_info, ride_status, by_pass_rider_info
+                ),
+            }
+        ],
+    )
+
+
+def enqueue_riders_notification(
+    riders,
+    price=None,
+    message=None,
+    request_coordinates=None,
+    order_id=None,
+    order_info=None,
+):
+    rows, _ = supabase.riders_notification_rows(
+        riders, price, message, request_coordinates, order_id, order_info
+    )
+    enqueue(supabase.riders_table, "rider_email", rows)
+
+
+def relay(batch_size=None):
+    """
+    Write the queued messages to Supabase in batches of batch_size, oldest
+    first. Successive updates of the same row are merged and written once.
+
+    Messages are claimed in a short transaction and written outside of it.
+    Written messages are deleted. Failed ones are released with their error
+    to be retried later, while the other messages keep draining.
+
+    Returns:
+    Tuple of the number of messages relayed and of rows written.
+    """
+    if batch_size is None:
+        batch_size = settings.SUPABASE_OUTBOX_BATCH_SIZE
+
+    relayed = written_rows = 0
+    while True:
+        messages, batch_full = claim(batch_size)
+        if messages:
+            written, errors = write(messages)
+            sent = [
+                message.id for message in messages if message_key(message) in written
+            ]
+            OutboxMessage.objects.filter(id__in=sent).delete()
+            release_failed(
+                [message for message in messages if message_key(message) not in written],
+                errors,
+            )
+            relayed += len(sent)
+            written_rows += len(written)
+        if not messages or not batch_full:
+            break
+
+    if relayed:
+        logger.info(f"Relayed {relayed} outbox messages in {written_rows} rows")
+    return relayed, written_rows
+
+
+def message_key(message):
+    return message.table, message.key_column, message.key
+
+
+def claim(batch_size):
+    """
+    Claim the oldest available messages for SUPABASE_OUTBOX_CLAIM_SECONDS.
+
+    Returns:
+    Tuple of the claimed messages and whether a full batch was available.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        candidates = list(
+            OutboxMessage.objects.select_for_update(skip_locked=True)
+            .filter(dead_at__isnull=True, available_at__lte=now)
+            .filter(Q(claimed_until__isnull=True) | Q(claimed_until__lte=now))
+            .order_by("id")[:batch_size]
+        )
+        if not candidates:
+            return [], False
+
+        # A message waits while an older update of the same row is claimed by
+        # another relay or waiting for its retry, so rows are never written
+        # out of order
+        pending = (
+            OutboxMessage.objects.filter(
+                dead_at__isnull=True,
+                key__in={message.key for message in candidates},
+                id__lt=candidates[-1].id,
+            )
+            .exclude(id__in=[message.id for message in candidates])
+            .values("table", "key_column", "key")
+            .annotate(oldest_id=Min("id"))
+        )
+        oldest_pending = {
+            (row["table"], row["key_column"], row["key"]): row["oldest_id"]
+            for row in pending
+        }
+        messages = [
+            message
+            for message in candidates
+            if message.id < oldest_pending.get(message_key(message), float("inf"))
+        ]
+        OutboxMessage.objects.filter(id__in=[message.id for message in messages]).update(
+            claimed_until=now
+            + timedelta(seconds=settings.SUPABASE_OUTBOX_CLAIM_SECONDS)
+        )
+    return messages, len(candidates) == batch_size
+
+
+def write(messages):
+    """
+    Write the merged rows of the messages.
+
+    Returns:
+    Tuple of the set of message keys written, and of the errors of the
+    failed ones by message key.
+    """
+    rows = {}
+    for message in messages:
+        rows.setdefault((message.table, message.key_column), {}).setdefault(
+            message.key, {message.key_column: message.key}
+        ).update(message.data)
+
+    written = set()
+    errors = {}
+    for (table, key_column), table_rows in rows.items():
+        report = supabase.write_rows(table, key_column, list(table_rows.values()))
+        written.update((table, key_column, key) for key in report["written"])
+        errors.update(
+            ((table, key_column, key), str(report["error"])) for key in report["failed"]
+        )
+    return written, errors
+
+
+def release_failed(messages, errors):
+    """
+    Release failed messages for a retry after a growing delay, or set them
+    aside as dead once they reached SUPABASE_OUTBOX_MAX_ATTEMPTS.
+    """
+    now = timezone.now()
+    dead = 0
+    for message in messages:
+        message.attempts += 1
+        message.last_error = errors.get(message_key(message))
+        message.claimed_until = None
+        if message.attempts >= settings.SUPABASE_OUTBOX_MAX_ATTEMPTS:
+            message.dead_at = now
+            dead += 1
+        else:
+            message.available_at = now + timedelta(
+                seconds=min(
+                    settings.SUPABASE_OUTBOX_RETRY_SECONDS * 2 ** (message.attempts - 1),
+                    settings.SUPABASE_OUTBOX_MAX_RETRY_SECONDS,
+                )
+            )
+    OutboxMessage.objects.bulk_update(
+        messages, ["attempts", "last_error", "claimed_until", "available_at", "dead_at"]
+    )
+    if dead:
+        logger.error(f"{dead} outbox messages failed too many times, set aside as dead")
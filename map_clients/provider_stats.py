@@ -0,0 +1,55 @@
+from collections import deque
+import threading
+
+
+class ProviderStats:
+    """
+    Rolling latency and error statistics of one provider over its last
+    ``window`` calls, kept per process.
+    """
+
+    def __init__(self, window=200):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.outcomes)
+
+    def record(self, latency, success):
+        """Record a call which took ``latency`` seconds."""
+        with self._lock:
+            self.outcomes.append(success)
+            if success:
+                self.latencies.append(latency)
+
+    def percentile(self, percent):
+        """Return the ``percent`` latency percentile in seconds, None without data."""
+        with self._lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(round(percent / 100 * (len(latencies) - 1))))
+        return latencies[index]
+
+    @property
+    def error_rate(self):
+        with self._lock:
+            outcomes = list(self.outcomes)
+        if not outcomes:
+            return None
+        return outcomes.count(False) / len(outcomes)
+
+    def stats(self):
+        percentiles = {
+            f"p{percent}_seconds": self.percentile(percent) for percent in (50, 95, 99)
+        }
+        error_rate = self.error_rate
+        return {
+            "calls": len(self),
+            "error_rate": round(error_rate, 3) if error_rate is not None else None,
+            **{
+                key: round(value, 3) if value is not None else None
+                for key, value in percentiles.items()
+            },
+        }
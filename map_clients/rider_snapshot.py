@@ -0,0 +1,153 @@
+from django.conf import settings
+import logging
+import threading
+import time
+
+from map_clients.spatial_index import rider_index
+from map_clients.supabase_query import SupabaseTransactions
+
+
+logger = logging.getLogger(__name__)
+
+RIDER_LOCATION_FIELDS = ["rider_email", "current_lat", "current_long"]
+
+supabase = SupabaseTransactions()
+
+
+def fetch_rider_locations():
+    return supabase.get_supabase_riders(fields=RIDER_LOCATION_FIELDS)
+
+
+class RiderLocationSnapshot:
+    """
+    Process-local copy of the rider locations held in Supabase.
+
+    A daemon thread refreshes the snapshot every ``refresh_interval`` seconds
+    and keeps the rider grid index in sync, so request handlers read rider
+    positions from memory instead of downloading the riders table. Reads fall
+    back to a synchronous refresh (a miss) once the snapshot is older than
+    ``max_staleness`` seconds, e.g. when the refresher is failing.
+    """
+
+    def __init__(self, fetch, refresh_interval, max_staleness, index=rider_index):
+        self.fetch = fetch
+        self.refresh_interval = refresh_interval
+        self.max_staleness = max_staleness
+        self.index = index
+        self.riders = []
+        self.refreshed_at = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+        self._riders_by_email = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def age(self):
+        """Seconds since the last successful refresh, None if never refreshed."""
+        if self.refreshed_at is None:
+            return None
+        return time.monotonic() - self.refreshed_at
+
+    @property
+    def is_fresh(self):
+        age = self.age
+        return age is not None and age <= self.max_staleness
+
+    def start(self):
+        """Start the background refresher once per process."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="rider-snapshot-refresher", daemon=True
+            )
+            self._thread.start()
+
+    def refresh(self):
+        """Fetch every rider location and swap it in as the current snapshot."""
+        riders = self.fetch() or []
+        self.index.sync(riders)
+        self._riders_by_email = {rider["email"]: rider for rider in riders}
+        self.riders = riders
+        self.refreshed_at = time.monotonic()
+        self.refreshes += 1
+        return riders
+
+    def ensure_fresh(self, refresh=True):
+        """
+        Make sure the snapshot, and with it the rider grid index, is within
+        the staleness bound, refreshing synchronously if it is not.
+
+        With ``refresh=False`` a stale snapshot is only reported, leaving the
+        caller to fall back to a narrower query of its own.
+
+        Returns:
+        bool: True if the snapshot can be used.
+        """
+        self.start()
+        if self.is_fresh:
+            self.hits += 1
+            return True
+        if not refresh:
+            self.misses += 1
+            return False
+        with self._lock:
+            # Another thread may have refreshed while we waited for the lock
+            if self.is_fresh:
+                self.hits += 1
+                return True
+            self.misses += 1
+            self.refresh()
+            return True
+
+    def get(self):
+        """
+        Return the list of rider locations.
+
+        Returns:
+        List of dictionaries, each containing 'email' and 'location' keys.
+        """
+        self.ensure_fresh()
+        return self.riders
+
+    def get_riders(self, emails):
+        """
+        Return the locations of the given riders, in the same shape as
+        ``get``. Riders missing from the snapshot are left out.
+        """
+        self.ensure_fresh()
+        riders_by_email = self._riders_by_email
+        return [riders_by_email[email] for email in emails if email in riders_by_email]
+
+    def stats(self):
+        age = self.age
+        return {
+            "riders": len(self.riders),
+            "age_seconds": round(age, 3) if age is not None else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "errors": self.errors,
+        }
+
+    def _run(self):
+        while True:
+            try:
+                with self._lock:
+                    self.refresh()
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Error refreshing rider snapshot: {str(e)}")
+            time.sleep(self.refresh_interval)
+
+
+rider_snapshot = RiderLocationSnapshot(
+    fetch_rider_locations,
+    refresh_interval=settings.RIDER_SNAPSHOT_REFRESH_SECONDS,
+    max_staleness=settings.RIDER_SNAPSHOT_MAX_STALENESS_SECONDS,
+)
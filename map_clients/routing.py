@@ -0,0 +1,102 @@
+from collections import Counter, deque
+from math import ceil
+import threading
+
+
+class ProviderRouter:
+    """
+    Order the map providers for a request by how well they meet the latency
+    SLO and how much the request would cost on each of them.
+
+    Providers whose rolling p95 latency is within ``latency_slo`` seconds and
+    whose error rate is at most ``max_error_rate`` come first, cheapest first.
+    Providers without enough data are assumed to meet the SLO so they keep
+    getting traffic. The rest follow, fastest first.
+
+    The cost of a request is the number of provider requests it needs, given
+    each provider's destinations-per-request limit, times the provider's
+    ``cost_per_request``.
+    """
+
+    def __init__(
+        self,
+        costs,
+        latency_slo,
+        max_error_rate,
+        provider_stats,
+        min_samples=20,
+        history=50,
+    ):
+        self.costs = costs
+        self.latency_slo = latency_slo
+        self.max_error_rate = max_error_rate
+        self.provider_stats = provider_stats
+        self.min_samples = min_samples
+        self.decisions = deque(maxlen=history)
+        self.primary_counts = Counter()
+        self._lock = threading.Lock()
+
+    def estimate(self, client_name, destinations_count, max_destinations):
+        """Return the latency, cost and SLO status of a request on a provider."""
+        stats = self.provider_stats[client_name]
+        requests = max(1, ceil(destinations_count / max_destinations))
+        p95 = stats.percentile(95)
+        error_rate = stats.error_rate
+        if len(stats) < self.min_samples:
+            meets_slo = True
+        else:
+            meets_slo = (p95 is None or p95 <= self.latency_slo) and (
+                error_rate is None or error_rate <= self.max_error_rate
+            )
+        return {
+            "requests": requests,
+            "cost": round(requests * self.costs.get(client_name, 0), 6),
+            "p95_seconds": round(p95, 3) if p95 is not None else None,
+            "error_rate": round(error_rate, 3) if error_rate is not None else None,
+            "meets_slo": meets_slo,
+        }
+
+    def rank(self, client_names, destinations_count, max_destinations):
+        """
+        Order client_names for a request to ``destinations_count`` destinations.
+
+        Parameters:
+        client_names: Candidate providers, in tie-break order.
+        destinations_count: Number of destinations in the request.
+        max_destinations: Dictionary of the destinations-per-request limit of
+                    each provider.
+        """
+        estimates = {
+            client_name: self.estimate(
+                client_name, destinations_count, max_destinations[client_name]
+            )
+            for client_name in client_names
+        }
+
+        def sort_key(client_name):
+            estimate = estimates[client_name]
+            if estimate["meets_slo"]:
+                return (0, estimate["cost"], client_names.index(client_name))
+            p95 = estimate["p95_seconds"]
+            return (1, p95 if p95 is not None else 0, client_names.index(client_name))
+
+        ranked = sorted(client_names, key=sort_key)
+        with self._lock:
+            self.primary_counts[ranked[0]] += 1
+            self.decisions.append(
+                {
+                    "destinations": destinations_count,
+                    "order": ranked,
+                    "estimates": estimates,
+                }
+            )
+        return ranked
+
+    def stats(self):
+        with self._lock:
+            return {
+                "latency_slo_seconds": self.latency_slo,
+                "max_error_rate": self.max_error_rate,
+                "primary_counts": dict(self.primary_counts),
+                "recent_decisions": list(self.decisions),
+            }
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+
+
+def get_shared_cache():
+    """
+    Get the cache shared by every web and celery process, the per-process
+    default cache when none is configured (single process setups only).
+    """
+    return caches["shared"] if "shared" in settings.CACHES else caches["default"]
+
+
+def require_shared_cache():
+    """
+    Get the shared cache, raising ImproperlyConfigured when state written by
+    a celery worker would not reach the web processes.
+    """
+    errors = check_shared_cache(None)
+    if errors:
+        raise ImproperlyConfigured(f"{errors[0].msg} {errors[0].hint}")
+    return get_shared_cache()
+
+
+@checks.register(checks.Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    # With a broker there are celery workers next to the web processes, each
+    # would keep its own circuit breakers, travel profile and zone table
+    if "shared" not in settings.CACHES and settings.CELERY_BROKER_URL:
+        return [
+            checks.Error(
+                "No shared cache is configured.",
+                hint="Set REDIS_CACHE_URL, or use a Redis Celery broker.",
+                id="map_clients.E001",
+            )
+        ]
+    return []
@@ -0,0 +1,177 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from math import floor
+import logging
+import threading
+
+from accounts.utils import DistanceCalculator
+
+
+logger = logging.getLogger(__name__)
+
+KM_PER_DEGREE = 111.32
+
+
+class RiderGridIndex:
+    """
+    Uniform latitude/longitude grid of rider positions.
+
+    Riders are bucketed into square cells of ``cell_size_km`` so a radius
+    query only has to look at the cells overlapping the search circle instead
+    of every rider in the fleet.
+    """
+
+    def __init__(self, cell_size_km):
+        if cell_size_km <= 0:
+            raise ValueError("cell_size_km must be greater than 0")
+        self.cell_size_km = cell_size_km
+        self.cell_size_deg = cell_size_km / KM_PER_DEGREE
+        self._cells = {}
+        self._positions = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, email):
+        return email in self._positions
+
+    def cell_for(self, lat, long):
+        """Return the (row, column) key of the cell containing a point."""
+        return (
+            floor(lat / self.cell_size_deg),
+            floor(long / self.cell_size_deg),
+        )
+
+    def insert(self, email, lat, long):
+        """
+        Add a rider to the index. Inserting a rider that is already indexed
+        behaves like ``move``.
+        """
+        with self._lock:
+            if email in self._positions:
+                self.move(email, lat, long)
+                return
+            cell = self.cell_for(lat, long)
+            self._cells.setdefault(cell, {})[email] = (lat, long)
+            self._positions[email] = (lat, long, cell)
+
+    def move(self, email, lat, long):
+        """
+        Update the position of a rider, only touching the cell buckets when
+        the rider actually crosses a cell boundary.
+        """
+        with self._lock:
+            position = self._positions.get(email)
+            if position is None:
+                self.insert(email, lat, long)
+                return
+            old_cell = position[2]
+            new_cell = self.cell_for(lat, long)
+            if new_cell != old_cell:
+                self._discard_from_cell(email, old_cell)
+            self._cells.setdefault(new_cell, {})[email] = (lat, long)
+            self._positions[email] = (lat, long, new_cell)
+
+    def remove(self, email):
+        """Remove a rider from the index. Unknown riders are ignored."""
+        with self._lock:
+            position = self._positions.pop(email, None)
+            if position is not None:
+                self._discard_from_cell(email, position[2])
+
+    def sync(self, riders_locations):
+        """
+        Bring the index in line with a full list of rider locations.
+
+        Parameters:
+        riders_locations: List of dictionaries, each containing 'email' and 'location' keys.
+                    'location' is a str containing 'longitude,latitude'.
+
+        Riders missing from ``riders_locations`` or without a usable location
+        are removed, every other rider is inserted or moved.
+        """
+        seen = set()
+        with self._lock:
+            for rider in riders_locations:
+                try:
+                    long, lat = map(float, rider["location"].split(","))
+                except (AttributeError, KeyError, TypeError, ValueError):
+                    continue
+                seen.add(rider["email"])
+                self.move(rider["email"], lat, long)
+            for email in list(self._positions):
+                if email not in seen:
+                    self.remove(email)
+
+    def candidate_cells(self, calculator, radius):
+        """
+        Return the keys of every cell overlapping a circle of ``radius`` km
+        around the origin of ``calculator``.
+        """
+        min_lat, min_long, max_lat, max_long = calculator.bounding_box(radius)
+        min_row, min_col = self.cell_for(min_lat, min_long)
+        max_row, max_col = self.cell_for(max_lat, max_long)
+        return [
+            (row, col)
+            for row in range(min_row, max_row + 1)
+            for col in range(min_col, max_col + 1)
+        ]
+
+    def search_expanding(self, origin, target, initial_radius, max_radius, growth=2):
+        """
+        Find the riders closest to the origin, widening the search in rings.
+
+        The search starts at ``initial_radius`` and multiplies the radius by
+        ``growth`` until at least ``target`` riders are found or
+        ``max_radius`` is reached. Each ring only scans the cells it adds, so
+        dense areas stop after the first ring while sparse areas still get
+        matches from further away.
+
+        Parameters:
+        origin: str containing 'longitude,latitude'.
+        target: Number of riders wanted.
+        initial_radius, max_radius: Radii in kilometers.
+        growth: Factor the radius grows by between rings.
+
+        Returns:
+        Tuple of (riders, radius): at most ``target`` dictionaries with 'email'
+        and 'location' keys sorted by distance, and the radius searched.
+
+        Raises:
+        ImproperlyConfigured: If the radius would never grow, i.e. growth is
+                    not greater than 1 or initial_radius not greater than 0.
+        """
+        if growth <= 1 or initial_radius <= 0:
+            raise ImproperlyConfigured(
+                "The search radius must start above 0 and grow by a factor greater than 1"
+            )
+        calculator = DistanceCalculator(origin)
+        radius = min(initial_radius, max_radius)
+        scanned_cells = set()
+        candidates = []
+        while True:
+            with self._lock:
+                for cell in self.candidate_cells(calculator, radius):
+                    if cell in scanned_cells:
+                        continue
+                    scanned_cells.add(cell)
+                    candidates.extend(
+                        {"email": email, "location": "{},{}".format(long, lat)}
+                        for email, (lat, long) in self._cells.get(cell, {}).items()
+                    )
+            nearest = calculator.nearest_destinations(candidates, target, radius)
+            if len(nearest) >= target or radius >= max_radius:
+                return nearest, radius
+            radius = min(radius * growth, max_radius)
+
+    def _discard_from_cell(self, email, cell):
+        bucket = self._cells.get(cell)
+        if bucket is None:
+            return
+        bucket.pop(email, None)
+        if not bucket:
+            del self._cells[cell]
+
+
+rider_index = RiderGridIndex(settings.RIDER_INDEX_CELL_KM)
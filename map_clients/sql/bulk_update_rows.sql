@@ -0,0 +1,42 @@
+-- Update many rows of a table in one request, each row with its own values.
+-- Rows are matched on key_column and keys missing from the table are skipped,
+-- nothing is inserted. Every row of a call must set the same columns.
+-- Returns the keys of the rows updated.
+create or replace function public.bulk_update_rows(
+  target_table text,
+  key_column text,
+  rows jsonb
+) returns setof text
+language plpgsql
+security invoker
+as $$
+declare
+  assignments text;
+begin
+  select string_agg(
+    format(
+      '%1$I = (jsonb_populate_record(null::public.%2$I, item.value)).%1$I',
+      column_name,
+      target_table
+    ),
+    ', '
+  )
+  into assignments
+  from jsonb_object_keys(rows -> 0) as column_name
+  where column_name <> key_column;
+
+  if assignments is null then
+    return;
+  end if;
+
+  return query execute format(
+    'update public.%1$I as target set %2$s '
+    'from jsonb_array_elements($1) as item '
+    'where target.%3$I::text = item.value ->> %3$L '
+    'returning target.%3$I::text',
+    target_table,
+    assignments,
+    key_column
+  ) using rows;
+end;
+$$;
@@ -1,13 +1,99 @@
 from celery import shared_task
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from django.conf import settings
+import json
 import logging
+import os
+import threading
+
+import httpx
+from postgrest import AsyncPostgrestClient
 from supabase import create_client
+from supabase.lib.client_options import ClientOptions
 from typing import List, Dict, Optional
+from http_pool.sessions import get_client_loop, run_on_client_loop
 
 
 logger = logging.getLogger(__name__)
 
+_clients = {}
+_clients_pid = None
+_lock = threading.Lock()
+_async_clients = {}
+_async_clients_loop = None
+
+
+def get_timeout():
+    return httpx.Timeout(
+        settings.SUPABASE_READ_TIMEOUT, connect=settings.HTTP_CONNECT_TIMEOUT
+    )
+
+
+def get_supabase_client(url, key):
+    """
+    Get the Supabase client shared by every caller in this process, creating
+    it on first use so importing this module opens no connection.
+
+    Clients are never shared with forked children (e.g. gunicorn or celery
+    workers), each process opens its own connections.
+    """
+    global _clients_pid
+
+    pid = os.getpid()
+    client = _clients.get((url, key))
+    if client is not None and _clients_pid == pid:
+        return client
+
+    with _lock:
+        if _clients_pid != pid:
+            _clients.clear()
+            _clients_pid = pid
+        if (url, key) not in _clients:
+            client = create_client(
+                url,
+                key,
+                options=ClientOptions(
+                    postgrest_client_timeout=get_timeout(),
+                    auto_refresh_token=False,
+                    persist_session=False,
+                ),
+            )
+            # The REST client is built lazily, build it here rather than
+            # racing on it from several threads
+            client.postgrest
+            _clients[(url, key)] = client
+        return _clients[(url, key)]
+
+
+def get_async_postgrest_client(url, key):
+    """
+    Get the async PostgREST client shared by every caller in this process,
+    creating it on first use. Its requests must be run with
+    run_on_client_loop.
+    """
+    global _async_clients_loop
+
+    loop = get_client_loop()
+    with _lock:
+        # A forked child runs a new client loop, the clients of the old one
+        # cannot be used from it
+        if _async_clients_loop is not loop:
+            _async_clients.clear()
+            _async_clients_loop = loop
+        if (url, key) not in _async_clients:
+            _async_clients[(url, key)] = AsyncPostgrestClient(
+                f"{url}/rest/v1",
+                headers={
+                    "Accept": "application/json",
+                    "Content-Type": "application/json",
+                    "apikey": key,
+                    "Authorization": f"Bearer {key}",
+                },
+                timeout=get_timeout(),
+            )
+        return _async_clients[(url, key)]
+
 
 class SupabaseTransactions:
     # Class attributes for Supabase URL and key
@@ -15,9 +101,18 @@ class SupabaseTransactions:
     supabase_key = settings.SUPABASE_KEY
     riders_table = "riders"
     customers_table = "customers"
+    # Function of map_clients/sql/bulk_update_rows.sql
+    bulk_update_function = "bulk_update_rows"
+    # PostgREST filters a condition may use through its "operator" key
+    condition_operators = {"eq", "neq", "gt", "gte", "lt", "lte"}
+
+    @property
+    def supabase(self):
+        return get_supabase_client(self.supabase_url, self.supabase_key)
 
-    def __init__(self):
-        self.supabase = create_client(self.supabase_url, self.supabase_key)
+    @property
+    def async_postgrest(self):
+        return get_async_postgrest_client(self.supabase_url, self.supabase_key)
 
     def get_supabase_riders(
         self,
@@ -25,28 +120,86 @@ class SupabaseTransactions:
         fields: Optional[List[str]] = None,
     ):
         try:
-            query = self.supabase.table(self.riders_table)
-            if fields is None:
-                fields = ["*"]
-            query = query.select(*fields)
-            if conditions:
-                for condition in conditions:
-                    query = query.eq(condition["column"], condition["value"])
-
-            response = query.execute()
-
-            return [
-                {
-                    "email": rider["rider_email"],
-                    "location": "{},{}".format(
-                        rider["current_long"], rider["current_lat"]
-                    ),
-                }
-                for rider in response.data
-            ]
+            query = self.riders_query(self.supabase, conditions, fields)
+            return self.parse_riders(query.execute().data)
         except Exception as e:
             self.handle_error(e)
 
+    async def aget_supabase_riders(
+        self,
+        conditions: Optional[List[Dict[str, str]]] = None,
+        fields: Optional[List[str]] = None,
+    ):
+        """Async version of get_supabase_riders for async views."""
+        try:
+            query = self.riders_query(self.async_postgrest, conditions, fields)
+            return self.parse_riders((await run_on_client_loop(query.execute())).data)
+        except Exception as e:
+            self.handle_error(e)
+
+    def riders_query(self, client, conditions=None, fields=None):
+        query = client.table(self.riders_table)
+        if fields is None:
+            fields = ["*"]
+        query = query.select(*fields)
+        if conditions:
+            for condition in conditions:
+                operator = condition.get("operator", "eq")
+                if operator not in self.condition_operators:
+                    raise ValueError(f"Unsupported operator: {operator}")
+                query = getattr(query, operator)(condition["column"], condition["value"])
+        return query
+
+    @staticmethod
+    def parse_riders(data):
+        return [
+            {
+                "email": rider["rider_email"],
+                "location": "{},{}".format(rider["current_long"], rider["current_lat"]),
+            }
+            for rider in data
+        ]
+
+    def get_supabase_riders_in_bounding_box(
+        self,
+        min_lat: float,
+        min_long: float,
+        max_lat: float,
+        max_long: float,
+        fields: Optional[List[str]] = None,
+    ):
+        """
+        Fetch only the riders whose current position lies inside a bounding
+        box, so the radius filtering happens on far fewer rows.
+        """
+        return self.get_supabase_riders(
+            conditions=self.bounding_box_conditions(min_lat, min_long, max_lat, max_long),
+            fields=fields,
+        )
+
+    async def aget_supabase_riders_in_bounding_box(
+        self,
+        min_lat: float,
+        min_long: float,
+        max_lat: float,
+        max_long: float,
+        fields: Optional[List[str]] = None,
+    ):
+        """Async version of get_supabase_riders_in_bounding_box for async views."""
+        return await self.aget_supabase_riders(
+            conditions=self.bounding_box_conditions(min_lat, min_long, max_lat, max_long),
+            fields=fields,
+        )
+
+    @staticmethod
+    def bounding_box_conditions(min_lat, min_long, max_lat, max_long):
+        return [
+            {"column": "current_lat", "operator": "gte", "value": min_lat},
+            {"column": "current_lat", "operator": "lte", "value": max_lat},
+            {"column": "current_long", "operator": "gte", "value": min_long},
+            {"column": "current_long", "operator": "lte", "value": max_long},
+        ]
+
     def send_riders_notification(
         self,
         riders,
@@ -56,33 +209,159 @@ class SupabaseTransactions:
         order_id=None,
         order_info=None,
     ):
-        try:
-            for rider in riders:
-                rider_email = rider.get("email")
-                distance = rider.get("distance")
-                duration = rider.get("duration")
-                if all([rider_email, distance is not None, duration is not None]):
-
-                    broadcast_message = f"New Delivery Request: Order is {distance} km and {duration} away with price tag of {price}"
-
-                    self.supabase.table(self.riders_table).update(
-                        {
-                            "broadcast_message": (
-                                broadcast_message if message is None else message
-                            ),
-                            "update_time": datetime.now().strftime("%m/%d/%Y,%H:%M:%S"),
-                            "order_id": order_id,
-                            "price": price,
-                            "request_coordinates": request_coordinates,
-                            "order_info": order_info,
-                        }
-                    ).eq("rider_email", rider_email).execute()
+        """
+        Write the order request to every rider's row in bulk, see write_rows.
+
+        Returns:
+        Dictionary with the emails of the riders 'notified', those whose
+        chunk 'failed' and those skipped as 'invalid'.
+
+        Raises:
+        The last error if no chunk could be written.
+        """
+        rows, invalid = self.riders_notification_rows(
+            riders, price, message, request_coordinates, order_id, order_info
+        )
+        report = self.write_rows(self.riders_table, "rider_email", rows)
+        if report["failed"] and not report["written"]:
+            raise report["error"]
+        return {
+            "notified": report["written"],
+            "failed": report["failed"],
+            "invalid": invalid,
+        }
+
+    @staticmethod
+    def riders_notification_rows(
+        riders,
+        price=None,
+        message=None,
+        request_coordinates=None,
+        order_id=None,
+        order_info=None,
+    ):
+        """
+        Build the riders table row of each rider to notify.
+
+        Returns:
+        Tuple of the rows and the emails of the riders skipped for missing
+        data.
+        """
+        payload = {
+            "update_time": datetime.now().strftime("%m/%d/%Y,%H:%M:%S"),
+            "order_id": order_id,
+            "price": price,
+            "request_coordinates": request_coordinates,
+            "order_info": order_info,
+        }
+        rows = {}
+        invalid = []
+        for rider in riders:
+            rider_email = rider.get("email")
+            distance = rider.get("distance")
+            duration = rider.get("duration")
+            if all([rider_email, distance is not None, duration is not None]):
+                rows[rider_email] = {
+                    "rider_email": rider_email,
+                    "broadcast_message": (
+                        f"New Delivery Request: Order is {distance} km and {duration} away with price tag of {price}"
+                        if message is None
+                        else message
+                    ),
+                    **payload,
+                }
+            else:
+                invalid.append(rider_email)
+        if invalid:
+            logger.warning(
+                f"Invalid rider data: email, distance, or duration missing for {len(invalid)} riders."
+            )
+        return list(rows.values()), invalid
+
+    def write_rows(self, table, key_column, rows):
+        """
+        Update the row matching each row's key_column value in bulk, rows
+        that do not exist are left alone.
+
+        Rows setting the same values are updated together, filtered with
+        ``in``. The other rows, e.g. rider notifications each with their own
+        distance and ETA, are sent with their own values to the
+        bulk_update_function, grouped by the columns they set. Requests hold
+        at most SUPABASE_WRITE_CHUNK_SIZE rows and are sent concurrently, a
+        failed request does not stop the others.
+
+        Returns:
+        Dictionary with the keys 'written' and 'failed', and the last
+        'error' if any.
+        """
+        groups = {}
+        for row in rows:
+            data = {key: value for key, value in row.items() if key != key_column}
+            groups.setdefault(json.dumps(data, sort_keys=True, default=str), []).append(
+                row
+            )
+
+        chunk_size = settings.SUPABASE_WRITE_CHUNK_SIZE
+        requests = []
+        singles = {}
+        for group in groups.values():
+            if len(group) == 1:
+                singles.setdefault(tuple(sorted(group[0])), []).extend(group)
+                continue
+            requests.extend(
+                (self.update_rows_chunk, group[i : i + chunk_size])
+                for i in range(0, len(group), chunk_size)
+            )
+        for group in singles.values():
+            requests.extend(
+                (self.bulk_update_rows_chunk, group[i : i + chunk_size])
+                for i in range(0, len(group), chunk_size)
+            )
+
+        report = {"written": [], "failed": [], "error": None}
+        if not requests:
+            return report
+
+        with ThreadPoolExecutor(
+            max_workers=min(settings.SUPABASE_WRITE_MAX_CONCURRENCY, len(requests))
+        ) as executor:
+            errors = executor.map(
+                lambda request: request[0](table, key_column, request[1]), requests
+            )
+            for (_, chunk), error in zip(requests, errors):
+                keys = [row[key_column] for row in chunk]
+                if error is None:
+                    report["written"].extend(keys)
                 else:
-                    logger.warning(
-                        "Invalid rider data: email, distance, or duration missing."
-                    )
+                    report["error"] = error
+                    report["failed"].extend(keys)
+
+        if report["failed"]:
+            logger.error(
+                f"Supabase API error: {len(report['failed'])} of {len(rows)} {table} "
+                f"rows not written: {str(report['error'])}"
+            )
+        return report
+
+    def update_rows_chunk(self, table, key_column, rows):
+        """Write the same values to every row of the chunk, returning the error if any."""
+        data = {key: value for key, value in rows[0].items() if key != key_column}
+        try:
+            self.supabase.table(table).update(data).in_(
+                key_column, [row[key_column] for row in rows]
+            ).execute()
         except Exception as e:
-            self.handle_error(e)
+            return e
+
+    def bulk_update_rows_chunk(self, table, key_column, rows):
+        """Write each row's own values in a single request, returning the error if any."""
+        try:
+            self.supabase.rpc(
+                self.bulk_update_function,
+                {"target_table": table, "key_column": key_column, "rows": rows},
+            ).execute()
+        except Exception as e:
+            return e
 
     def send_customer_notification(
         self,
@@ -92,19 +371,28 @@ class SupabaseTransactions:
         ride_status=None,
         by_pass_rider_info=False,
     ):
-        rider_data = {"rider_info": rider_info} if not by_pass_rider_info else {}
         try:
             self.supabase.table(self.customers_table).update(
-                {
-                    "notification": message,
-                    "updated_at": datetime.now().strftime("%m/%d/%Y,%H:%M:%S"),
-                    "ride_status": ride_status,
-                    **rider_data,
-                }
+                self.customer_notification_data(
+                    message, rider_info, ride_status, by_pass_rider_info
+                )
             ).eq("email", customer).execute()
         except Exception as e:
             self.handle_error(e)
 
+    @staticmethod
+    def customer_notification_data(
+        message, rider_info=None, ride_status=None, by_pass_rider_info=False
+    ):
+        """Build the customers table update of a notification."""
+        rider_data = {"rider_info": rider_info} if not by_pass_rider_info else {}
+        return {
+            "notification": message,
+            "updated_at": datetime.now().strftime("%m/%d/%Y,%H:%M:%S"),
+            "ride_status": ride_status,
+            **rider_data,
+        }
+
     def create_on_table(
         self,
         table,
@@ -0,0 +1,31 @@
+from celery import shared_task
+from django.conf import settings
+import logging
+
+from map_clients.estimator import road_estimator
+from map_clients.map_clients import map_clients_manager
+from map_clients.outbox import relay
+from map_clients.shared_cache import require_shared_cache
+from map_clients.zone_matrix import zone_matrix
+
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def refresh_travel_profile():
+    # Learned here, the profile is only useful if the web processes see it
+    require_shared_cache()
+    trips = road_estimator.learn()
+    logger.info(f"Travel profile learned from {trips} trips")
+
+
+@shared_task
+def refresh_zone_matrix():
+    zones = zone_matrix.fill(map_clients_manager, settings.ZONE_MATRIX_ORIGINS_PER_RUN)
+    logger.info(f"Zone matrix refreshed from {zones} zones")
+
+
+@shared_task
+def relay_supabase_outbox():
+    relay()
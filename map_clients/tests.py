@@ -0,0 +1,533 @@
+from unittest import mock
+import time
+
+from asgiref.sync import async_to_sync
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, TestCase, override_settings
+import httpx
+
+from fake_providers.server import FakeProviderServer
+from http_pool.rate_limit import TokenBucket
+from map_clients.circuit_breaker import CircuitBreaker
+from map_clients.map_clients import MapClientsManager, aget_route
+from map_clients.matrix_cache import MatrixCache
+from map_clients.models import MapClientManager
+from map_clients.provider_stats import ProviderStats
+from map_clients.rider_snapshot import RiderLocationSnapshot
+from map_clients.routing import ProviderRouter
+from map_clients.spatial_index import RiderGridIndex
+from map_clients.tasks import refresh_travel_profile
+from orders.views import anearest_riders
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        caches["default"].clear()
+        self.now = 1000.0
+        patcher = mock.patch(
+            "map_clients.circuit_breaker.time.time", side_effect=lambda: self.now
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(
+            "test",
+            caches["default"],
+            failure_rate_threshold=0.5,
+            minimum_calls=4,
+            window_seconds=60,
+            open_seconds=30,
+            bucket_seconds=10,
+        )
+
+    def record(self, successes, failures):
+        for _ in range(successes):
+            self.breaker.record_success()
+        for _ in range(failures):
+            self.breaker.record_failure()
+
+    def test_opens_at_the_failure_rate_once_enough_calls_were_made(self):
+        self.record(0, 3)
+        # Below minimum_calls the circuit stays closed
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+        self.record(3, 0)
+        self.record(0, 1)
+        # 4 failures out of 7 calls
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_failures_leave_the_window(self):
+        self.record(0, 3)
+        self.now += 80
+        self.record(0, 1)
+
+        self.assertEqual(self.breaker.window_counts(), (0, 1))
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_lets_one_trial_through(self):
+        self.record(0, 4)
+        self.now += 31
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow_request())
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_trial_success_closes_the_circuit(self):
+        self.record(0, 4)
+        self.now += 31
+        self.breaker.allow_request()
+
+        self.breaker.record_success()
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        # The failures that opened it are forgotten
+        self.assertEqual(self.breaker.window_counts(), (1, 0))
+
+    def test_trial_failure_opens_the_circuit_again(self):
+        self.record(0, 4)
+        self.now += 31
+        self.breaker.allow_request()
+
+        self.breaker.record_failure()
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.now += 31
+        self.assertTrue(self.breaker.allow_request())
+
+
+class SharedCacheTests(SimpleTestCase):
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+        CELERY_BROKER_URL="amqp://broker",
+    )
+    def test_profile_is_not_learned_into_a_process_cache(self):
+        with mock.patch("map_clients.tasks.road_estimator") as estimator:
+            with self.assertRaises(ImproperlyConfigured):
+                refresh_travel_profile()
+        estimator.learn.assert_not_called()
+
+
+class FakeClient:
+    def __init__(self, name, delay=0, error=None):
+        self.name = name
+        self.delay = delay
+        self.error = error
+
+    def get_distances_duration(self, origin, destinations):
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return [
+            {"email": destination["email"], "client": self.name}
+            for destination in destinations
+        ]
+
+
+@override_settings(MAP_CLIENTS_HEDGE_DEFAULT_DELAY_SECONDS=0.05)
+class HedgingTests(SimpleTestCase):
+    def setUp(self):
+        caches["default"].clear()
+        self.manager = MapClientsManager()
+        self.manager.hedging_enabled = True
+
+    def call(self, tomtom, mapbox):
+        self.manager.clients = {"tomtom": tomtom, "mapbox": mapbox}
+        return self.manager.call_hedged(
+            "tomtom",
+            iter(["mapbox"]),
+            "3.3,6.5",
+            [{"email": "rider@test.com", "location": "3.4,6.5"}],
+        )
+
+    def test_fast_primary_is_not_hedged(self):
+        success, results = self.call(FakeClient("tomtom"), FakeClient("mapbox"))
+
+        self.assertTrue(success)
+        self.assertEqual(results[0]["client"], "tomtom")
+        self.assertEqual(self.manager.hedge_counts, {"not_hedged": 1})
+
+    def test_first_successful_answer_wins(self):
+        success, results = self.call(
+            FakeClient("tomtom", delay=0.2), FakeClient("mapbox")
+        )
+        self.assertEqual(results[0]["client"], "mapbox")
+
+        # A failed hedge leaves the slow primary to answer
+        with self.assertLogs("map_clients.map_clients", "ERROR"):
+            success, results = self.call(
+                FakeClient("tomtom", delay=0.2),
+                FakeClient("mapbox", error=ValueError("down")),
+            )
+        self.assertEqual(results[0]["client"], "tomtom")
+
+        self.assertEqual(
+            self.manager.hedge_counts, {"hedged": 2, "hedge_won": 1, "primary_won": 1}
+        )
+
+    def test_hedges_are_limited_by_the_budget(self):
+        self.manager.hedge_budget = TokenBucket(1 / 3600, 1)
+
+        for _ in range(2):
+            success, results = self.call(
+                FakeClient("tomtom", delay=0.2), FakeClient("mapbox")
+            )
+
+        self.assertEqual(results[0]["client"], "tomtom")
+        self.assertEqual(
+            self.manager.hedge_counts,
+            {"hedged": 1, "hedge_won": 1, "budget_exhausted": 1},
+        )
+
+    @override_settings(MAP_CLIENTS_HEDGE_MAX_WORKERS=1)
+    def test_queued_primary_is_not_slow(self):
+        # The worker is busy for longer than the hedge delay
+        self.manager.get_executor().submit(time.sleep, 0.2)
+
+        success, results = self.call(FakeClient("tomtom"), FakeClient("mapbox"))
+
+        self.assertEqual(results[0]["client"], "tomtom")
+        self.assertEqual(self.manager.hedge_counts, {"not_hedged": 1})
+
+    @override_settings(
+        MAP_CLIENTS_HEDGE_MAX_WORKERS=1, HTTP_CONNECT_TIMEOUT=0.05, HTTP_READ_TIMEOUT=0.05
+    )
+    def test_primary_waiting_for_a_worker_fails_after_the_provider_timeout(self):
+        self.manager.get_executor().submit(time.sleep, 0.5)
+        tomtom = FakeClient("tomtom")
+        tomtom.get_distances_duration = mock.Mock(wraps=tomtom.get_distances_duration)
+
+        start = time.monotonic()
+        with self.assertLogs("map_clients.map_clients", "ERROR"):
+            success, results = self.call(tomtom, FakeClient("mapbox"))
+
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertFalse(success)
+        self.assertIsNone(results)
+        self.assertEqual(self.manager.hedge_counts, {"queue_timeout": 1})
+        # The queued call was dropped and did not count against the provider
+        self.manager.get_executor().shutdown(wait=True)
+        tomtom.get_distances_duration.assert_not_called()
+        self.assertTrue(self.manager.breakers["tomtom"].allow_request())
+
+
+class ProviderRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.provider_stats = {"tomtom": ProviderStats(), "mapbox": ProviderStats()}
+        self.router = ProviderRouter(
+            {"tomtom": 0.001, "mapbox": 0.002},
+            latency_slo=1,
+            max_error_rate=0.2,
+            provider_stats=self.provider_stats,
+            min_samples=10,
+        )
+        self.max_destinations = {"tomtom": 1, "mapbox": 25}
+
+    def record(self, client_name, latency, failures=0):
+        for i in range(20):
+            self.provider_stats[client_name].record(latency, i >= failures)
+
+    def rank(self, destinations_count, client_names=("tomtom", "mapbox")):
+        return self.router.rank(
+            list(client_names), destinations_count, self.max_destinations
+        )
+
+    def test_cheapest_provider_meeting_the_slo_comes_first(self):
+        self.assertEqual(self.rank(1), ["tomtom", "mapbox"])
+        # 10 TomTom requests cost more than a single Mapbox one
+        self.assertEqual(self.rank(10), ["mapbox", "tomtom"])
+        self.assertEqual(self.router.stats()["primary_counts"], {"tomtom": 1, "mapbox": 1})
+
+    def test_providers_missing_the_slo_come_last_fastest_first(self):
+        self.record("tomtom", latency=2)
+        self.assertEqual(self.rank(1), ["mapbox", "tomtom"])
+
+        self.record("mapbox", latency=3)
+        self.assertEqual(self.rank(1), ["tomtom", "mapbox"])
+
+    def test_failing_provider_misses_the_slo(self):
+        self.record("tomtom", latency=0.1, failures=5)
+        self.record("mapbox", latency=0.1)
+
+        self.assertEqual(self.rank(1), ["mapbox", "tomtom"])
+
+    def test_ties_keep_the_given_order(self):
+        self.router.costs = {"tomtom": 0.001, "mapbox": 0.001}
+        self.max_destinations = {"tomtom": 25, "mapbox": 25}
+
+        self.assertEqual(self.rank(5), ["tomtom", "mapbox"])
+        self.assertEqual(self.rank(5, ("mapbox", "tomtom")), ["mapbox", "tomtom"])
+
+
+@override_settings(MAP_CLIENTS_COST_PER_REQUEST={"tomtom": 0.001, "mapbox": 0.001})
+class GetClientNamesTests(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        self.manager = MapClientsManager()
+
+    def test_admin_choice_wins_ties(self):
+        MapClientManager.objects.create(current_map_client="mapbox")
+
+        self.assertEqual(self.manager.get_client_names(1), ["mapbox", "tomtom"])
+
+    def test_router_overrides_the_admin_choice(self):
+        MapClientManager.objects.create(current_map_client="mapbox")
+        for _ in range(20):
+            self.manager.provider_stats["mapbox"].record(60, True)
+
+        self.assertEqual(self.manager.get_client_names(1), ["tomtom", "mapbox"])
+
+
+class MatrixCacheTests(SimpleTestCase):
+    origin = "3.300000,6.500000"
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch(
+            "map_clients.matrix_cache.time.monotonic", side_effect=lambda: self.now
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.shared_cache = LocMemCache("matrix-cache-tests", {})
+        self.addCleanup(self.shared_cache.clear)
+
+    def make_cache(self, shared_cache=None, max_entries=10):
+        return MatrixCache(
+            precision=3, ttl=60, max_entries=max_entries, shared_cache=shared_cache
+        )
+
+    def test_keys_are_rounded_to_the_precision(self):
+        cache = self.make_cache()
+        cache.set_many(self.origin, {"3.4001,6.6001": {"duration_seconds": 300}})
+
+        found = cache.get_many("3.30004,6.49996", ["3.40004,6.6004", "3.4006,6.6"])
+
+        self.assertEqual(found, {"3.40004,6.6004": {"duration_seconds": 300}})
+        self.assertEqual(cache.key(self.origin, "3.4,6.6"), "matrix:3.300,6.500;3.400,6.600")
+
+    def test_entries_expire_after_the_ttl(self):
+        cache = self.make_cache()
+        cache.set_many(self.origin, {"3.4,6.6": 1})
+
+        self.now += 59
+        self.assertEqual(cache.get_many(self.origin, ["3.4,6.6"]), {"3.4,6.6": 1})
+        self.now += 2
+        self.assertEqual(cache.get_many(self.origin, ["3.4,6.6"]), {})
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = self.make_cache(max_entries=2)
+        cache.set_many(self.origin, {"3.4,6.6": 1, "3.5,6.6": 2})
+        # Reading an entry makes it the most recently used
+        cache.get_many(self.origin, ["3.4,6.6"])
+        cache.set_many(self.origin, {"3.6,6.6": 3})
+
+        self.assertEqual(
+            cache.get_many(self.origin, ["3.4,6.6", "3.5,6.6", "3.6,6.6"]),
+            {"3.4,6.6": 1, "3.6,6.6": 3},
+        )
+
+    def test_shared_tier_fills_other_processes(self):
+        self.make_cache(self.shared_cache).set_many(self.origin, {"3.4,6.6": 1})
+        cache = self.make_cache(self.shared_cache)
+
+        for _ in range(2):
+            found = cache.get_many(self.origin, ["3.4,6.6", "3.5,6.6"])
+            self.assertEqual(found, {"3.4,6.6": 1})
+
+        # The second lookup was answered by the local tier
+        self.assertEqual(
+            cache.stats(),
+            {
+                "entries": 1,
+                "local_hits": 1,
+                "shared_hits": 1,
+                "misses": 2,
+                "hit_rate": 0.5,
+            },
+        )
+
+    def test_shared_tier_errors_count_as_misses(self):
+        shared_cache = mock.Mock()
+        shared_cache.get_many.side_effect = ConnectionError("Redis is down")
+        shared_cache.set_many.side_effect = ConnectionError("Redis is down")
+        cache = self.make_cache(shared_cache)
+
+        with self.assertLogs("map_clients.matrix_cache", "ERROR"):
+            cache.set_many(self.origin, {"3.4,6.6": 1})
+        with self.assertLogs("map_clients.matrix_cache", "ERROR"):
+            found = cache.get_many(self.origin, ["3.4,6.6", "3.5,6.6"])
+
+        self.assertEqual(found, {"3.4,6.6": 1})
+        self.assertEqual(cache.stats()["local_hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+
+class RiderGridIndexTests(SimpleTestCase):
+    origin = "3.400000,6.500000"
+
+    def setUp(self):
+        self.index = RiderGridIndex(2)
+
+    def search(self, origin=None, radius=1):
+        riders, _ = self.index.search_expanding(
+            origin or self.origin, 10, radius, radius, growth=2
+        )
+        return [rider["email"] for rider in riders]
+
+    def test_moved_rider_leaves_its_old_cell(self):
+        self.index.insert("rider@test.com", 6.5, 3.4)
+        self.index.move("rider@test.com", 6.6, 3.5)
+
+        self.assertEqual(self.search(), [])
+        self.assertEqual(self.search("3.5,6.6"), ["rider@test.com"])
+        self.assertEqual(len(self.index), 1)
+        # The emptied cell is dropped
+        self.assertEqual(len(self.index._cells), 1)
+
+    def test_removed_rider_is_not_found(self):
+        self.index.insert("rider@test.com", 6.5, 3.4)
+        self.index.insert("other@test.com", 6.5, 3.4)
+        self.index.remove("rider@test.com")
+        self.index.remove("unknown@test.com")
+
+        self.assertNotIn("rider@test.com", self.index)
+        self.assertEqual(self.search(), ["other@test.com"])
+
+    def test_sync_removes_riders_missing_from_the_feed(self):
+        self.index.sync(
+            [
+                {"email": "stays@test.com", "location": "3.4,6.5"},
+                {"email": "leaves@test.com", "location": "3.4,6.5"},
+            ]
+        )
+        self.index.sync(
+            [
+                {"email": "stays@test.com", "location": "3.401,6.5"},
+                {"email": "new@test.com", "location": "3.4,6.5"},
+                {"email": "offline@test.com", "location": None},
+            ]
+        )
+
+        self.assertEqual(sorted(self.search()), ["new@test.com", "stays@test.com"])
+        self.assertEqual(len(self.index), 2)
+
+    def test_search_finds_exactly_the_riders_inside_the_radius(self):
+        # 1 km is about 0.009 degrees of latitude, the riders north of the
+        # origin are in the next cell up
+        for email, lat, long in (
+            ("inside_north@test.com", 6.5088, 3.4),
+            ("outside_north@test.com", 6.5092, 3.4),
+            ("inside_west@test.com", 6.5, 3.3912),
+            ("outside_west@test.com", 6.5, 3.3908),
+            ("far@test.com", 6.6, 3.5),
+        ):
+            self.index.insert(email, lat, long)
+
+        self.assertNotEqual(
+            self.index.cell_for(6.5, 3.4), self.index.cell_for(6.5088, 3.4)
+        )
+        self.assertEqual(
+            self.search(), ["inside_west@test.com", "inside_north@test.com"]
+        )
+
+    def test_search_radius_must_grow(self):
+        index = RiderGridIndex(2)
+        index.insert("rider@test.com", 6.50, 3.40)
+
+        for initial_radius, growth in ((1, 1), (1, 0.5), (0, 2)):
+            with self.assertRaises(ImproperlyConfigured):
+                index.search_expanding("3.45,6.55", 2, initial_radius, 50, growth)
+        riders, radius = index.search_expanding("3.45,6.55", 2, 1, 50, 2)
+        self.assertEqual([rider["email"] for rider in riders], ["rider@test.com"])
+        self.assertEqual(radius, 50)
+
+
+class RiderLocationSnapshotTests(SimpleTestCase):
+    def setUp(self):
+        self.feed = [
+            {"email": "rider@test.com", "location": "3.4,6.5"},
+            {"email": "other@test.com", "location": "3.401,6.5"},
+        ]
+        self.fetch = mock.Mock(side_effect=lambda: list(self.feed))
+        self.index = RiderGridIndex(2)
+        self.snapshot = RiderLocationSnapshot(
+            self.fetch, refresh_interval=5, max_staleness=15, index=self.index
+        )
+        self.snapshot.start = lambda: None
+
+    def search(self):
+        riders, _ = self.index.search_expanding("3.4,6.5", 10, 1, 1)
+        return sorted(rider["email"] for rider in riders)
+
+    def test_refresh_replaces_the_index_contents(self):
+        self.snapshot.refresh()
+        self.feed = [{"email": "new@test.com", "location": "3.4,6.5"}]
+        self.snapshot.refresh()
+
+        self.assertEqual(self.search(), ["new@test.com"])
+        self.assertEqual(self.snapshot.get_riders(["rider@test.com", "new@test.com"]), self.feed)
+
+    def test_stale_snapshot_falls_back_to_the_bounding_box_query(self):
+        self.snapshot.refresh()
+        bounding_box_riders = [{"email": "other@test.com", "location": "3.401,6.5"}]
+
+        with mock.patch("orders.views.rider_snapshot", self.snapshot), mock.patch(
+            "orders.views.rider_index", self.index
+        ), mock.patch(
+            "orders.views.supabase.aget_supabase_riders_in_bounding_box",
+            new_callable=mock.AsyncMock,
+            return_value=bounding_box_riders,
+        ) as aget_riders:
+            riders = async_to_sync(anearest_riders)("3.4,6.5", k=5, max_radius=1)
+            self.assertEqual(len(riders), 2)
+            aget_riders.assert_not_awaited()
+
+            self.snapshot.refreshed_at -= 16
+            self.assertFalse(self.snapshot.is_fresh)
+            riders = async_to_sync(anearest_riders)("3.4,6.5", k=5, max_radius=1)
+
+        self.assertEqual(riders, bounding_box_riders)
+        aget_riders.assert_awaited_once()
+        # The stale read is only reported, the request does not refresh it
+        self.assertEqual(self.fetch.call_count, 1)
+        self.assertEqual((self.snapshot.hits, self.snapshot.misses), (1, 1))
+
+    def test_failed_refresh_keeps_the_last_snapshot(self):
+        self.snapshot.refresh()
+        refreshed_at = self.snapshot.refreshed_at
+        self.fetch.side_effect = ConnectionError("Supabase is down")
+
+        class Stop(Exception):
+            pass
+
+        with mock.patch(
+            "map_clients.rider_snapshot.time.sleep", side_effect=Stop
+        ), self.assertLogs("map_clients.rider_snapshot", "ERROR"):
+            with self.assertRaises(Stop):
+                self.snapshot._run()
+
+        self.assertEqual(self.snapshot.errors, 1)
+        self.assertEqual(self.snapshot.refreshed_at, refreshed_at)
+        self.assertEqual(self.snapshot.get_riders(["rider@test.com"]), self.feed[:1])
+        self.assertEqual(self.search(), ["other@test.com", "rider@test.com"])
+
+
+class AsyncClientTests(SimpleTestCase):
+    def test_async_client_is_shared_across_event_loops(self):
+        server = FakeProviderServer(("127.0.0.1", 0)).start()
+        self.addCleanup(server.stop)
+
+        with override_settings(MAPBOX_API_URL=server.service_url("mapbox")), mock.patch.dict(
+            "http_pool.sessions._async_clients", clear=True
+        ), mock.patch(
+            "http_pool.sessions.httpx.AsyncClient", wraps=httpx.AsyncClient
+        ) as async_client:
+            # Each async_to_sync call runs on a new event loop
+            for _ in range(3):
+                distance, duration = async_to_sync(aget_route)("3.4,6.5", "3.41,6.5")
+                self.assertGreater(distance, 0)
+
+        self.assertEqual(async_client.call_count, 1)
+        self.assertEqual(server.request_counts["mapbox"], 3)
@@ -0,0 +1,6 @@
+from django.urls import path
+from . import views
+
+urlpatterns = [
+    path("stats/", views.MapClientsStatsView.as_view(), name="map-clients-stats"),
+]
@@ -1,3 +1,25 @@
-from django.shortcuts import render
+from rest_framework import status
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
-# Create your views here.
+from map_clients.map_clients import map_clients_manager
+from map_clients.rider_snapshot import rider_snapshot
+
+
+class MapClientsStatsView(APIView):
+    """
+    Operator view of the map client layer of this process: routing decisions,
+    latency and error statistics, circuit states, hedging and cache counters.
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(
+            {
+                **map_clients_manager.stats(),
+                "rider_snapshot": rider_snapshot.stats(),
+            },
+            status=status.HTTP_200_OK,
+        )
@@ -0,0 +1,331 @@
+from django.conf import settings
+from django.utils import timezone
+from math import ceil
+import io
+import logging
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from accounts.utils import format_duration
+from map_clients.estimator import KM_PER_DEGREE, road_estimator
+from map_clients.shared_cache import get_shared_cache
+
+
+logger = logging.getLogger(__name__)
+
+DURATION, DISTANCE = 0, 1
+VERSION_CACHE_KEY = "map_clients:zone_matrix:version"
+DATA_CACHE_KEY = "map_clients:zone_matrix:data"
+
+
+class ZoneGrid:
+    """
+    Square zones of ``zone_size_km`` covering the service area, given as
+    (min_long, min_lat, max_long, max_lat). Zones are numbered row by row from
+    the south-west corner.
+    """
+
+    def __init__(self, area, zone_size_km):
+        self.min_long, self.min_lat, self.max_long, self.max_lat = area
+        self.zone_size_deg = zone_size_km / KM_PER_DEGREE
+        self.rows = max(1, ceil((self.max_lat - self.min_lat) / self.zone_size_deg))
+        self.cols = max(1, ceil((self.max_long - self.min_long) / self.zone_size_deg))
+
+    @property
+    def size(self):
+        return self.rows * self.cols
+
+    def zones_for(self, lats, longs):
+        """Return the zone of each point, -1 for points outside the area."""
+        rows = np.floor((np.asarray(lats) - self.min_lat) / self.zone_size_deg).astype(int)
+        cols = np.floor((np.asarray(longs) - self.min_long) / self.zone_size_deg).astype(int)
+        inside = (rows >= 0) & (rows < self.rows) & (cols >= 0) & (cols < self.cols)
+        return np.where(inside, rows * self.cols + cols, -1)
+
+    def center(self, zone):
+        """Return the center of a zone as 'longitude,latitude'."""
+        row, col = divmod(int(zone), self.cols)
+        long = self.min_long + (col + 0.5) * self.zone_size_deg
+        lat = self.min_lat + (row + 0.5) * self.zone_size_deg
+        return f"{long:.6f},{lat:.6f}"
+
+
+class ZoneMatrix:
+    """
+    Zone to zone travel times for each time of day bucket, filled in the
+    background from the map providers so rider ranking and displayed ETAs
+    are table lookups instead of live matrix calls.
+
+    The table is a float32 .npy array of shape (buckets, zones, zones, 2)
+    holding the duration in seconds and distance in meters between zone
+    centers, NaN where unknown. Each process memory-maps it read-only, so
+    every worker on a host shares the same pages. When the file is recreated
+    (e.g. after the zone settings changed) the new one is mapped on the next
+    check.
+
+    The web and celery services do not share a disk, so after each fill the
+    table is published to the shared cache with a new version. Every host
+    keeps a local copy at ``path`` and downloads the table again when the
+    published version changes.
+
+    Pairs in the same zone, and cells not filled yet, are answered by the
+    road estimator.
+    """
+
+    def __init__(
+        self, cache, path, grid, bucket_hours, reload_seconds, estimator=road_estimator
+    ):
+        self.cache = cache
+        self.path = path
+        self.filled_at_path = f"{os.path.splitext(path)[0]}_filled_at.npy"
+        self.version_path = f"{os.path.splitext(path)[0]}_version.txt"
+        self.grid = grid
+        self.bucket_hours = bucket_hours
+        self.shape = (ceil(24 / bucket_hours), grid.size, grid.size, 2)
+        self.reload_seconds = reload_seconds
+        self.estimator = estimator
+        self.table = None
+        self.file_id = None
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def bucket_for(self, hour):
+        return hour // self.bucket_hours
+
+    def get_table(self):
+        """Return the mapped table, or None if there is no usable table."""
+        if (
+            self.checked_at is None
+            or time.monotonic() - self.checked_at > self.reload_seconds
+        ):
+            with self._lock:
+                self.load()
+                self.checked_at = time.monotonic()
+        return self.table
+
+    def load(self):
+        self.sync()
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.table = self.file_id = None
+            return
+        file_id = (stat.st_dev, stat.st_ino)
+        if file_id == self.file_id:
+            return
+        try:
+            table = np.load(self.path, mmap_mode="r")
+        except (OSError, ValueError) as e:
+            logger.error(f"Error loading zone matrix: {str(e)}")
+            return
+        if table.shape != self.shape or table.dtype != np.float32:
+            logger.warning("Zone matrix does not match the zone settings, ignoring it")
+            table = None
+        self.table, self.file_id = table, file_id
+
+    def estimate(self, origin, destinations, hour=None):
+        """
+        Look up the distance and duration from origin to each destination.
+
+        Parameters:
+        origin: str containing 'longitude,latitude'.
+        destinations: List of dictionaries, each containing 'email' and 'location' keys.
+        hour: Hour of the day of the trip, defaults to the current hour.
+
+        Returns:
+        Tuple of the list of dictionaries, each containing 'email',
+        'distance_meters' and 'duration_seconds' in the order of
+        destinations, and whether the table covered every destination.
+        """
+        if hour is None:
+            hour = timezone.localtime().hour
+        results = self.estimator.estimate(origin, destinations, hour)
+        if not destinations:
+            return results, True
+
+        origin_long, origin_lat = map(float, origin.split(","))
+        locations = np.array(
+            [destination["location"].split(",") for destination in destinations],
+            dtype=float,
+        )
+        origin_zone = int(self.grid.zones_for(origin_lat, origin_long))
+        zones = self.grid.zones_for(locations[:, 1], locations[:, 0])
+        same_zone = (zones == origin_zone) & (origin_zone >= 0)
+
+        cells = np.full((len(destinations), 2), np.nan, dtype=np.float32)
+        table = self.get_table()
+        if table is not None and origin_zone >= 0:
+            inside = zones >= 0
+            cells[inside] = table[self.bucket_for(hour), origin_zone, zones[inside]]
+        known = ~np.isnan(cells[:, DURATION]) & ~same_zone
+
+        for i in np.flatnonzero(known):
+            results[i]["duration_seconds"] = int(round(float(cells[i, DURATION])))
+            results[i]["distance_meters"] = int(round(float(cells[i, DISTANCE])))
+        return results, bool(np.all(known | same_zone))
+
+    def rank(self, origin, destinations, k, hour=None):
+        """Keep the k destinations with the shortest ETA from origin."""
+        results, _ = self.estimate(origin, destinations, hour)
+        durations = {result["email"]: result["duration_seconds"] for result in results}
+        return sorted(
+            destinations, key=lambda destination: durations[destination["email"]]
+        )[:k]
+
+    def get_distances_duration(self, origin, destinations):
+        """
+        Get distances and durations in the same format as the map clients,
+        or None when the table does not cover every destination yet.
+        """
+        results, covered = self.estimate(origin, destinations)
+        if not covered:
+            return None
+        return [
+            {
+                **result,
+                "distance": round(result["distance_meters"] / 1000, 2),
+                "duration": format_duration(result["duration_seconds"]),
+                "estimated": True,
+            }
+            for result in results
+        ]
+
+    def fill(self, manager, max_origins, hour=None):
+        """
+        Refresh the rows of the max_origins zones filled the longest ago in
+        the time of day bucket of hour (the current hour by default), with
+        one live matrix lookup from each zone center to every zone center.
+
+        Returns:
+        The number of zones refreshed.
+        """
+        if hour is None:
+            hour = timezone.localtime().hour
+        bucket = self.bucket_for(hour)
+        table, filled_at = self.open_for_writing()
+        destinations = [
+            {"email": str(zone), "location": self.grid.center(zone)}
+            for zone in range(self.grid.size)
+        ]
+
+        refreshed = 0
+        for origin_zone in np.argsort(filled_at[bucket], kind="stable")[:max_origins]:
+            try:
+                results = manager.get_distances_duration(
+                    self.grid.center(origin_zone), destinations
+                )
+            except Exception as e:
+                logger.error(f"Error filling zone matrix: {str(e)}")
+                break
+            # Degraded mode answers from the road estimator, only live
+            # provider results go in the table
+            if not results or any(result.get("estimated") for result in results):
+                break
+            row = np.full((self.grid.size, 2), np.nan, dtype=np.float32)
+            for result in results:
+                row[int(result["email"])] = (
+                    result["duration_seconds"],
+                    result["distance_meters"],
+                )
+            table[bucket, origin_zone] = row
+            filled_at[bucket, origin_zone] = time.time()
+            refreshed += 1
+
+        table.flush()
+        filled_at.flush()
+        if refreshed:
+            self.publish(table, filled_at)
+        return refreshed
+
+    def publish(self, table, filled_at):
+        """Share the table with the other hosts under a new version."""
+        arrays = io.BytesIO()
+        np.savez_compressed(arrays, table=table, filled_at=filled_at)
+        version = uuid.uuid4().hex
+        self.cache.set(
+            DATA_CACHE_KEY, {"version": version, "arrays": arrays.getvalue()}, timeout=None
+        )
+        self.cache.set(VERSION_CACHE_KEY, version, timeout=None)
+        self.write_file(self.version_path, version.encode())
+
+    def sync(self):
+        """Replace the local copy when a newer table has been published."""
+        try:
+            version = self.cache.get(VERSION_CACHE_KEY)
+            if version is None or version == self.local_version():
+                return
+            data = self.cache.get(DATA_CACHE_KEY)
+            if data is None:
+                return
+            arrays = np.load(io.BytesIO(data["arrays"]))
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            for path, name in ((self.filled_at_path, "filled_at"), (self.path, "table")):
+                array = io.BytesIO()
+                np.save(array, arrays[name])
+                self.write_file(path, array.getvalue())
+            self.write_file(self.version_path, data["version"].encode())
+        except Exception as e:
+            logger.error(f"Error syncing zone matrix: {str(e)}")
+
+    def local_version(self):
+        try:
+            with open(self.version_path) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def write_file(path, content):
+        # Written aside and moved in place, so readers never see a partial
+        # file, per process as every worker on the host may sync at once
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def open_for_writing(self):
+        self.sync()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        table, created = self.open_array(self.path, self.shape, np.float32, np.nan)
+        filled_at, _ = self.open_array(
+            self.filled_at_path, self.shape[:2], np.float64, 0, recreate=created
+        )
+        return table, filled_at
+
+    @staticmethod
+    def open_array(path, shape, dtype, fill_value, recreate=False):
+        """
+        Map the array at path for writing, creating it when missing or when
+        its shape or type no longer match.
+
+        Returns:
+        Tuple of the array and whether it was created.
+        """
+        if not recreate:
+            try:
+                array = np.load(path, mmap_mode="r+")
+                if array.shape == shape and array.dtype == dtype:
+                    return array, False
+            except (FileNotFoundError, ValueError):
+                pass
+        # Built aside and moved in place, so readers never map a partial file
+        tmp_path = f"{path}.tmp"
+        array = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=shape)
+        array[:] = fill_value
+        array.flush()
+        del array
+        os.replace(tmp_path, path)
+        return np.load(path, mmap_mode="r+"), True
+
+
+zone_matrix = ZoneMatrix(
+    get_shared_cache(),
+    settings.ZONE_MATRIX_PATH,
+    ZoneGrid(settings.ZONE_MATRIX_AREA, settings.ZONE_MATRIX_ZONE_KM),
+    bucket_hours=settings.ZONE_MATRIX_BUCKET_HOURS,
+    reload_seconds=settings.ZONE_MATRIX_RELOAD_SECONDS,
+)
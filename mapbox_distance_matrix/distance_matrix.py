@@ -1,10 +1,45 @@
-import requests
-import time
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+
+from accounts.utils import format_duration
+from http_pool.sessions import get_session
+
+
+# Most coordinates, origins and destinations together, a Matrix API request
+# may hold for each profile
+PROFILE_MAX_COORDINATES = {"driving-traffic": 10}
+DEFAULT_MAX_COORDINATES = 25
 
 
 class MapboxDistanceDuration:
-    def __init__(self, api_key):
+    def __init__(
+        self,
+        api_key,
+        rate_limiter=None,
+        max_concurrency=1,
+        profile="driving-traffic",
+        api_url="https://api.mapbox.com",
+    ):
+        """
+        Args:
+        - api_key (str): Mapbox access token.
+        - rate_limiter (TokenBucket, optional): Bucket holding the Matrix API
+                                    request quota, one token is taken per request.
+        - max_concurrency (int): Maximum number of blocks requested at once.
+        - profile (str): Mapbox routing profile.
+        - api_url (str): Base URL of the Mapbox API.
+        """
         self.api_key = api_key
+        self.base_url = f"{api_url}/directions-matrix/v1/mapbox"
+        self.rate_limiter = rate_limiter
+        self.max_concurrency = max_concurrency
+        self.profile = profile
+        self.max_coordinates = PROFILE_MAX_COORDINATES.get(
+            profile, DEFAULT_MAX_COORDINATES
+        )
+        # Destinations a request holds alongside a single origin
+        self.batch_size = self.max_coordinates - 1
+        self.session = get_session("mapbox")
 
     def get_distance_duration(self, origin, riders_locations):
         """
@@ -16,109 +51,142 @@ class MapboxDistanceDuration:
                                     'location' is a string in the format 'longitude,latitude'.
 
         Returns:
-        - List of dictionaries: List of dictionaries, each containing 'email', 'distance' (in meters), and
-                                'duration' (in minutes) for each location.
+        - List of dictionaries: List of dictionaries, each containing 'email', 'distance' (in kilometers),
+                                'duration' (formatted), 'distance_meters' and 'duration_seconds'
+                                for each location Mapbox found a route to.
         """
         if len(riders_locations) == 0:
             return []
+        return self.get_matrix([origin], riders_locations)[0]
 
-        # Maximum 10 riders_locations per request
-        batch_size = 9
-        num_batches = (len(riders_locations) + batch_size - 1) // batch_size
+    def get_matrix(self, origins, riders_locations):
+        """
+        Get distance and duration from each of several origins to each rider,
+        e.g. when several orders are dispatched at once.
 
-        results = []
+        The origins x riders matrix is split in blocks filling the coordinate
+        limit of a request, so every request carries as many cells as
+        possible. Blocks are requested concurrently, up to max_concurrency at
+        a time and within the rate limiter quota.
 
-        # Define the Mapbox Matrix API endpoint URL
-        url_base = f"https://api.mapbox.com/directions-matrix/v1/mapbox/driving-traffic/{origin};"
-
-        if num_batches == 1 and len(riders_locations) == 1:
-            # Directly make a request without batching
-            rider_location = riders_locations[0]
-            destinations_str = rider_location["location"]
-            url = f"{url_base}{destinations_str}?access_token={self.api_key}"
-            response = requests.get(url)
-
-            if response.status_code == 200:
-                data = response.json()
-                distance = data["destinations"][1]["distance"]
-                duration = data["durations"][1][0]
-                formatted_duration = self.format_duration(duration)
-                distance = round(distance / 1000, 2)
-                results.append(
-                    {
-                        "email": rider_location["email"],
-                        "distance": distance,
-                        "duration": formatted_duration,
-                    }
-                )
-            else:
-                raise Exception(
-                    f"Failed to get response. Status code: {response.status_code}. Error: {response.text}"
-                )
-        else:
-            for i in range(num_batches):
-                start_idx = i * batch_size
-                end_idx = min((i + 1) * batch_size, len(riders_locations))
-                batch_destinations = riders_locations[start_idx:end_idx]
-
-                # Convert riders_locations list to a semicolon-separated string
-                destinations_str = ";".join(
-                    [
-                        rider_location["location"]
-                        for rider_location in batch_destinations
-                    ]
-                )
+        Args:
+        - origins (list of str): Origin coordinates in the format 'longitude,latitude'.
+        - riders_locations (list of dict): List of dictionaries, each containing 'email' and 'location' keys.
 
-                # Make a GET request to the API
-                url = f"{url_base}{destinations_str}?access_token={self.api_key}"
-                response = requests.get(url)
-
-                # Check if the request was successful (status code 200)
-                if response.status_code == 200:
-                    data = response.json()
-
-                    # Extract distances and durations from the response
-                    for j, destination in enumerate(data["destinations"][1:], start=1):
-                        distance = destination["distance"]
-                        duration = data["durations"][j][0]
-                        formatted_duration = self.format_duration(duration)
-                        distance = round(distance / 1000, 2)
-
-                        results.append(
-                            {
-                                "email": batch_destinations[j - 1]["email"],
-                                "distance": distance,
-                                "duration": formatted_duration,
-                            }
-                        )
-
-                else:
-                    raise Exception(
-                        f"Failed to get response. Status code: {response.status_code}. Error: {response.text}"
-                    )
-
-                # Wait for a short interval to avoid hitting rate limits
-                if i < num_batches - 1:
-                    time.sleep(6)
+        Returns:
+        - List with, for each origin, the results of get_distance_duration in
+          the order of riders_locations.
+        """
+        if len(riders_locations) == 0:
+            return [[] for _ in origins]
+        if len(origins) == 0:
+            return []
 
+        origins_per_block, riders_per_block = self.plan_blocks(
+            len(origins), len(riders_locations)
+        )
+        blocks = [
+            (i, j)
+            for i in range(0, len(origins), origins_per_block)
+            for j in range(0, len(riders_locations), riders_per_block)
+        ]
+
+        def get_block(block):
+            i, j = block
+            return self.get_block_distance_duration(
+                origins[i : i + origins_per_block],
+                riders_locations[j : j + riders_per_block],
+            )
+
+        if len(blocks) == 1:
+            block_results = [get_block(blocks[0])]
+        else:
+            workers = min(self.max_concurrency, len(blocks))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                block_results = list(executor.map(get_block, blocks))
+
+        results = [[] for _ in origins]
+        for (i, _), rows in zip(blocks, block_results):
+            for k, row in enumerate(rows):
+                results[i + k].extend(row)
         return results
 
-    @staticmethod
-    def format_duration(duration: int) -> str:
+    def plan_blocks(self, origins_count, destinations_count):
         """
-        Format a duration in seconds into a human-readable format.
+        Choose how many origins and destinations go in each request so that
+        the whole matrix takes as few requests as possible.
 
-        Parameters:
-        - duration (int): The duration in seconds.
+        Returns:
+        - Tuple of (origins per block, destinations per block).
+        """
+        best = None
+        for origins_per_block in range(
+            1, min(origins_count, self.max_coordinates - 1) + 1
+        ):
+            destinations_per_block = min(
+                self.max_coordinates - origins_per_block, destinations_count
+            )
+            requests = ceil(origins_count / origins_per_block) * ceil(
+                destinations_count / destinations_per_block
+            )
+            if best is None or requests < best[0]:
+                best = (requests, origins_per_block, destinations_per_block)
+        return best[1], best[2]
+
+    def get_block_distance_duration(self, origins, batch_destinations):
+        """
+        Get distance and duration between each origin and each destination of
+        a single block fitting in one request.
 
         Returns:
-        - str: The formatted duration string.
+        - List with, for each origin, a list of result dictionaries.
         """
-        duration_minutes, duration_seconds = divmod(duration, 60)
+        coordinates = ";".join(
+            origins + [rider_location["location"] for rider_location in batch_destinations]
+        )
+        params = {
+            "sources": ";".join(str(i) for i in range(len(origins))),
+            "destinations": ";".join(
+                str(i)
+                for i in range(len(origins), len(origins) + len(batch_destinations))
+            ),
+            "annotations": "distance,duration",
+            "access_token": self.api_key,
+        }
+
+        # Only wait when the request quota is actually exhausted
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        response = self.session.get(
+            f"{self.base_url}/{self.profile}/{coordinates}", params=params
+        )
+
+        # Check if the request was successful (status code 200)
+        if response.status_code != 200:
+            raise Exception(
+                f"Failed to get response. Status code: {response.status_code}. Error: {response.text}"
+            )
+
+        data = response.json()
+        results = []
 
-        if duration <= 60:
-            return f"{duration} secs"
-        elif duration_seconds == 0:
-            return f"{duration_minutes} minutes"
-        else:
-            return f"{duration_minutes} mins {duration_seconds} secs"
+        # Row i holds the distances and durations from origin i to each destination
+        for distances, durations in zip(data["distances"], data["durations"]):
+            row = []
+            for rider_location, distance, duration in zip(
+                batch_destinations, distances, durations
+            ):
+                # Mapbox returns null when no route was found
+                if distance is None or duration is None:
+                    continue
+                row.append(
+                    {
+                        "email": rider_location["email"],
+                        "distance": round(distance / 1000, 2),
+                        "duration": format_duration(round(duration)),
+                        "distance_meters": round(distance),
+                        "duration_seconds": round(duration),
+                    }
+                )
+            results.append(row)
+        return results
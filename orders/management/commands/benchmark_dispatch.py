@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import random
+import time
+from collections import defaultdict
+
+import httpx
+import numpy as np
+from django.core.management.base import BaseCommand
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from accounts.models import Customer, CustomUser, Rider
+from wallet.models import Wallet
+
+
+KM_PER_DEGREE = 111.32
+STEPS = ["create", "get-rider", "accept", "assign", "deliver"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive create -> get-rider -> accept -> assign -> deliver against a "
+        "running server at the given concurrency and report throughput and "
+        "p50/p95/p99 latency per endpoint. Run the server against the fake "
+        "providers (run_fake_providers) with CELERY_TASK_ALWAYS_EAGER=True, "
+        "the command seeds the fake Supabase riders table itself."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+        parser.add_argument("--fake-url", default="http://127.0.0.1:8900")
+        parser.add_argument("--flows", type=int, default=100, help="Orders to dispatch.")
+        parser.add_argument("--concurrency", type=int, default=10)
+        parser.add_argument("--riders", type=int, default=50)
+        parser.add_argument(
+            "--center", default="3.3792,6.5244", help="'longitude,latitude' of the area."
+        )
+        parser.add_argument(
+            "--spread-km", type=float, default=3, help="Radius of the area in km."
+        )
+        parser.add_argument("--price", default="1500")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        # Keep the per-request httpx log lines out of the report
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        self.rng = random.Random(options["seed"])
+        self.center_long, self.center_lat = map(float, options["center"].split(","))
+        self.spread = options["spread_km"] / KM_PER_DEGREE
+
+        customers = [
+            self.get_customer(f"bench-customer{i}@example.com")
+            for i in range(options["concurrency"])
+        ]
+        riders = [
+            self.get_rider(f"bench-rider{i}@example.com", i)
+            for i in range(options["riders"])
+        ]
+        self.seed_supabase(options["fake_url"], customers, riders)
+
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        start = time.perf_counter()
+        completed = asyncio.run(self.run(options, customers, riders))
+        elapsed = time.perf_counter() - start
+        self.report(completed, options["flows"], elapsed)
+
+    def get_user(self, email):
+        user, created = CustomUser.objects.get_or_create(
+            email=email, defaults={"first_name": "Bench", "last_name": "User"}
+        )
+        if created:
+            user.set_unusable_password()
+            user.save()
+        return user
+
+    def get_customer(self, email):
+        user = self.get_user(email)
+        Customer.objects.get_or_create(user=user)
+        wallet, _ = Wallet.objects.get_or_create(
+            user=user, defaults={"code": f"BENCH-{user.id}"}
+        )
+        # Every assignment debits the wallet, top it up for each run
+        wallet.balance = 10**9
+        wallet.save()
+        return {"email": email, "token": self.token(user)}
+
+    def get_rider(self, email, i):
+        user = self.get_user(email)
+        Rider.objects.get_or_create(
+            user=user,
+            defaults={
+                "vehicle_registration_number": f"BENCH{i}",
+                "min_capacity": 1,
+                "max_capacity": 100,
+                "charge_per_km": 100,
+            },
+        )
+        return {"email": email, "token": self.token(user), "location": self.random_point()}
+
+    @staticmethod
+    def token(user):
+        return str(RefreshToken.for_user(user).access_token)
+
+    def random_point(self):
+        return (
+            round(self.center_long + self.rng.uniform(-self.spread, self.spread), 6),
+            round(self.center_lat + self.rng.uniform(-self.spread, self.spread), 6),
+        )
+
+    def seed_supabase(self, fake_url, customers, riders):
+        headers = {"Prefer": "resolution=merge-duplicates"}
+        with httpx.Client(base_url=f"{fake_url}/supabase/rest/v1") as client:
+            client.post(
+                "/riders",
+                params={"on_conflict": "rider_email"},
+                headers=headers,
+                json=[
+                    {
+                        "rider_email": rider["email"],
+                        "current_long": rider["location"][0],
+                        "current_lat": rider["location"][1],
+                    }
+                    for rider in riders
+                ],
+            ).raise_for_status()
+            client.post(
+                "/customers",
+                params={"on_conflict": "email"},
+                headers=headers,
+                json=[{"email": customer["email"]} for customer in customers],
+            ).raise_for_status()
+
+    async def run(self, options, customers, riders):
+        flows = asyncio.Queue()
+        for flow in range(options["flows"]):
+            flows.put_nowait(flow)
+        limits = httpx.Limits(max_connections=options["concurrency"] * 2)
+        async with httpx.AsyncClient(
+            base_url=options["base_url"], limits=limits, timeout=60
+        ) as client:
+            # One customer per worker so concurrent flows never share a wallet
+            completed = await asyncio.gather(
+                *[
+                    self.worker(client, flows, customer, riders, options["price"])
+                    for customer in customers
+                ]
+            )
+        return sum(completed)
+
+    async def worker(self, client, flows, customer, riders, price):
+        completed = 0
+        while not flows.empty():
+            flow = flows.get_nowait()
+            rider = riders[flow % len(riders)]
+            if await self.dispatch(client, customer, rider, price):
+                completed += 1
+        return completed
+
+    async def dispatch(self, client, customer, rider, price):
+        """Run one order through every step, stopping at the first failure."""
+        pickup_long, pickup_lat = self.random_point()
+        recipient_long, recipient_lat = self.random_point()
+        order = await self.call(
+            client,
+            "create",
+            customer,
+            "POST",
+            "/order/create/",
+            json={
+                "pickup_address": "Benchmark pickup",
+                "pickup_lat": pickup_lat,
+                "pickup_long": pickup_long,
+                "recipient_name": "Benchmark recipient",
+                "recipient_address": "Benchmark recipient address",
+                "recipient_lat": recipient_lat,
+                "recipient_long": recipient_long,
+                "recipient_phone_number": "08000000000",
+                "weight": 2,
+                "value": 1000,
+            },
+        )
+        if order is None:
+            return False
+        order_id = order["id"]
+        found = await self.call(
+            client,
+            "get-rider",
+            customer,
+            "GET",
+            "/order/get-rider/",
+            params={"price": price, "order_id": order_id},
+        )
+        if found is None:
+            return False
+        accepted = await self.call(
+            client,
+            "accept",
+            rider,
+            "POST",
+            "/order/accept/",
+            json={"order_id": order_id, "price": price, "accept": True},
+        )
+        if accepted is None:
+            return False
+        assigned = await self.call(
+            client,
+            "assign",
+            customer,
+            "POST",
+            "/order/assign/",
+            json={"order_id": order_id, "rider_email": rider["email"], "price": price},
+        )
+        if assigned is None:
+            return False
+        delivered = await self.call(
+            client,
+            "deliver",
+            rider,
+            "POST",
+            "/order/update-order-status/",
+            json={
+                "order_id": order_id,
+                "status": "Delivered",
+                "order_code": assigned["code"],
+            },
+        )
+        return delivered is not None
+
+    async def call(self, client, step, user, method, url, **kwargs):
+        headers = {"Authorization": f"Bearer {user['token']}"}
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, headers=headers, **kwargs)
+        except httpx.HTTPError:
+            self.errors[step] += 1
+            return None
+        self.latencies[step].append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            self.errors[step] += 1
+            return None
+        return response.json()
+
+    def report(self, completed, flows, elapsed):
+        requests = sum(len(latencies) for latencies in self.latencies.values())
+        self.stdout.write(
+            f"{completed}/{flows} orders delivered in {elapsed:.2f}s: "
+            f"{completed / elapsed:.2f} orders/s, {requests / elapsed:.2f} requests/s"
+        )
+        self.stdout.write(
+            f"{'endpoint':>10} {'requests':>9} {'errors':>7} "
+            f"{'p50 (ms)':>10} {'p95 (ms)':>10} {'p99 (ms)':>10}"
+        )
+        for step in STEPS:
+            latencies = self.latencies[step]
+            if latencies:
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+            else:
+                p50 = p95 = p99 = float("nan")
+            self.stdout.write(
+                f"{step:>10} {len(latencies):>9} {self.errors[step]:>7} "
+                f"{p50:>10.1f} {p95:>10.1f} {p99:>10.1f}"
+            )
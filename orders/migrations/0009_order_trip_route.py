@@ -0,0 +1,28 @@
+# Generated by Django 4.1.6 on 2026-10-18 08:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0008_alter_order_duration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='trip_distance_meters',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='trip_duration_seconds',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='trip_route_key',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+    ]
@@ -0,0 +1,92 @@
+# Generated by Django 4.1.6 on 2026-10-18 08:55
+
+import re
+
+from django.db import migrations, models
+
+
+DURATION_UNITS = {"h": 3600, "m": 60, "s": 1}
+
+
+def parse_duration(duration):
+    """Parse display durations such as '12 mins 5 secs' or '5 minutes'."""
+    parts = re.findall(r"(\d+(?:\.\d+)?)\s*([hms])", duration or "", re.IGNORECASE)
+    if not parts:
+        return None
+    return round(
+        sum(float(value) * DURATION_UNITS[unit.lower()] for value, unit in parts)
+    )
+
+
+def parse_distance(distance):
+    """Parse a distance in kilometers into meters."""
+    try:
+        return round(float(distance) * 1000)
+    except (TypeError, ValueError):
+        return None
+
+
+def format_duration(duration):
+    duration_minutes, duration_seconds = divmod(duration, 60)
+    if duration <= 60:
+        return f"{duration} secs"
+    elif duration_seconds == 0:
+        return f"{duration_minutes} minutes"
+    else:
+        return f"{duration_minutes} mins {duration_seconds} secs"
+
+
+def strings_to_numbers(apps, schema_editor):
+    Order = apps.get_model("orders", "Order")
+    orders = Order.objects.exclude(distance__isnull=True, duration__isnull=True)
+    for order in orders.iterator():
+        order.distance_meters = parse_distance(order.distance)
+        order.duration_seconds = parse_duration(order.duration)
+        order.save(update_fields=["distance_meters", "duration_seconds"])
+
+
+def numbers_to_strings(apps, schema_editor):
+    Order = apps.get_model("orders", "Order")
+    orders = Order.objects.exclude(
+        distance_meters__isnull=True, duration_seconds__isnull=True
+    )
+    for order in orders.iterator():
+        if order.distance_meters is not None:
+            order.distance = str(round(order.distance_meters / 1000, 2))
+        if order.duration_seconds is not None:
+            order.duration = format_duration(order.duration_seconds)
+        order.save(update_fields=["distance", "duration"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0009_order_trip_route'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='distance_meters',
+            field=models.PositiveIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='duration_seconds',
+            field=models.PositiveIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(strings_to_numbers, numbers_to_strings),
+        migrations.RemoveField(
+            model_name='order',
+            name='distance',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='duration',
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='trip_distance_meters',
+            field=models.PositiveIntegerField(blank=True, db_index=True, null=True),
+        ),
+    ]
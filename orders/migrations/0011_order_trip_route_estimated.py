@@ -0,0 +1,18 @@
+# Generated by Django 4.1.6 on 2026-10-18 09:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0010_order_numeric_distance_duration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='trip_route_estimated',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from accounts.models import Customer, Rider
+from accounts.utils import format_duration
 from django.core.validators import MinValueValidator
 from django.utils.translation import gettext_lazy as _
 
@@ -41,12 +42,73 @@ class Order(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    duration = models.CharField(null=True, blank=True, max_length=30)
-    distance = models.CharField(max_length=10, blank=True, null=True)
+    # Rider to pickup distance and ETA when the order was assigned
+    distance_meters = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+    duration_seconds = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+    # Pickup to recipient route, computed once and reused for pricing
+    trip_distance_meters = models.PositiveIntegerField(
+        null=True, blank=True, db_index=True
+    )
+    trip_duration_seconds = models.PositiveIntegerField(null=True, blank=True)
+    trip_route_key = models.CharField(max_length=100, null=True, blank=True)
+    # Set when the road estimator answered while Mapbox was down
+    trip_route_estimated = models.BooleanField(default=False)
 
     def __str__(self):
         return f"Order {self.pk} - {self.status}"
 
+    @property
+    def distance(self):
+        """Rider to pickup distance in kilometers, for display."""
+        if self.distance_meters is None:
+            return None
+        return round(self.distance_meters / 1000, 2)
+
+    @property
+    def duration(self):
+        """Rider to pickup ETA, for display."""
+        if self.duration_seconds is None:
+            return None
+        return format_duration(self.duration_seconds)
+
+    @property
+    def pickup_location(self):
+        return f"{self.pickup_long},{self.pickup_lat}"
+
+    @property
+    def recipient_location(self):
+        return f"{self.recipient_long},{self.recipient_lat}"
+
+    @property
+    def route_key(self):
+        """The coordinates the trip route depends on."""
+        return f"{self.pickup_location};{self.recipient_location}"
+
+    @property
+    def trip_route_is_stale(self):
+        """
+        True if the trip route was never computed, was only estimated, or the
+        pickup or recipient coordinates changed since it was.
+        """
+        return (
+            self.trip_distance_meters is None
+            or self.trip_route_estimated
+            or self.trip_route_key != self.route_key
+        )
+
+    def set_trip_route(self, distance, duration, estimated=False):
+        """Store the trip route, distance in meters and duration in seconds."""
+        self.trip_distance_meters = distance
+        self.trip_duration_seconds = duration
+        self.trip_route_key = self.route_key
+        self.trip_route_estimated = estimated
+
+    @property
+    def trip_distance_km(self):
+        if self.trip_distance_meters is None:
+            return None
+        return round(self.trip_distance_meters / 1000, 2)
+
 
 class DeclinedOrder(models.Model):
     order = models.OneToOneField(Order, on_delete=models.CASCADE)
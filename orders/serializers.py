@@ -64,6 +64,8 @@ class OrderDetailSerializer(serializers.ModelSerializer):
             "rider",
             "distance",
             "duration",
+            "distance_meters",
+            "duration_seconds",
         ]
 
 
@@ -96,4 +98,6 @@ class OrderDetailUserSerializer(serializers.ModelSerializer):
             "order_completion_code",
             "distance",
             "duration",
+            "distance_meters",
+            "duration_seconds",
         ]
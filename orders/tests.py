@@ -1,3 +1,674 @@
-from django.test import TestCase
+from unittest import mock
+import os
+import tempfile
+import time
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.cache import caches
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+import numpy as np
+
+from accounts.models import Customer, CustomUser, Rider
+from accounts.utils import DistanceCalculator
+from fake_providers.server import FakeProviderServer, ServiceBehaviour
+from mapbox_distance_matrix.distance_matrix import MapboxDistanceDuration
+from map_clients.estimator import RoadEstimator
+from map_clients import outbox
+from map_clients.models import OutboxMessage
+from map_clients.map_clients import Estimator, MapClientsManager
+from map_clients.supabase_query import SupabaseTransactions
+from map_clients.zone_matrix import ZoneGrid, ZoneMatrix
+from map_clients.rider_snapshot import RiderLocationSnapshot
+from map_clients.spatial_index import RiderGridIndex
+from tom_tom_map_api.distance_matrix import TomTomDistanceMatrix
+from .models import Order
+from .views import GetAvailableRidersView, aensure_trip_route
+
+
+PICKUP_LAT = 6.5244
+PICKUP_LONG = 3.3792
+
+
+def create_user(email):
+    return CustomUser.objects.create_user(
+        email=email, first_name="Test", last_name="User", password="Passw0rd!"
+    )
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class GetAvailableRidersViewTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(user=create_user("customer@test.com"))
+        self.order = Order.objects.create(
+            customer=self.customer,
+            pickup_address="Pickup",
+            pickup_lat=PICKUP_LAT,
+            pickup_long=PICKUP_LONG,
+            recipient_name="Recipient",
+            recipient_address="Recipient address",
+            recipient_lat=6.6,
+            recipient_long=3.4,
+            recipient_phone_number="08000000000",
+            weight=2,
+            value=1000,
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.customer.user)
+        self.riders_locations = []
+
+    def create_riders(self, count):
+        for i in range(len(self.riders_locations), count):
+            email = f"rider{i}@test.com"
+            Rider.objects.create(
+                user=create_user(email),
+                vehicle_registration_number=f"REG{i}",
+                min_capacity=1,
+                max_capacity=10,
+                charge_per_km=100,
+            )
+            self.riders_locations.append(
+                {
+                    "email": email,
+                    "location": "{},{}".format(
+                        PICKUP_LONG + 0.001 * (i % 10), PICKUP_LAT + 0.001 * (i // 10)
+                    ),
+                }
+            )
+
+    def get_available_riders(self):
+        index = RiderGridIndex(2)
+        snapshot = RiderLocationSnapshot(
+            lambda: self.riders_locations,
+            refresh_interval=60,
+            max_staleness=60,
+            index=index,
+        )
+        snapshot.refresh()
+        snapshot.start = lambda: None
+        matrix_results = [
+            {"email": rider["email"], "distance": 1.0, "duration": "5 mins"}
+            for rider in self.riders_locations
+        ]
+        with mock.patch("orders.views.rider_snapshot", snapshot), mock.patch(
+            "orders.views.rider_index", index
+        ), mock.patch.object(
+            GetAvailableRidersView, "get_matrix_results", return_value=matrix_results
+        ) as get_matrix_results:
+            response = self.client.get(
+                reverse("available_rider"),
+                {"price": "1500", "order_id": self.order.id},
+            )
+        return response, get_matrix_results
+
+    def test_query_count_does_not_grow_with_fleet(self):
+        self.create_riders(3)
+        with CaptureQueriesContext(connection) as small_fleet:
+            response, _ = self.get_available_riders()
+        self.assertEqual(response.status_code, 200)
+
+        self.create_riders(60)
+        with self.assertNumQueries(len(small_fleet.captured_queries)):
+            response, _ = self.get_available_riders()
+        self.assertEqual(response.status_code, 200)
+
+    def test_only_eligible_riders_are_notified(self):
+        self.create_riders(3)
+        Rider.objects.filter(user__email="rider1@test.com").update(max_capacity=1)
+        Rider.objects.filter(user__email="rider2@test.com").update(
+            fragile_item_allowed=False
+        )
+        self.order.fragile = True
+        self.order.save()
+
+        response, get_matrix_results = self.get_available_riders()
+
+        self.assertEqual(response.status_code, 200)
+        notified = [rider["email"] for rider in get_matrix_results.call_args[0][1]]
+        self.assertEqual(notified, ["rider0@test.com"])
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class TripRouteTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(user=create_user("customer@test.com"))
+        self.rider = Rider.objects.create(
+            user=create_user("rider@test.com"),
+            vehicle_registration_number="REG",
+            min_capacity=1,
+            max_capacity=10,
+            charge_per_km=100,
+        )
+        self.client = APIClient()
+        riders = [{"email": "rider@test.com", "location": f"{PICKUP_LONG},{PICKUP_LAT}"}]
+        mocks = {}
+        for target, value in (
+            ("orders.views.map_clients_manager.aget_route", (1500, 300, False)),
+            ("orders.views.anearest_riders", riders),
+            (
+                "orders.views.AcceptOrDeclineOrderView.get_rider_matrix_results",
+                [{"distance": 1.0, "duration": "5 mins"}],
+            ),
+        ):
+            patcher = mock.patch(target, new_callable=mock.AsyncMock, return_value=value)
+            mocks[target] = patcher.start()
+            self.addCleanup(patcher.stop)
+        self.aget_route = mocks["orders.views.map_clients_manager.aget_route"]
+
+    def get_order_detail(self):
+        self.client.force_authenticate(user=self.customer.user)
+        response = self.client.get(
+            reverse("order-detail-by-user", args=["customer@test.com"]),
+            {"user_type": "customer"},
+        )
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def accept_order(self, order):
+        self.client.force_authenticate(user=self.rider.user)
+        response = self.client.post(
+            reverse("accept-order"), {"order_id": order.id, "accept": True}, format="json"
+        )
+        self.assertEqual(response.status_code, 201)
+
+    def test_route_is_computed_once_per_coordinates(self):
+        self.client.force_authenticate(user=self.customer.user)
+        response = self.client.post(
+            reverse("create-order"),
+            {
+                "pickup_address": "Pickup",
+                "pickup_lat": PICKUP_LAT,
+                "pickup_long": PICKUP_LONG,
+                "recipient_name": "Recipient",
+                "recipient_address": "Recipient address",
+                "recipient_lat": 6.6,
+                "recipient_long": 3.4,
+                "recipient_phone_number": "08000000000",
+                "weight": 2,
+                "value": 1000,
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201)
+        order = Order.objects.get()
+
+        for _ in range(2):
+            self.get_order_detail()
+            self.accept_order(order)
+        self.assertEqual(self.aget_route.await_count, 1)
+
+        Order.objects.filter(id=order.id).update(pickup_lat=PICKUP_LAT + 0.01)
+        self.get_order_detail()
+        self.accept_order(order)
+        self.assertEqual(self.aget_route.await_count, 2)
+        self.aget_route.assert_awaited_with(f"{PICKUP_LONG},{PICKUP_LAT + 0.01}", "3.4,6.6")
+
+        Order.objects.filter(id=order.id).update(recipient_long=3.41)
+        self.accept_order(order)
+        self.get_order_detail()
+        self.assertEqual(self.aget_route.await_count, 3)
+
+
+class DistanceCalculatorTests(SimpleTestCase):
+    def test_malformed_locations_are_rejected(self):
+        calculator = DistanceCalculator(f"{PICKUP_LONG},{PICKUP_LAT}")
+        locations = [
+            {"email": "rider@test.com", "location": f"{PICKUP_LONG},{PICKUP_LAT},0"},
+            {"email": "next@test.com", "location": f"{PICKUP_LONG}"},
+        ]
+
+        with self.assertRaises(ValueError):
+            calculator.parse_locations(locations)
+        self.assertEqual(calculator.parse_locations([]).shape, (0, 2))
+
+
+class FakeProvidersTests(SimpleTestCase):
+    def setUp(self):
+        self.server = FakeProviderServer(("127.0.0.1", 0), async_job_seconds=0.1).start()
+        self.addCleanup(self.server.stop)
+        self.riders_locations = [
+            {
+                "email": f"rider{i}@test.com",
+                "location": f"{PICKUP_LONG + 0.01 * i},{PICKUP_LAT}",
+            }
+            for i in range(12)
+        ]
+
+    def test_mapbox_matrix_fills_each_request(self):
+        mapbox = MapboxDistanceDuration(
+            "key", max_concurrency=2, api_url=self.server.service_url("mapbox")
+        )
+        origins = [f"{PICKUP_LONG},{PICKUP_LAT}", f"{PICKUP_LONG},{PICKUP_LAT + 0.01}"]
+
+        results = mapbox.get_matrix(origins, self.riders_locations)
+
+        # 2 origins x 12 riders fit in 2 requests of 2 origins and 8 or 4 riders
+        self.assertEqual(self.server.request_counts["mapbox"], 2)
+        self.assertEqual(
+            [[result["email"] for result in row] for row in results],
+            [[rider["email"] for rider in self.riders_locations]] * 2,
+        )
+        self.assertLess(results[0][0]["distance"], results[0][-1]["distance"])
+
+    def test_tomtom_async_job(self):
+        tomtom = TomTomDistanceMatrix(
+            "key",
+            sync_max_cells=5,
+            poll_initial_delay=0.05,
+            poll_max_delay=0.05,
+            api_url=self.server.service_url("tomtom"),
+        )
+
+        results = tomtom.get_distance_duration(
+            f"{PICKUP_LONG},{PICKUP_LAT}", self.riders_locations
+        )
+
+        self.assertEqual(
+            [result["email"] for result in results],
+            [rider["email"] for rider in self.riders_locations],
+        )
+
+        # A job whose status cannot be read is not polled again on retry
+        tomtom._jobs["job"] = ("unknown", time.monotonic())
+        with self.assertRaises(Exception):
+            tomtom.wait_for_job("unknown", "job")
+        self.assertIsNone(tomtom.get_in_flight_job("job"))
+
+    def test_supabase_bounding_box_and_injected_errors(self):
+        class FakeSupabase(SupabaseTransactions):
+            supabase_url = self.server.service_url("supabase")
+
+        supabase = FakeSupabase()
+        supabase.create_on_table(
+            "riders",
+            [
+                {
+                    "rider_email": "near@test.com",
+                    "current_lat": PICKUP_LAT,
+                    "current_long": PICKUP_LONG,
+                },
+                {
+                    "rider_email": "far@test.com",
+                    "current_lat": PICKUP_LAT + 1,
+                    "current_long": PICKUP_LONG,
+                },
+                {
+                    "rider_email": "south@test.com",
+                    "current_lat": PICKUP_LAT - 1,
+                    "current_long": PICKUP_LONG,
+                },
+            ],
+        )
+
+        bounding_box = (
+            PICKUP_LAT - 0.1,
+            PICKUP_LONG - 0.1,
+            PICKUP_LAT + 0.1,
+            PICKUP_LONG + 0.1,
+        )
+        riders = supabase.get_supabase_riders_in_bounding_box(*bounding_box)
+        self.assertEqual([rider["email"] for rider in riders], ["near@test.com"])
+        riders = async_to_sync(supabase.aget_supabase_riders_in_bounding_box)(
+            *bounding_box
+        )
+        self.assertEqual([rider["email"] for rider in riders], ["near@test.com"])
+        # Every instance shares the process' clients, async calls from
+        # different event loops included
+        self.assertIs(FakeSupabase().supabase, supabase.supabase)
+        async_postgrest = supabase.async_postgrest
+        riders = async_to_sync(supabase.aget_supabase_riders_in_bounding_box)(
+            *bounding_box
+        )
+        self.assertEqual(len(riders), 1)
+        self.assertIs(FakeSupabase().async_postgrest, async_postgrest)
+        self.assertFalse(async_postgrest.session.is_closed)
+
+        self.server.behaviours["supabase"] = ServiceBehaviour(error_rate=1)
+        with self.assertRaises(Exception), self.assertLogs(
+            "map_clients.supabase_query", "ERROR"
+        ):
+            supabase.get_supabase_riders()
+
+    @override_settings(SUPABASE_WRITE_CHUNK_SIZE=5)
+    def test_supabase_rider_notifications_are_batched(self):
+        class FakeSupabase(SupabaseTransactions):
+            supabase_url = self.server.service_url("supabase")
+
+        supabase = FakeSupabase()
+        supabase.create_on_table(
+            "riders",
+            [{"rider_email": rider["email"]} for rider in self.riders_locations],
+        )
+        riders = [
+            {**rider, "distance": i, "duration": f"{i} mins"}
+            for i, rider in enumerate(self.riders_locations)
+        ]
+        requests = self.server.request_counts["supabase"]
+
+        report = supabase.send_riders_notification(riders, price=1500, order_id=1)
+
+        # Each rider has its own message, 12 riders in chunks of 5
+        self.assertEqual(self.server.request_counts["supabase"] - requests, 3)
+        self.assertEqual(len(report["notified"]), 12)
+        rows = self.server.tables["riders"]
+        self.assertIn("is 3 km and 3 mins away", rows[3]["broadcast_message"])
+        self.assertEqual(rows[11]["order_id"], 1)
+
+        # 7 riders with the same message in chunks of 5
+        requests = self.server.request_counts["supabase"]
+        supabase.send_riders_notification(riders[:7], message="Order assigned")
+        self.assertEqual(self.server.request_counts["supabase"] - requests, 2)
+        self.assertEqual(
+            [row["broadcast_message"] for row in rows[6:8]],
+            [
+                "Order assigned",
+                "New Delivery Request: Order is 7 km and 7 mins away with price tag of 1500",
+            ],
+        )
+
+        # Riders missing from the table are not created
+        supabase.send_riders_notification(
+            [
+                {"email": f"unknown{i}@test.com", "distance": i, "duration": "1 min"}
+                for i in range(2)
+            ]
+        )
+        self.assertEqual(len(rows), 12)
+
+        # A failed request does not stop the others
+        def write_chunk(table, key_column, rows, write=supabase.bulk_update_rows_chunk):
+            if rows[0]["rider_email"] == riders[5]["email"]:
+                return Exception("Injected error")
+            return write(table, key_column, rows)
+
+        with mock.patch.object(
+            supabase, "bulk_update_rows_chunk", side_effect=write_chunk
+        ), self.assertLogs("map_clients.supabase_query", "ERROR"):
+            report = supabase.send_riders_notification(riders + [{"email": "x"}])
+        self.assertEqual(report["failed"], [rider["email"] for rider in riders[5:10]])
+        self.assertEqual(len(report["notified"]), 7)
+        self.assertEqual(report["invalid"], ["x"])
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class RoadEstimatorTests(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        self.estimator = RoadEstimator(caches["default"], zone_size_km=5, reload_seconds=60)
+        customer = Customer.objects.create(user=create_user("customer@test.com"))
+        # 1 km east of the pickup as the crow flies, 1.5 km and 300 s by road
+        straight_line = (
+            self.estimator.estimate(
+                f"{PICKUP_LONG},{PICKUP_LAT}",
+                [{"email": "x", "location": f"{PICKUP_LONG + 0.009},{PICKUP_LAT}"}],
+            )[0]["distance_meters"]
+            / 1.3
+        )
+        for _ in range(5):
+            Order.objects.create(
+                customer=customer,
+                pickup_address="Pickup",
+                pickup_lat=PICKUP_LAT,
+                pickup_long=PICKUP_LONG,
+                recipient_name="Recipient",
+                recipient_address="Recipient address",
+                recipient_lat=PICKUP_LAT,
+                recipient_long=PICKUP_LONG + 0.009,
+                recipient_phone_number="08000000000",
+                weight=2,
+                value=1000,
+                trip_distance_meters=round(straight_line * 1.5),
+                trip_duration_seconds=300,
+            )
+
+    def test_estimates_use_the_learned_profile(self):
+        self.assertEqual(self.estimator.learn(), 5)
+
+        # Another process picks the profile up from the cache
+        estimator = RoadEstimator(caches["default"], zone_size_km=5, reload_seconds=60)
+        result = estimator.estimate(
+            f"{PICKUP_LONG},{PICKUP_LAT}",
+            [{"email": "rider@test.com", "location": f"{PICKUP_LONG},{PICKUP_LAT + 0.009}"}],
+        )[0]
+
+        self.assertAlmostEqual(result["distance_meters"], 1.5 * 1001, delta=5)
+        self.assertAlmostEqual(result["duration_seconds"], 300, delta=2)
+
+    def test_manager_falls_back_to_the_estimator(self):
+        manager = MapClientsManager()
+        manager.estimator = Estimator(self.estimator)
+        riders = [{"email": "rider@test.com", "location": f"{PICKUP_LONG},{PICKUP_LAT + 0.009}"}]
+
+        with mock.patch.object(
+            manager, "call_client", return_value=(False, None)
+        ), mock.patch.object(manager, "get_client_names", return_value=["tomtom", "mapbox"]):
+            results = manager.get_distances_duration(f"{PICKUP_LONG},{PICKUP_LAT}", riders)
+
+        self.assertEqual(results[0]["email"], "rider@test.com")
+        self.assertTrue(results[0]["estimated"])
+        self.assertEqual(manager.estimator_fallbacks, 1)
+
+    def test_trip_route_is_estimated_while_mapbox_is_down(self):
+        server = FakeProviderServer(("127.0.0.1", 0)).start()
+        self.addCleanup(server.stop)
+        server.behaviours["mapbox"] = ServiceBehaviour(error_rate=1)
+        manager = MapClientsManager()
+        manager.estimator = Estimator(self.estimator)
+        self.estimator.learn()
+        order = Order.objects.first()
+        order.trip_distance_meters = None
+
+        with override_settings(MAPBOX_API_URL=server.service_url("mapbox")), mock.patch(
+            "orders.views.map_clients_manager", manager
+        ):
+            with self.assertLogs("map_clients.map_clients", "ERROR"):
+                distance = async_to_sync(aensure_trip_route)(order)
+
+            order.refresh_from_db()
+            self.assertTrue(order.trip_route_estimated)
+            self.assertAlmostEqual(distance, 1.5, delta=0.05)
+            self.assertEqual(manager.estimator_fallbacks, 1)
+            self.assertTrue(order.trip_route_is_stale)
+
+            # Replaced by the real route once Mapbox is back
+            server.behaviours["mapbox"] = ServiceBehaviour()
+            async_to_sync(aensure_trip_route)(order)
+
+        order.refresh_from_db()
+        self.assertFalse(order.trip_route_estimated)
+        self.assertFalse(order.trip_route_is_stale)
+        self.assertEqual(manager.estimator_fallbacks, 1)
+
+
+class ZoneMatrixTests(SimpleTestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        estimator = RoadEstimator(caches["default"], zone_size_km=5, reload_seconds=60)
+        self.tmp_dir = tmp_dir.name
+        self.cache = caches["default"]
+        self.addCleanup(self.cache.clear)
+        self.zone_matrix = self.make_zone_matrix("worker", estimator)
+        self.origin = f"{PICKUP_LONG},{PICKUP_LAT}"
+        self.riders = [
+            {"email": "far@test.com", "location": "3.39,6.59"},
+            {"email": "near@test.com", "location": "3.31,6.51"},
+        ]
+
+    def make_zone_matrix(self, host, estimator):
+        return ZoneMatrix(
+            self.cache,
+            os.path.join(self.tmp_dir, host, "zone_matrix.npy"),
+            ZoneGrid((3.3, 6.5, 3.4, 6.6), zone_size_km=3),
+            bucket_hours=3,
+            reload_seconds=0,
+            estimator=estimator,
+        )
+
+    def fill(self, hour):
+        grid = self.zone_matrix.grid
+        manager = mock.Mock()
+        # 100 s per zone of east-west offset, so the table disagrees with
+        # the straight-line estimate
+        manager.get_distances_duration.side_effect = lambda origin, destinations: [
+            {
+                "email": destination["email"],
+                "distance_meters": 1000,
+                "duration_seconds": 100 * (int(destination["email"]) % grid.cols),
+            }
+            for destination in destinations
+        ]
+        return self.zone_matrix.fill(manager, max_origins=100, hour=hour)
+
+    def test_uncovered_destinations_fall_back_to_the_live_matrix(self):
+        self.assertIsNone(self.zone_matrix.get_distances_duration(self.origin, self.riders))
+
+        self.fill(hour=3)
+        # Only the 03:00-06:00 bucket was filled
+        results, covered = self.zone_matrix.estimate(self.origin, self.riders, hour=12)
+        self.assertFalse(covered)
+
+    def test_lookups_come_from_the_table(self):
+        self.assertEqual(self.fill(hour=13), self.zone_matrix.grid.size)
+
+        results, covered = self.zone_matrix.estimate(self.origin, self.riders, hour=14)
+
+        self.assertTrue(covered)
+        grid = self.zone_matrix.grid
+        for result, rider in zip(results, self.riders):
+            long, lat = map(float, rider["location"].split(","))
+            zone = int(grid.zones_for(lat, long))
+            self.assertEqual(result["duration_seconds"], 100 * (zone % grid.cols))
+        self.assertEqual(
+            self.zone_matrix.rank(self.origin, self.riders, 1, hour=14), [self.riders[1]]
+        )
+
+    def test_table_is_shared_with_other_hosts(self):
+        web = self.make_zone_matrix("web", self.zone_matrix.estimator)
+        self.assertIsNone(web.get_table())
+
+        self.fill(hour=13)
+        results, covered = web.estimate(self.origin, self.riders, hour=14)
+
+        self.assertTrue(covered)
+        self.assertEqual(
+            results, self.zone_matrix.estimate(self.origin, self.riders, hour=14)[0]
+        )
+        # A new worker carries on from the published table
+        worker = self.make_zone_matrix("new_worker", self.zone_matrix.estimator)
+        table, filled_at = worker.open_for_writing()
+        self.assertFalse(np.isnan(table[worker.bucket_for(13)]).any())
+        self.assertTrue(filled_at[worker.bucket_for(13)].all())
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.server = FakeProviderServer(("127.0.0.1", 0)).start()
+        self.addCleanup(self.server.stop)
+
+        class FakeSupabase(SupabaseTransactions):
+            supabase_url = self.server.service_url("supabase")
+
+        patcher = mock.patch.object(outbox, "supabase", FakeSupabase())
+        self.supabase = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server.tables["customers"] = [{"email": "customer@test.com"}]
+        self.server.tables["riders"] = [
+            {"rider_email": f"rider{i}@test.com"} for i in range(3)
+        ]
+
+    def test_updates_of_the_same_row_are_merged(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            outbox.enqueue_customer_notification(
+                "customer@test.com", "Rider found", rider_info={"rider_name": "Rider"}
+            )
+            outbox.enqueue_customer_notification(
+                "customer@test.com",
+                "Status update PickedUp",
+                ride_status="PickedUp",
+                by_pass_rider_info=True,
+            )
+            outbox.enqueue_riders_notification(
+                [
+                    {"email": f"rider{i}@test.com", "distance": i, "duration": "5 mins"}
+                    for i in range(3)
+                ],
+                price=1500,
+                order_id=1,
+            )
+        # The relay is only kicked off once committed
+        self.assertEqual(len(callbacks), 3)
+
+        self.assertEqual(outbox.relay(), (5, 4))
+
+        self.assertFalse(OutboxMessage.objects.exists())
+        customer = self.server.tables["customers"][0]
+        self.assertEqual(customer["notification"], "Status update PickedUp")
+        self.assertEqual(customer["rider_info"], {"rider_name": "Rider"})
+        self.assertIn("is 2 km", self.server.tables["riders"][2]["broadcast_message"])
+
+    def test_failed_messages_are_kept(self):
+        outbox.enqueue_customer_notification("customer@test.com", "Rider found")
+        self.server.behaviours["supabase"] = ServiceBehaviour(error_rate=1)
+
+        with self.assertLogs("map_clients.supabase_query", "ERROR"):
+            self.assertEqual(outbox.relay(), (0, 0))
+
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.attempts, 1)
+        self.assertIn("Injected error", message.last_error)
+        self.assertIsNone(message.claimed_until)
+        self.assertIsNone(message.dead_at)
+        # Retried after a delay, not by the next relay
+        self.assertGreater(message.available_at, timezone.now())
+        self.assertEqual(outbox.relay(), (0, 0))
+
+    @override_settings(SUPABASE_OUTBOX_MAX_ATTEMPTS=2)
+    def test_messages_failing_too_often_are_set_aside(self):
+        outbox.enqueue_customer_notification("customer@test.com", "Rider found")
+        self.server.behaviours["supabase"] = ServiceBehaviour(error_rate=1)
+
+        with self.assertLogs("map_clients.supabase_query", "ERROR"):
+            outbox.relay()
+        OutboxMessage.objects.update(available_at=timezone.now())
+        with self.assertLogs("map_clients.outbox", "ERROR"):
+            outbox.relay()
+
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.attempts, 2)
+        self.assertIsNotNone(message.dead_at)
+        OutboxMessage.objects.update(available_at=timezone.now())
+        self.assertEqual(outbox.relay(), (0, 0))
+
+    def test_failures_do_not_block_other_rows(self):
+        for i in range(3):
+            outbox.enqueue_riders_notification(
+                [{"email": f"rider{i}@test.com", "distance": i, "duration": "5 mins"}],
+                price=1500,
+                order_id=i,
+            )
+        outbox.enqueue_customer_notification("customer@test.com", "Rider found")
+
+        def write_rows(table, key_column, rows, **kwargs):
+            keys = [row[key_column] for row in rows]
+            failed = [key for key in keys if key == "rider0@test.com"]
+            written = [key for key in keys if key not in failed]
+            return {"written": written, "failed": failed, "error": "Injected error"}
+
+        with mock.patch.object(self.supabase, "write_rows", side_effect=write_rows):
+            # Small batches, so the relay keeps going past the failed one
+            self.assertEqual(outbox.relay(batch_size=1), (3, 3))
+            # A later update of the failed row waits for the retry
+            outbox.enqueue_riders_notification(
+                [{"email": "rider0@test.com", "distance": 1, "duration": "5 mins"}],
+                price=2000,
+                order_id=4,
+            )
+            self.assertEqual(outbox.relay(), (0, 0))
+
+        self.assertEqual(OutboxMessage.objects.count(), 2)
+        self.assertEqual(OutboxMessage.objects.filter(attempts=1).count(), 1)
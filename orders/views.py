@@ -1,4 +1,9 @@
+import asyncio
 import decimal
+from adrf.views import APIView as AsyncAPIView
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import Http404
 from django.utils import timezone
 from decimal import Decimal
 from accounts.models import Rider
@@ -6,20 +11,21 @@ from django.db import transaction
 from django.db.models import Avg, Q
 
 from django.shortcuts import get_object_or_404
-from accounts.utils import (
-    DistanceCalculator,
-    generate_otp,
-    send_customer_notification,
-    send_riders_notification,
-    str_to_bool,
+from accounts.utils import DistanceCalculator, generate_otp, str_to_bool
+from map_clients.map_clients import map_clients_manager
+from map_clients.outbox import (
+    enqueue_customer_notification,
+    enqueue_riders_notification,
 )
-from map_clients.map_clients import MapClientsManager, get_distance
+from map_clients.rider_snapshot import RIDER_LOCATION_FIELDS, rider_snapshot
+from map_clients.spatial_index import rider_index
+from map_clients.zone_matrix import zone_matrix
 from map_clients.supabase_query import SupabaseTransactions
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from wallet.models import PendingWalletTransaction, WalletTransaction
+from wallet.models import PendingWalletTransaction, Wallet, WalletTransaction
 from .models import DeclinedOrder, Order
 from accounts.models import Rider
 from .serializers import (
@@ -30,34 +36,100 @@ from .serializers import (
 import logging
 
 
-map_clients_manager = MapClientsManager()
 supabase = SupabaseTransactions()
 
 logger = logging.getLogger(__name__)
 
 
-def get_rider_available(SEARCH_RADIUS_KM, order_location):
-    fields = ["rider_email", "current_lat", "current_long"]
-    riders_location_data = supabase.get_supabase_riders(fields=fields)
+async def anearest_riders(
+    origin,
+    k=settings.RIDER_SEARCH_MAX_RIDERS,
+    max_radius=settings.RIDER_SEARCH_MAX_RADIUS_KM,
+):
+    """
+    Get the k riders closest to origin within max_radius km, sorted by distance.
+    """
+    # The snapshot keeps the grid index in step with the latest positions, so
+    # the search widens ring by ring from the pickup and stops as soon as k
+    # riders are found instead of scanning the whole fleet
+    if rider_snapshot.ensure_fresh(refresh=False):
+        riders, _ = rider_index.search_expanding(
+            origin,
+            k,
+            settings.RIDER_SEARCH_INITIAL_RADIUS_KM,
+            max_radius,
+            settings.RIDER_SEARCH_RADIUS_GROWTH,
+        )
+        return riders
+
+    # The snapshot is stale, only download the riders inside the bounding box
+    # of the search circle rather than the whole riders table
+    distance_calc = DistanceCalculator(origin)
+    riders_location_data = await supabase.aget_supabase_riders_in_bounding_box(
+        *distance_calc.bounding_box(max_radius), fields=RIDER_LOCATION_FIELDS
+    )
+    return distance_calc.nearest_destinations(riders_location_data, k, max_radius)
+
 
-    distance_calc = DistanceCalculator(order_location)
-    riders_within_radius = distance_calc.destinations_within_radius(
-        riders_location_data, SEARCH_RADIUS_KM
+async def aget_rider_location(rider_email):
+    # A stale snapshot is refreshed synchronously, keep that off the event loop
+    rider_data = await sync_to_async(rider_snapshot.get_riders, thread_sensitive=False)(
+        [rider_email]
     )
-    return riders_within_radius
+    if not rider_data:
+        # The rider came online after the last snapshot refresh
+        conditions = [{"column": "rider_email", "value": rider_email}]
+        rider_data = await supabase.aget_supabase_riders(
+            conditions=conditions, fields=RIDER_LOCATION_FIELDS
+        )
+    return rider_data
+
+
+TRIP_ROUTE_FIELDS = [
+    "trip_distance_meters",
+    "trip_duration_seconds",
+    "trip_route_key",
+    "trip_route_estimated",
+]
+
+
+async def aensure_trip_route(order):
+    """
+    Compute the pickup to recipient route of an order once and store it, it
+    is only recomputed when the pickup or recipient coordinates change, or
+    to replace an estimate once Mapbox is back.
+
+    Returns:
+    The trip distance in kilometers.
+    """
+    if order.trip_route_is_stale:
+        order.set_trip_route(
+            *await map_clients_manager.aget_route(
+                order.pickup_location, order.recipient_location
+            )
+        )
+        await sync_to_async(order.save)(update_fields=TRIP_ROUTE_FIELDS)
+    return order.trip_distance_km
 
 
-def get_ride_average_cost(riders_within_radius, order_location, recipient_location):
+async def aget_object_or_404(queryset, **kwargs):
+    try:
+        return await queryset.aget(**kwargs)
+    except queryset.model.DoesNotExist:
+        raise Http404(f"No {queryset.model._meta.object_name} matches the given query.")
+
+
+async def aget_average_charge_per_km(riders_within_radius):
     rider_emails = [rider["email"] for rider in riders_within_radius]
 
     # Query Rider model to get charge_per_km for riders within radius
     riders_within_radius_queryset = Rider.objects.filter(user__email__in=rider_emails)
-    average_charge_per_km = riders_within_radius_queryset.aggregate(
-        avg_charge=Avg("charge_per_km")
+    return (
+        await riders_within_radius_queryset.aaggregate(avg_charge=Avg("charge_per_km"))
     )["avg_charge"]
 
-    trip_distance = get_distance(order_location, recipient_location)
 
+def get_ride_cost(average_charge_per_km, trip_distance):
     # Convert trip_distance to Decimal
     trip_distance_decimal = Decimal(str(trip_distance))
 
@@ -67,51 +139,71 @@ def get_ride_average_cost(riders_within_radius, order_location, recipient_locati
     return cost
 
 
-class CreateOrderView(APIView):
+# The async views below keep the event loop free while waiting on the
+# database and the map providers. ORM calls without an async API yet, and
+# anything needing a transaction, go through sync_to_async, blocking I/O
+# (the provider clients) runs on worker threads and Supabase rider lookups
+# use the async client. Lookups that do not depend on each other are awaited
+# together, so a request takes as long as its slowest lookup rather than
+# their sum.
+
+
+class CreateOrderView(AsyncAPIView):
     permission_classes = [IsAuthenticated]
-    SEARCH_RADIUS_KM = 5
 
-    @transaction.atomic
-    def post(self, request, *args, **kwargs):
+    async def post(self, request, *args, **kwargs):
         serializer = OrderSerializer(data=request.data)
 
-        recipient_lat = request.data.get("recipient_lat")
-        recipient_long = request.data.get("recipient_long")
-
         pickup_lat = request.data.get("pickup_lat")
         pickup_long = request.data.get("pickup_long")
 
         order_location = f"{pickup_long},{pickup_lat}"
-        recipient_location = f"{recipient_long},{recipient_lat}"
-
-        if serializer.is_valid():
-            serializer.validated_data["customer"] = request.user.customer
 
-            riders_within_radius = get_rider_available(
-                self.SEARCH_RADIUS_KM, order_location
+        if await sync_to_async(serializer.is_valid)():
+            recipient_location = "{},{}".format(
+                serializer.validated_data.get("recipient_long"),
+                serializer.validated_data.get("recipient_lat"),
             )
+            # The route does not depend on the riders, start it right away
+            route_task = asyncio.ensure_future(
+                map_clients_manager.aget_route(order_location, recipient_location)
+            )
+            try:
+                riders_within_radius = await anearest_riders(order_location)
+            except BaseException:
+                route_task.cancel()
+                raise
 
             if riders_within_radius:
-                cost = get_ride_average_cost(
-                    riders_within_radius, order_location, recipient_location
+                average_charge_per_km, route = await asyncio.gather(
+                    aget_average_charge_per_km(riders_within_radius), route_task
+                )
+                response_data = await sync_to_async(self.create_order)(
+                    serializer, request.user, average_charge_per_km, route
                 )
-                serializer.save()
-                # Include cost in serializer data
-                response_data = serializer.data
-                response_data["cost"] = cost
-
                 return Response(response_data, status=status.HTTP_201_CREATED)
             else:
+                route_task.cancel()
                 return Response(
                     {"error": "No riders found within the search radius."},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-
-class GetAvailableRidersView(APIView):
+    @transaction.atomic
+    def create_order(self, serializer, user, average_charge_per_km, route):
+        order = serializer.save(customer=user.customer)
+        order.set_trip_route(*route)
+        order.save(update_fields=TRIP_ROUTE_FIELDS)
+        cost = get_ride_cost(average_charge_per_km, order.trip_distance_km)
+        # Include cost in serializer data
+        response_data = serializer.data
+        response_data["cost"] = cost
+        return response_data
+
+
+class GetAvailableRidersView(AsyncAPIView):
     permission_classes = [IsAuthenticated]
-    SEARCH_RADIUS_KM = 5
 
     def validate_parameters(self, price_offer):
         """Validate input parameters."""
@@ -125,16 +217,38 @@ class GetAvailableRidersView(APIView):
             return False, "Invalid or missing parameters"
         return True, ""
 
-    def get(self, request, *args, **kwargs):
+    async def get_eligible_riders(self, order, candidates):
+        """
+        Keep the candidates able to carry the order, in their original order.
+
+        Capacity and fragile eligibility are checked in a single query over
+        the nearby candidates only, so the database cost does not grow with
+        the size of the fleet.
+        """
+        if not candidates:
+            return []
+
+        fragile_query = {"fragile_item_allowed": True} if order.fragile else {}
+        eligible_emails = {
+            email
+            async for email in Rider.objects.filter(
+                user__email__in=[rider["email"] for rider in candidates],
+                min_capacity__lte=order.weight,
+                max_capacity__gte=order.weight,
+                **fragile_query,
+            ).values_list("user__email", flat=True)
+        }
+        return [rider for rider in candidates if rider["email"] in eligible_emails]
+
+    async def get(self, request, *args, **kwargs):
         price_offer = request.GET.get("price")
         order_id = request.GET.get("order_id")
-        order = get_object_or_404(Order, id=int(order_id))
-        item_weight = order.weight
+        order = await aget_object_or_404(
+            Order.objects.select_related("customer__user", "rider__user"),
+            id=int(order_id),
+        )
         origin_lat = order.pickup_lat
         origin_long = order.pickup_long
-        is_fragile = order.fragile
-
-        customer = request.user.customer
 
         is_valid, validation_message = self.validate_parameters(price_offer)
         if not is_valid:
@@ -143,58 +257,24 @@ class GetAvailableRidersView(APIView):
             )
 
         origin = f"{origin_long},{origin_lat}"
-        fields = ["rider_email", "current_lat", "current_long"]
-        riders_location_data = supabase.get_supabase_riders(fields=fields)
-
-        # Fetch all Rider objects that meet the conditions in a single query
-        fragile_query = {"fragile_item_allowed": True} if is_fragile else {}
-        rider_queryset = Rider.objects.filter(
-            user__email__in=[rider["email"] for rider in riders_location_data],
-            min_capacity__lte=item_weight,
-            max_capacity__gte=item_weight,
-            **fragile_query,
+
+        # Geography first: only the riders closest to the pickup are checked
+        # for eligibility, the eligible ones with the shortest ETA in the zone
+        # table are notified
+        candidates = await anearest_riders(
+            origin, k=settings.RIDER_SEARCH_MAX_CANDIDATES
+        )
+        riders = await sync_to_async(zone_matrix.rank, thread_sensitive=False)(
+            origin,
+            await self.get_eligible_riders(order, candidates),
+            settings.RIDER_SEARCH_MAX_RIDERS,
         )
 
-        # Create a dictionary to map rider emails to rider objects
-        rider_email_to_rider = {rider.user.email: rider for rider in rider_queryset}
-
-        # Iterate through riders_location_data and filter the Rider objects
-        riders = []
-        for rider in riders_location_data:
-            rider_email = rider["email"]
-            if rider_email in rider_email_to_rider:
-                rider_info = {
-                    "email": rider_email,
-                    "location": rider["location"],
-                }
-                riders.append(rider_info)
-
-        if riders and origin:
-            calculator = DistanceCalculator(origin)
-            location_within_radius = calculator.destinations_within_radius(
-                riders, self.SEARCH_RADIUS_KM
-            )
-            if not location_within_radius:
-                send_customer_notification.delay(
-                    customer=customer.user.email, message="No rider around you"
-                )
-            else:
-                try:
-                    results = self.get_matrix_results(origin, location_within_radius)
-
-                except Exception as e:
-                    logger.error(f"Error processing API request: {str(e)}")
-                    map_clients_manager.switch_client()
-                    results = self.get_matrix_results(origin, location_within_radius)
-            send_riders_notification.delay(
-                results,
-                price=price_offer,
-                request_coordinates={"long": origin_long, "lat": origin_lat},
-                order_id=order_id,
-            )
-        order.status = "RiderSearch"
-        order.save()
-        order_data = OrderDetailUserSerializer(order).data
+        results = await self.get_matrix_results(origin, riders) if riders else []
+        await sync_to_async(self.start_rider_search)(
+            order, request.user.email, results, price_offer, order_id
+        )
+        order_data = await sync_to_async(lambda: OrderDetailUserSerializer(order).data)()
         return Response(
             {
                 **order_data,
@@ -204,10 +284,38 @@ class GetAvailableRidersView(APIView):
             }
         )
 
-    def get_matrix_results(self, origin, destinations):
-        """Get results from Matrix API."""
-        map_client = map_clients_manager.get_client()
-        results = map_client.get_distances_duration(origin, destinations)
+    @transaction.atomic
+    def start_rider_search(self, order, customer_email, results, price_offer, order_id):
+        """
+        Queue the notifications with the order status change, they are only
+        sent once it is committed.
+        """
+        if not results:
+            enqueue_customer_notification(
+                customer=customer_email, message="No rider around you"
+            )
+        else:
+            enqueue_riders_notification(
+                results,
+                price=price_offer,
+                request_coordinates={"long": order.pickup_long, "lat": order.pickup_lat},
+                order_id=order_id,
+            )
+        order.status = "RiderSearch"
+        order.save()
+
+    async def get_matrix_results(self, origin, destinations):
+        """
+        Get results from the zone table, or the Matrix API for the riders
+        the table does not cover yet.
+        """
+        results = await sync_to_async(
+            zone_matrix.get_distances_duration, thread_sensitive=False
+        )(origin, destinations)
+        if results is None:
+            results = await map_clients_manager.aget_distances_duration(
+                origin, destinations
+            )
         return results
 
 
@@ -220,80 +328,65 @@ class OrderDetailView(APIView):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class GetOrderDetailByUser(APIView):
-    SEARCH_RADIUS_KM = 5
+class GetOrderDetailByUser(AsyncAPIView):
     permission_classes = [IsAuthenticated]
 
-    def get(self, request, email, *args, **kwargs):
+    async def get(self, request, email, *args, **kwargs):
         print(email)
         user_type = request.GET.get("user_type")
-        order = Order.objects.filter(
-            Q(customer__user__email=email) | Q(rider__user__email=email)
+        order = (
+            await Order.objects.filter(
+                Q(customer__user__email=email) | Q(rider__user__email=email)
+            )
+            .select_related("customer__user", "rider__user")
+            .order_by("-created_at")
+            .afirst()
         )
         if order:
-            order = order.latest("created_at")
             extra_data = {}
             if user_type == "customer":
-                order_location = f"{order.pickup_long},{order.pickup_lat}"
-                recipient_location = f"{order.recipient_long},{order.recipient_lat}"
-                available_riders = get_rider_available(
-                    self.SEARCH_RADIUS_KM, order_location
-                )
-                cost = get_ride_average_cost(
-                    available_riders, order_location, recipient_location
+                average_charge_per_km, trip_distance = await asyncio.gather(
+                    self.get_average_charge_per_km(order.pickup_location),
+                    aensure_trip_route(order),
                 )
-                extra_data["cost"] = cost
+                extra_data["cost"] = get_ride_cost(average_charge_per_km, trip_distance)
 
-            serializer = OrderDetailUserSerializer(order)
-            return Response(
-                {**serializer.data, **extra_data}, status=status.HTTP_200_OK
-            )
+            serializer_data = await sync_to_async(
+                lambda: OrderDetailUserSerializer(order).data
+            )()
+            return Response({**serializer_data, **extra_data}, status=status.HTTP_200_OK)
         else:
             return Response({"message": "Order not found"}, status=status.HTTP_200_OK)
 
+    async def get_average_charge_per_km(self, origin):
+        available_riders = await anearest_riders(origin)
+        return await aget_average_charge_per_km(available_riders)
 
-class AcceptOrDeclineOrderView(APIView):
+
+class AcceptOrDeclineOrderView(AsyncAPIView):
     permission_classes = [IsAuthenticated]
 
-    @transaction.atomic
-    def post(self, request, *args, **kwargs):
+    async def post(self, request, *args, **kwargs):
         order_id = request.data.get("order_id")
         price = request.data.get("price")
         accept = request.data.get("accept")
         reason = request.data.get("reason")
 
         # Get authenticated rider from request
-        rider = request.user.rider_profile
-        order = get_object_or_404(Order, id=order_id)
+        rider = await Rider.objects.select_related("user").aget(user=request.user)
+        order = await aget_object_or_404(
+            Order.objects.select_related("customer__user"), id=order_id
+        )
 
         if accept and reason is None:
-            pickup_lat = order.pickup_lat
-            pickup_long = order.pickup_long
-            recipient_long = order.recipient_long
-            recipient_lat = order.recipient_lat
-
-            order_location = f"{pickup_long},{pickup_lat}"
-            recipient_location = f"{recipient_long},{recipient_lat}"
-
-            conditions = [{"column": "rider_email", "value": rider.user.email}]
-            fields = ["rider_email", "current_lat", "current_long"]
-
-            rider_data = supabase.get_supabase_riders(
-                conditions=conditions, fields=fields
+            result, trip_distance = await asyncio.gather(
+                self.get_rider_matrix_results(order.pickup_location, rider.user.email),
+                aensure_trip_route(order),
             )
 
-            try:
-                result = self.get_matrix_results(order_location, rider_data)
-            except Exception as e:
-                logger.error(f"Error processing API request: {str(e)}")
-                map_clients_manager.switch_client()
-                result = self.get_matrix_results(order_location, rider_data)
-
             distance = result[0]["distance"]
             duration = result[0]["duration"]
 
-            trip_distance = get_distance(order_location, recipient_location)
-
             # Calculate the cost of the ride based on the distance of the trip
             cost_of_ride = round((float(rider.charge_per_km) * trip_distance), 2)
 
@@ -307,7 +400,7 @@ class AcceptOrDeclineOrderView(APIView):
                 "order_completed": rider.completed_orders,
                 "price": price if price else cost_of_ride,
             }
-            send_customer_notification.delay(
+            await sync_to_async(enqueue_customer_notification)(
                 customer=order.customer.user.email,
                 message="Notifying riders close to you",
                 rider_info=rider_info,
@@ -319,15 +412,7 @@ class AcceptOrDeclineOrderView(APIView):
                 status=status.HTTP_201_CREATED,
             )
         elif reason and not accept:
-            rider.declined_requests += 1
-            rider.save()
-            # Create and save DeclinedOrder instance
-            DeclinedOrder.objects.create(
-                order=order,
-                customer=None,
-                rider=rider,
-                decline_reason=reason,
-            )
+            await sync_to_async(self.decline_order)(rider, order, reason)
 
             # Return response for declined order
             return Response(
@@ -335,22 +420,45 @@ class AcceptOrDeclineOrderView(APIView):
                 status=status.HTTP_201_CREATED,
             )
 
-    def get_matrix_results(self, origin, destinations):
-        """Get results from Matrix API."""
-        map_client = map_clients_manager.get_client()
-        results = map_client.get_distances_duration(origin, destinations)
+    @transaction.atomic
+    def decline_order(self, rider, order, reason):
+        rider.declined_requests += 1
+        rider.save()
+        # Create and save DeclinedOrder instance
+        DeclinedOrder.objects.create(
+            order=order,
+            customer=None,
+            rider=rider,
+            decline_reason=reason,
+        )
+
+    async def get_rider_matrix_results(self, origin, rider_email):
+        rider_data = await aget_rider_location(rider_email)
+        return await self.get_matrix_results(origin, rider_data)
+
+    async def get_matrix_results(self, origin, destinations):
+        """
+        Get results from the zone table, or the Matrix API when the table
+        does not cover the rider yet.
+        """
+        results = await sync_to_async(
+            zone_matrix.get_distances_duration, thread_sensitive=False
+        )(origin, destinations)
+        if results is None:
+            results = await map_clients_manager.aget_distances_duration(
+                origin, destinations
+            )
         return results
 
 
-class AssignOrderToRiderView(APIView):
+class AssignOrderToRiderView(AsyncAPIView):
     """
     This view assigns an order to a rider.
     """
 
     permission_classes = [IsAuthenticated]
 
-    @transaction.atomic
-    def post(self, request, *args, **kwargs):
+    async def post(self, request, *args, **kwargs):
         """
         This method handles the POST request to assign an order to a rider.
         It assigns the rider to the order, updates the order status, and sends notifications to both the rider and the customer.
@@ -359,7 +467,7 @@ class AssignOrderToRiderView(APIView):
         rider_email = request.data.get("rider_email")
         order_id = request.data.get("order_id")
         price = request.data.get("price")
-        wallet = request.user.wallet
+        wallet = await Wallet.objects.aget(user=request.user)
 
         if wallet.balance < decimal.Decimal(price):
             return Response(
@@ -368,33 +476,21 @@ class AssignOrderToRiderView(APIView):
             )
         try:
             # Get the order and rider objects
-            order = get_object_or_404(Order, id=order_id)
-            rider = get_object_or_404(Rider, user__email=rider_email)
-
-            # Assign the rider to the order and update the order status
-            order.rider = rider
-            order.status = "WaitingForPickup"
+            order = await aget_object_or_404(
+                Order.objects.select_related("customer__user"), id=order_id
+            )
+            rider = await aget_object_or_404(
+                Rider.objects.select_related("user"), user__email=rider_email
+            )
 
             # Get the order location
             order_location = f"{order.pickup_long},{order.pickup_lat}"
 
-            # Define conditions and fields for retrieving rider data from supabase
-            conditions = [{"column": "rider_email", "value": rider_email}]
-            fields = ["rider_email", "current_lat", "current_long"]
-
-            # Retrieve rider data from supabase
-            rider_data = supabase.get_supabase_riders(
-                conditions=conditions, fields=fields
-            )
+            # Retrieve rider location from the snapshot
+            rider_data = await aget_rider_location(rider_email)
 
-            try:
-                # Get distance and duration from the matrix results
-                result = self.get_matrix_results(order_location, rider_data)
-            except Exception as e:
-                # Handle exception and retry
-                logger.error(f"Error processing API request: {str(e)}")
-                map_clients_manager.switch_client()
-                result = self.get_matrix_results(order_location, rider_data)
+            # Get distance and duration from the matrix results
+            result = await self.get_matrix_results(order_location, rider_data)
 
             # Extract distance and duration from the result
             distance = result[0]["distance"]
@@ -408,48 +504,10 @@ class AssignOrderToRiderView(APIView):
             # Generate order_completion code
             code = generate_otp(length=4)
 
-            # Update the order price and save the order
-            wallet.balance -= decimal.Decimal(price) * 100
-            wallet.updated_at = timezone.now()
-            wallet.save()
-            order.distance = distance
-            order.duration = duration
-            order.price = decimal.Decimal(price) * 100
-            order.order_completion_code = code
-            order.save()
-
-            WalletTransaction.objects.create(
-                wallet=wallet,
-                transaction_type="debit",
-                amount=price,
-                transaction_status="pending",
-                created_at=timezone.now(),
-                paid_at=timezone.now(),
-            )
-
-            PendingWalletTransaction.objects.create(
-                user=request.user, order=order, amount=price
+            response_data = await sync_to_async(self.assign_order)(
+                request.user, wallet, order, rider, price, result, code, rider_message
             )
 
-            customer_message = f"Order Assigned successfully: {rider.user.get_full_name} is {distance} km and {duration} away. Order code: {code}"
-
-            # Serialize the updated order and attach distance and duration
-            serializer = OrderDetailSerializer(order)
-            response_data = serializer.data
-            response_data["distance"] = distance
-            response_data["duration"] = duration
-
-            send_riders_notification.delay(
-                result,
-                message=rider_message,
-                order_id=order_id,
-                price=price,
-                order_info=response_data,
-                request_coordinates={
-                    "long": order.pickup_long,
-                    "lat": order.pickup_lat,
-                },
-            )
             customer_message = f"Order Assigned successfully: {rider.user.get_full_name} is {distance} km and {duration} away"
             return Response(
                 {
@@ -464,11 +522,54 @@ class AssignOrderToRiderView(APIView):
             # Handle if rider or order not found
             return Response("Rider or Order not found")
 
-    def get_matrix_results(self, origin, destinations):
+    @transaction.atomic
+    def assign_order(self, user, wallet, order, rider, price, result, code, rider_message):
+        """
+        Debit the wallet, assign the rider to the order and queue the rider
+        notification in one transaction.
+
+        Returns:
+        The serialized order.
+        """
+        # Assign the rider to the order and update the order status
+        order.rider = rider
+        order.status = "WaitingForPickup"
+
+        # Update the order price and save the order
+        wallet.balance -= decimal.Decimal(price) * 100
+        wallet.updated_at = timezone.now()
+        wallet.save()
+        order.distance_meters = result[0].get("distance_meters")
+        order.duration_seconds = result[0].get("duration_seconds")
+        order.price = decimal.Decimal(price) * 100
+        order.order_completion_code = code
+        order.save()
+
+        WalletTransaction.objects.create(
+            wallet=wallet,
+            transaction_type="debit",
+            amount=price,
+            transaction_status="pending",
+            created_at=timezone.now(),
+            paid_at=timezone.now(),
+        )
+
+        PendingWalletTransaction.objects.create(user=user, order=order, amount=price)
+
+        order_data = OrderDetailSerializer(order).data
+        enqueue_riders_notification(
+            result,
+            message=rider_message,
+            order_id=order.id,
+            price=price,
+            order_info=order_data,
+            request_coordinates={"long": order.pickup_long, "lat": order.pickup_lat},
+        )
+        return order_data
+
+    async def get_matrix_results(self, origin, destinations):
         """Get results from Matrix API."""
-        map_client = map_clients_manager.get_client()
-        results = map_client.get_distances_duration(origin, destinations)
-        return results
+        return await map_clients_manager.aget_distances_duration(origin, destinations)
 
 
 class UpdateOrderStatusView(APIView):
@@ -507,16 +608,17 @@ class UpdateOrderStatusView(APIView):
                 {"error": "Invalid order code."}, status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Update order status
-        order.status = order_status
-        order.save()
+        # Update order status, the customer is notified once it is committed
+        with transaction.atomic():
+            order.status = order_status
+            order.save()
 
-        send_customer_notification(
-            customer=order.customer.user.email,
-            message=f"Status update {order_status}",
-            ride_status=order_status,
-            by_pass_rider_info=True,
-        )
+            enqueue_customer_notification(
+                customer=order.customer.user.email,
+                message=f"Status update {order_status}",
+                ride_status=order_status,
+                by_pass_rider_info=True,
+            )
 
         return Response(
             {
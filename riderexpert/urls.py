@@ -22,4 +22,5 @@ urlpatterns = [
     path("account/", include("accounts.urls")),
     path("order/", include("orders.urls")),
     path("wallet/", include("wallet.urls")),
+    path("map-clients/", include("map_clients.urls")),
 ]
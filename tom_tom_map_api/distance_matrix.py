@@ -1,12 +1,112 @@
-import requests
 import logging
+import threading
+import time
+
+from accounts.utils import format_duration
+from http_pool.sessions import get_session
 
 
 class TomTomDistanceMatrix:
-    def __init__(self, api_key):
+    # Async job states after which polling stops without a result
+    failed_states = {"Failed", "Rejected", "Expired"}
+
+    def __init__(
+        self,
+        api_key,
+        sync_max_cells=200,
+        poll_initial_delay=0.5,
+        poll_max_delay=5,
+        job_deadline=30,
+        job_ttl=300,
+        api_url="https://api.tomtom.com",
+    ):
+        """
+        Args:
+            api_key (str): TomTom API key.
+            sync_max_cells (int): Largest matrix (origins x destinations) sent to
+                                  the synchronous endpoint, larger ones use an async job.
+            poll_initial_delay, poll_max_delay (float): Bounds in seconds of the
+                                  exponential backoff between async job status polls.
+            job_deadline (float): Seconds to wait for an async job to complete.
+            job_ttl (float): Seconds an in-flight async job may be reused by a retry.
+            api_url (str): Base URL of the TomTom API.
+        """
         self.api_key = api_key
-        self.base_url = "https://api.tomtom.com/routing/matrix/2/async"
+        self.base_url = f"{api_url}/routing/matrix/2"
+        self.async_url = f"{self.base_url}/async"
+        self.sync_max_cells = sync_max_cells
+        self.poll_initial_delay = poll_initial_delay
+        self.poll_max_delay = poll_max_delay
+        self.job_deadline = job_deadline
+        self.job_ttl = job_ttl
+        self.session = get_session("tomtom")
         self.logger = logging.getLogger(__name__)
+        self._jobs = {}
+        self._jobs_lock = threading.Lock()
+
+    def get_distance_duration(self, origin, riders_locations_data):
+        """
+        Get distance and duration between origin and multiple riders_locations using TomTom Matrix API.
+
+        Small matrices go to the synchronous endpoint, larger ones are submitted
+        as an async job which is polled until it completes.
+
+        Args:
+        - origin (str): Origin coordinates in the format 'longitude,latitude'.
+        - riders_locations_data (list of dict): List of dictionaries, each containing 'email' and 'location' keys.
+                                    'location' is a string in the format 'longitude,latitude'.
+
+        Returns:
+        - List of dictionaries: List of dictionaries, each containing 'email', 'distance' (in km), and
+                                'duration' for each location.
+        """
+        if not riders_locations_data:
+            self.logger.warning("No rider locations provided.")
+            return None
+        if len(riders_locations_data) <= self.sync_max_cells:
+            return self.get_sync_response(origin, riders_locations_data)
+        return self.get_async_response(origin, riders_locations_data)
+
+    def build_payload(self, origin, riders_locations_data):
+        origin_long, origin_lat = map(float, origin.split(","))
+        rider_locations = [
+            {
+                "point": {
+                    "latitude": float(item["location"].split(",")[1]),
+                    "longitude": float(item["location"].split(",")[0]),
+                }
+            }
+            for item in riders_locations_data
+        ]
+        return {
+            "origins": [{"point": {"latitude": origin_lat, "longitude": origin_long}}],
+            "destinations": rider_locations,
+            "options": {"routeType": "fastest", "vehicleMaxSpeed": 120},
+        }
+
+    def get_sync_response(self, origin, riders_locations_data):
+        """
+        Get the matrix from the synchronous endpoint in a single round trip.
+        """
+        try:
+            payload = self.build_payload(origin, riders_locations_data)
+            headers = {"Content-Type": "application/json"}
+            url = f"{self.base_url}?key={self.api_key}"
+            response = self.session.post(url, headers=headers, json=payload)
+
+            if response.status_code == 200:
+                return self.parse_results(response.json(), riders_locations_data)
+            else:
+                self.logger.error(
+                    f"Failed to get sync matrix. Status code: {response.status_code}"
+                )
+                raise Exception(
+                    f"Failed to get sync matrix. Status code: {response.status_code}. Error: {response.text}"
+                )
+
+        except Exception as e:
+            self.logger.exception(f"Error occurred while getting sync matrix: {e}")
+            raise e
 
     def post_async_matrix(self, origin, riders_locations_data):
         """
@@ -21,32 +121,15 @@ class TomTomDistanceMatrix:
             str: JSON response from the API containing jobId and state.
         """
         try:
-            origin_long, origin_lat = map(float, origin.split(","))
             if not riders_locations_data:
                 self.logger.warning("No rider locations provided.")
                 return None
 
-            rider_locations = [
-                {
-                    "point": {
-                        "latitude": float(item["location"].split(",")[1]),
-                        "longitude": float(item["location"].split(",")[0]),
-                    }
-                }
-                for item in riders_locations_data
-            ]
-
-            payload = {
-                "origins": [
-                    {"point": {"latitude": origin_lat, "longitude": origin_long}}
-                ],
-                "destinations": rider_locations,
-                "options": {"routeType": "fastest", "vehicleMaxSpeed": 120},
-            }
+            payload = self.build_payload(origin, riders_locations_data)
             headers = {"Content-Type": "application/json"}
 
-            url = f"{self.base_url}?key={self.api_key}"
-            response = requests.post(url, headers=headers, json=payload)
+            url = f"{self.async_url}?key={self.api_key}"
+            response = self.session.post(url, headers=headers, json=payload)
 
             if response.status_code == 202:
                 return response.json()
@@ -64,7 +147,12 @@ class TomTomDistanceMatrix:
 
     def get_async_response(self, origin, riders_locations_data):
         """
-        Get distance and duration between origin and multiple riders_locations using TomTom Matrix API.
+        Get distance and duration between origin and multiple riders_locations using an async TomTom Matrix job.
+
+        The job is polled with capped exponential backoff until it completes or
+        the deadline passes. A job that is still in flight is reused when the
+        same matrix is requested again, e.g. by a retry, instead of being
+        submitted a second time.
 
         Args:
         - origin (str): Origin coordinates in the format 'longitude,latitude'.
@@ -72,40 +160,29 @@ class TomTomDistanceMatrix:
                                     'location' is a string in the format 'longitude,latitude'.
 
         Returns:
-        - List of dictionaries: List of dictionaries, each containing 'email', 'distance' (in meters), and
-                                'duration' (in minutes) for each location.
+        - List of dictionaries: List of dictionaries, each containing 'email', 'distance' (in km), and
+                                'duration' for each location.
         """
+        job_key = (origin, tuple(item["location"] for item in riders_locations_data))
         try:
-            results = []
-            post_response = self.post_async_matrix(origin, riders_locations_data)
-            if not post_response:
-                return None
+            job_id = self.get_in_flight_job(job_key)
+            if job_id is None:
+                post_response = self.post_async_matrix(origin, riders_locations_data)
+                if not post_response:
+                    return None
+                job_id = post_response.get("jobId")
+                with self._jobs_lock:
+                    self._jobs[job_key] = (job_id, time.monotonic())
 
-            job_id = post_response.get("jobId")
-            url = f"{self.base_url}/{job_id}/result"
+            self.wait_for_job(job_id, job_key)
+
+            url = f"{self.async_url}/{job_id}/result"
             params = {"key": self.api_key}
+            response = self.session.get(url, params=params)
+            self.forget_job(job_key)
 
-            response = requests.get(url, params=params)
             if response.status_code == 200:
-                data = response.json().get("data", [])
-
-                for i, item in enumerate(data):
-                    route_summary = item.get("routeSummary", {})
-                    distance = route_summary.get("lengthInMeters", 0)
-                    duration = route_summary.get("travelTimeInSeconds", 0)
-
-                    distance = round(distance / 1000, 2)
-
-                    formatted_duration = self.format_duration(duration)
-                    results.append(
-                        {
-                            "email": riders_locations_data[i]["email"],
-                            "distance": distance,
-                            "duration": formatted_duration,
-                        }
-                    )
-
-                return results
+                return self.parse_results(response.json(), riders_locations_data)
             else:
                 self.logger.error(
                     f"Failed to get async response. Status code: {response.status_code}"
@@ -118,22 +195,84 @@ class TomTomDistanceMatrix:
             self.logger.exception(f"Error occurred while getting async response: {e}")
             raise e
 
-    @staticmethod
-    def format_duration(duration: int) -> str:
+    def wait_for_job(self, job_id, job_key=None):
         """
-        Format a duration in seconds into a human-readable format.
-
-        Parameters:
-        - duration (int): The duration in seconds.
+        Poll the status of an async job until it is completed.
 
-        Returns:
-        - str: The formatted duration string.
+        Raises:
+            TimeoutError: If the job is not completed before the deadline, the job
+                          is kept so a retry can resume polling it.
+            Exception: If the job failed or its status could not be read, the
+                       job is forgotten.
         """
-        duration_minutes, duration_seconds = divmod(duration, 60)
-
-        if duration <= 60:
-            return f"{duration} secs"
-        elif duration_seconds == 0:
-            return f"{duration_minutes} minutes"
-        else:
-            return f"{duration_minutes} mins {duration_seconds} secs"
+        url = f"{self.async_url}/{job_id}"
+        params = {"key": self.api_key}
+        deadline = time.monotonic() + self.job_deadline
+        delay = self.poll_initial_delay
+
+        while True:
+            response = self.session.get(url, params=params)
+            if response.status_code != 200:
+                self.forget_job(job_key)
+                raise Exception(
+                    f"Failed to get async job status. Status code: {response.status_code}. Error: {response.text}"
+                )
+
+            state = response.json().get("state")
+            if state == "Completed":
+                return
+            if state in self.failed_states:
+                self.forget_job(job_key)
+                raise Exception(f"Async matrix job {job_id} ended with state {state}")
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(
+                    f"Async matrix job {job_id} not completed after {self.job_deadline} seconds"
+                )
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, self.poll_max_delay)
+
+    def get_in_flight_job(self, job_key):
+        with self._jobs_lock:
+            job = self._jobs.get(job_key)
+            if job is None:
+                return None
+            job_id, submitted_at = job
+            if time.monotonic() - submitted_at > self.job_ttl:
+                del self._jobs[job_key]
+                return None
+            return job_id
+
+    def forget_job(self, job_key):
+        with self._jobs_lock:
+            self._jobs.pop(job_key, None)
+
+    def parse_results(self, response_data, riders_locations_data):
+        results = []
+        data = sorted(
+            response_data.get("data", []),
+            key=lambda item: item.get("destinationIndex", 0),
+        )
+
+        for i, item in enumerate(data):
+            route_summary = item.get("routeSummary", {})
+            distance_meters = route_summary.get("lengthInMeters", 0)
+            duration_seconds = route_summary.get("travelTimeInSeconds", 0)
+
+            distance = round(distance_meters / 1000, 2)
+
+            formatted_duration = format_duration(duration_seconds)
+            results.append(
+                {
+                    "email": riders_locations_data[
+                        item.get("destinationIndex", i)
+                    ]["email"],
+                    "distance": distance,
+                    "duration": formatted_duration,
+                    "distance_meters": distance_meters,
+                    "duration_seconds": duration_seconds,
+                }
+            )
+
+        return results